@@ -0,0 +1,141 @@
+import threading
+import time
+from collections import OrderedDict
+
+SKETCH_WIDTH = 1 << 14  # counters per row of the frequency sketch
+SKETCH_DEPTH = 4  # rows of the frequency sketch, i.e. counters per article
+MAX_COUNT = 15  # counters saturate here, recent popularity is all that matters
+SAMPLE_FACTOR = 10  # the sketch ages after SAMPLE_FACTOR * width increments
+NEGATIVE_CACHE_SIZE = 4096  # max number of paths the origin answered with a 404 to remember
+NEGATIVE_CACHE_TTL = 60.0  # seconds a 404 from the origin is remembered
+
+# Halves a counter, for bytes.translate()
+HALVE = bytes(count >> 1 for count in range(256))
+
+
+class FrequencySketch:
+    """
+    This class represents a count-min sketch of how often articles were requested
+    lately, for any number of articles in a fixed amount of memory (the frequency
+    part of TinyLFU).
+
+    Every article maps to one small counter in each row, and its frequency is the
+    smallest of them, so collisions can only make an article look more popular than
+    it is, never less. Only the smallest counters are incremented (conservative
+    update), which keeps the overestimation down. After sample_size increments all
+    the counters are halved, so that what was popular a while ago fades out and the
+    frequencies reflect recent traffic.
+    """
+
+    def __init__(self, width: int = SKETCH_WIDTH, depth: int = SKETCH_DEPTH, sample_size: int = None):
+        """
+        :param width: counters per row, rounded up to a power of two
+        :param depth: number of rows
+        :param sample_size: increments after which the counters are halved, defaults to SAMPLE_FACTOR * width
+        """
+
+        self.width = 1 << max(0, width - 1).bit_length()
+        self.mask = self.width - 1
+        self.depth = depth
+        self.sample_size = sample_size or SAMPLE_FACTOR * self.width
+        self.rows = [bytearray(self.width) for _ in range(depth)]
+        self.additions = 0
+        self.resets = 0
+        self.lock = threading.Lock()
+
+    def indexes(self, article: str) -> list:
+        # Double hashing: the rows are independent enough without hashing the name once per row
+        h = hash(article)
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return [(h1 + i * h2) & self.mask for i in range(self.depth)]
+
+    def increment(self, article: str) -> None:
+        indexes = self.indexes(article)
+        with self.lock:
+            counts = [row[index] for row, index in zip(self.rows, indexes)]
+            smallest = min(counts)
+            if smallest >= MAX_COUNT:
+                return
+            for row, index, count in zip(self.rows, indexes, counts):
+                if count == smallest:
+                    row[index] = count + 1
+
+            self.additions += 1
+            if self.additions >= self.sample_size:
+                self.reset()
+
+    def estimate(self, article: str) -> int:
+        """
+        :return: how often the article was requested lately, possibly a bit more
+        """
+
+        indexes = self.indexes(article)
+        with self.lock:
+            return min(row[index] for row, index in zip(self.rows, indexes))
+
+    def reset(self) -> None:
+        """
+        Halves every counter. Holding self.lock.
+        """
+
+        self.rows = [bytearray(row.translate(HALVE)) for row in self.rows]
+        self.additions //= 2
+        self.resets += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "width": self.width,
+                "depth": self.depth,
+                "bytes": self.width * self.depth,
+                "additions": self.additions,
+                "sample_size": self.sample_size,
+                "resets": self.resets,
+            }
+
+
+class NegativeCache:
+    """
+    This class represents the paths the origin recently answered with a 404, so that
+    requests for them are answered right away instead of going to the origin again.
+
+    It holds at most max_entries paths, and forgets the oldest ones first and any
+    that are older than ttl.
+    """
+
+    def __init__(self, max_entries: int = NEGATIVE_CACHE_SIZE, ttl: float = NEGATIVE_CACHE_TTL):
+        """
+        :param max_entries: max number of paths to remember
+        :param ttl: seconds a path is remembered
+        """
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.expires = OrderedDict()  # path -> when to forget it, oldest first
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    def add(self, path: str) -> None:
+        with self.lock:
+            self.expires[path] = time.monotonic() + self.ttl
+            self.expires.move_to_end(path)
+            while len(self.expires) > self.max_entries:
+                self.expires.popitem(last=False)
+
+    def __contains__(self, path: str) -> bool:
+        with self.lock:
+            expires = self.expires.get(path)
+            if expires is None:
+                return False
+            if expires <= time.monotonic():
+                del self.expires[path]
+                return False
+            self.hits += 1
+            return True
+
+    def __len__(self) -> int:
+        return len(self.expires)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"paths": len(self.expires), "max_entries": self.max_entries, "hits": self.hits}
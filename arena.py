@@ -0,0 +1,213 @@
+import mmap
+from bisect import bisect_left, insort
+
+NO_SPACE = -1
+
+
+class Arena:
+    """
+    A simple arena allocator over a single preallocated anonymous memory map.
+
+    Articles are stored back to back in one contiguous region instead of as
+    separate bytes objects, so the memory used by the in-memory cache is exactly
+    the capacity of the arena no matter how many articles are in it, and there's
+    no per-object overhead or garbage collector involved.
+
+    Free space is tracked as a list of (offset, length) extents sorted by offset.
+    Allocation is first fit and freed extents are merged with their neighbours.
+    When the free space is too fragmented for an allocation, compact() slides the
+    allocated regions towards the start of the arena.
+
+    Reads hand out zero-copy memoryview slices. Since a slice would see whatever
+    gets written to the region next, every slice handed out by lease() pins its
+    region until it is given back with release(). Pinned regions that get freed
+    are only reused once the last lease is released, and compact() leaves them alone.
+
+    The arena does no locking of its own, callers have to serialize access to it.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        # Anonymous maps are MAP_SHARED on Unix, so forked processes see the same pages
+        self.memory = mmap.mmap(-1, capacity)
+        self.view = memoryview(self.memory)
+        self.free_extents = [(0, capacity)]
+        self.allocations = {}  # offset -> length of every allocated region
+        self.pins = {}  # offset -> number of outstanding leases
+        self.pending = {}  # offset -> length of regions freed while pinned
+        self.leases = {}  # id(slice) -> offset of the region it was taken from
+
+    def allocate(self, length: int) -> int:
+        """
+        Reserves length bytes in the arena.
+
+        :return: the offset of the region or NO_SPACE if there's no contiguous free region large enough
+        """
+        for i, (offset, extent_length) in enumerate(self.free_extents):
+            if extent_length >= length:
+                if extent_length == length:
+                    del self.free_extents[i]
+                else:
+                    self.free_extents[i] = (offset + length, extent_length - length)
+                self.allocations[offset] = length
+                return offset
+
+        return NO_SPACE
+
+    def store(self, data: bytes) -> int:
+        """
+        Allocates a region and copies data into it.
+
+        :return: the offset of the region or NO_SPACE
+        """
+        offset = self.allocate(len(data))
+        if offset != NO_SPACE:
+            self.view[offset : offset + len(data)] = data
+        return offset
+
+    def free(self, offset: int):
+        """
+        Gives back a region. If it is pinned, it only becomes free again once the last lease is released.
+        """
+        length = self.allocations.pop(offset)
+        if offset in self.pins:
+            self.pending[offset] = length
+        else:
+            self._add_free_extent(offset, length)
+
+    def lease(self, offset: int) -> memoryview:
+        """
+        :return: a zero-copy slice of the region at offset, pinned until it is released
+        """
+        length = self.pin(offset)
+        data = self.view[offset : offset + length]
+        self.leases[id(data)] = offset
+        return data
+
+    def release(self, data: memoryview):
+        """
+        Gives back a slice handed out by lease().
+        """
+        offset = self.leases.pop(id(data), None)
+        if offset is None:
+            return
+        data.release()
+        self.unpin(offset)
+
+    def pin(self, offset: int) -> int:
+        """
+        Pins the region at offset without handing out a slice, for readers
+        that slice the memory themselves (e.g. another process).
+
+        :return: the length of the region
+        """
+        length = self.allocations[offset]
+        self.pins[offset] = self.pins.get(offset, 0) + 1
+        return length
+
+    def unpin(self, offset: int):
+        """
+        Undoes one pin(). The region becomes free if it was freed while pinned.
+        """
+        pins = self.pins[offset] - 1
+        if pins:
+            self.pins[offset] = pins
+            return
+
+        del self.pins[offset]
+        if offset in self.pending:
+            self._add_free_extent(offset, self.pending.pop(offset))
+
+    def free_bytes(self) -> int:
+        return sum(length for _, length in self.free_extents)
+
+    def largest_free_extent(self) -> int:
+        return max((length for _, length in self.free_extents), default=0)
+
+    def compact(self) -> dict:
+        """
+        Slides every unpinned region as far towards the start of the arena as it
+        goes without overlapping a pinned one, merging all the holes in between.
+
+        :return: a dict mapping the old offset of every moved region to its new one
+        """
+        moved, self.allocations, self.free_extents = self._plan_compaction(self.allocations, self.pending)
+        for offset, target in sorted(moved.items()):
+            self.memory.move(target, offset, self.allocations[target])
+        return moved
+
+    def fits_after_free(self, length: int, offsets: list) -> bool:
+        """
+        Works out whether length bytes could be stored, compacting if need be, once
+        the regions at offsets are freed, without freeing or moving anything. The
+        pinned ones among them would only be freed once they're released, so they
+        don't count.
+        """
+        allocations = dict(self.allocations)
+        pending = dict(self.pending)
+        for offset in offsets:
+            region_length = allocations.pop(offset)
+            if offset in self.pins:
+                pending[offset] = region_length
+
+        _, _, free_extents = self._plan_compaction(allocations, pending)
+        return any(extent_length >= length for _, extent_length in free_extents)
+
+    def _plan_compaction(self, allocations: dict, pending: dict) -> (dict, dict, list):
+        """
+        :return: where compacting the given regions would move them (old offset ->
+        new one), the regions after that and the free extents left
+        """
+        # Regions that can't move: the ones being read and the ones waiting for their readers
+        fixed = sorted(
+            [(offset, offset + allocations[offset]) for offset in self.pins if offset in allocations]
+            + [(offset, offset + length) for offset, length in pending.items()]
+        )
+
+        moved = {}
+        compacted = {}
+        cursor = 0
+        for offset in sorted(allocations):
+            length = allocations[offset]
+            if offset in self.pins:
+                compacted[offset] = length
+                continue
+
+            target = cursor
+            for start, end in fixed:
+                if start < target + length and end > target:
+                    target = end
+
+            if target != offset:
+                moved[offset] = target
+            compacted[target] = length
+            cursor = target + length
+
+        occupied = sorted(list(compacted.items()) + list(pending.items()))
+        free_extents = []
+        cursor = 0
+        for offset, length in occupied:
+            if offset > cursor:
+                free_extents.append((cursor, offset - cursor))
+            cursor = max(cursor, offset + length)
+        if cursor < self.capacity:
+            free_extents.append((cursor, self.capacity - cursor))
+
+        return moved, compacted, free_extents
+
+    def _add_free_extent(self, offset: int, length: int):
+        i = bisect_left(self.free_extents, (offset, length))
+
+        # Merge with the next extent
+        if i < len(self.free_extents) and self.free_extents[i][0] == offset + length:
+            length += self.free_extents[i][1]
+            del self.free_extents[i]
+
+        # Merge with the previous extent
+        if i > 0:
+            previous_offset, previous_length = self.free_extents[i - 1]
+            if previous_offset + previous_length == offset:
+                self.free_extents[i - 1] = (previous_offset, previous_length + length)
+                return
+
+        insort(self.free_extents, (offset, length))
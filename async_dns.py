@@ -0,0 +1,257 @@
+import asyncio
+import socket
+import struct
+import threading
+from types import SimpleNamespace
+from typing import Callable, Optional
+
+from dnslib import DNSRecord
+from dnslib.dns import DNSError
+
+from ringlog import log
+from subnets import (
+    ECS_OPTION,
+    EDNS_UDP_SIZE,
+    ClientSubnet,
+    encode_client_subnet,
+    parse_client_subnet,
+    scope_prefix_len,
+)
+
+HEADER_SIZE = 12
+QTYPE_A_CLASS_IN = b"\x00\x01\x00\x01"
+# Header counts of the queries the fast path handles: one question, and no additional
+# record or a single OPT (EDNS) record
+PLAIN_COUNTS = b"\x00\x01\x00\x00\x00\x00\x00\x00"
+EDNS_COUNTS = b"\x00\x01\x00\x00\x00\x00\x00\x01"
+OPT_HEADER = b"\x00\x00\x29"  # root name, type OPT
+OPT_FIXED_SIZE = 11  # name, type, class, TTL and rdlength
+
+
+def encode_name(name: str) -> bytes:
+    """
+    :return: a domain name in wire format (lowercase, uncompressed)
+    """
+
+    labels = name.rstrip(".").lower().split(".")
+    return b"".join(bytes([len(label)]) + label.encode("ascii") for label in labels) + b"\x00"
+
+
+def read_opt(additional: bytes) -> (bool, Optional[ClientSubnet]):
+    """
+    :param additional: the bytes after the question
+    :return: whether they're exactly one well-formed OPT record, and its EDNS Client Subnet if it has one
+    """
+
+    if len(additional) < OPT_FIXED_SIZE or additional[:3] != OPT_HEADER:
+        return False, None
+    rdlength = struct.unpack_from("!H", additional, 9)[0]
+    if len(additional) != OPT_FIXED_SIZE + rdlength:
+        return False, None
+
+    client_subnet = None
+    offset = OPT_FIXED_SIZE
+    while offset < len(additional):
+        if offset + 4 > len(additional):
+            return False, None
+        code, length = struct.unpack_from("!HH", additional, offset)
+        offset += 4 + length
+        if offset > len(additional):
+            return False, None
+        if code == ECS_OPTION:
+            client_subnet = parse_client_subnet(additional[offset - length : offset])
+            if client_subnet is None:
+                return False, None
+    return True, client_subnet
+
+
+def encode_opt(client_subnet: ClientSubnet, scope_prefix_len: int) -> bytes:
+    """
+    :return: an OPT record with nothing but an EDNS Client Subnet option
+    """
+
+    ecs = encode_client_subnet(client_subnet, scope_prefix_len)
+    return (
+        OPT_HEADER
+        + struct.pack("!HIH", EDNS_UDP_SIZE, 0, len(ecs) + 4)  # payload size, no extended rcode or flags
+        + struct.pack("!HH", ECS_OPTION, len(ecs))
+        + ecs
+    )
+
+
+class AsyncDNSServer:
+    """
+    This class represents an asyncio-based UDP front end for the DNS server.
+
+    It answers A queries for the CDN name itself, without dnslib: the question is
+    checked against the pre-encoded name with a byte comparison, and the reply is
+    the transaction ID and question of the query patched into a pre-encoded answer
+    for the replica, i.e. a few slices and joins instead of parsing the query and
+    building the reply record by record. Anything else, e.g. other names, other
+    query types or several questions, goes to the dnslib resolver like it does with
+    the threaded server, so the replies are the same either way.
+
+    Has the same interface as dnslib's DNSServer as far as DNSProxy is concerned.
+    Queries with EDNS Client Subnet get it echoed with the scope of the answer in
+    an OPT record. Other EDNS clients get a reply without an OPT record, like with
+    dnslib, which is how servers that don't do EDNS answer.
+    """
+
+    def __init__(
+        self,
+        resolver,
+        pick_replica: Callable[[str, Optional[ClientSubnet]], tuple],
+        name: str,
+        ttl: int,
+        address: str = "",
+        port: int = 53,
+    ):
+        """
+        :param resolver: the dnslib resolver for the queries the fast path doesn't handle
+        :param pick_replica: returns the best replica for a client's IP address and client subnet, and its network
+        :param name: the CDN-specific name the server translates to an IP
+        :param ttl: the TTL of the answers
+        :param address: the address the server will bind to
+        :param port: the port number the server will bind to
+        """
+
+        self.resolver = resolver
+        self.pick_replica = pick_replica
+        self.qname = encode_name(name)
+        self.question_end = HEADER_SIZE + len(self.qname) + len(QTYPE_A_CLASS_IN)
+        self.ttl = ttl
+        self.address = address
+        self.port = port
+        self.answers = {}  # replica IP -> the answer record, pointing at the question for its name
+        self.loop = None
+        self.transport = None
+        self.thread = None
+
+        # Flags and counts of a reply by (recursion desired, OPT record): an authoritative
+        # answer, recursion available, and recursion desired copied from the query
+        self.reply_headers = {
+            (rd, opt): bytes([0x84 | rd, 0x80]) + b"\x00\x01\x00\x01\x00\x00" + bytes([0, opt])
+            for rd in (0, 1)
+            for opt in (0, 1)
+        }
+
+        self.fast = 0
+        self.fallback = 0
+        self.dropped = 0
+
+    def answer(self, replica_ip: str) -> bytes:
+        """
+        :return: the pre-encoded answer record for a replica
+        """
+
+        answer = self.answers.get(replica_ip)
+        if answer is None:
+            # Name (a pointer to the question), type A, class IN, TTL, rdlength and the address
+            answer = b"\xc0\x0c" + QTYPE_A_CLASS_IN + struct.pack("!IH", self.ttl, 4) + socket.inet_aton(replica_ip)
+            self.answers[replica_ip] = answer
+        return answer
+
+    def reply(self, data: bytes, client_address: tuple) -> bytes:
+        """
+        :param data: the query
+        :param client_address: the (host, port) of the client
+        :return: the reply, or None if there's none
+        """
+
+        question_end = self.question_end
+        if (
+            len(data) >= question_end
+            and not data[2] & 0xF8  # a standard query
+            and data[HEADER_SIZE:question_end].lower() == self.qname + QTYPE_A_CLASS_IN
+        ):
+            counts = data[4:HEADER_SIZE]
+            if counts == PLAIN_COUNTS and len(data) == question_end:
+                fast, client_subnet = True, None
+            elif counts == EDNS_COUNTS:
+                fast, client_subnet = read_opt(data[question_end:])
+            else:
+                fast = False
+
+            if fast:
+                self.fast += 1
+                replica_ip, unit = self.pick_replica(client_address[0], client_subnet)
+                reply = (
+                    data[:2]
+                    + self.reply_headers[data[2] & 1, client_subnet is not None]
+                    + data[HEADER_SIZE:question_end]
+                    + self.answer(replica_ip)
+                )
+                if client_subnet is not None:
+                    reply += encode_opt(client_subnet, scope_prefix_len(client_subnet, unit))
+                return reply
+
+        self.fallback += 1
+        try:
+            request = DNSRecord.parse(data)
+            return self.resolver.resolve(request, SimpleNamespace(client_address=client_address)).pack()
+        except DNSError as e:
+            log(f"DNS: {client_address[0]}: {e}")
+        except Exception as e:
+            log(f"DNS: {client_address[0]}: Can't parse the query: {e!r}")
+        self.dropped += 1
+        return None
+
+    def start_thread(self) -> None:
+        """
+        Starts serving on an event loop in a background thread.
+        """
+
+        # Bind here, so that e.g. the port being taken is raised to the caller
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.address, self.port))
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.serve_forever, args=(sock,), daemon=True)
+        self.thread.start()
+
+    def serve_forever(self, sock: socket.socket) -> None:
+        """
+        Serves on a bound socket until stop() is called.
+        """
+
+        asyncio.set_event_loop(self.loop)
+        self.transport, _ = self.loop.run_until_complete(
+            self.loop.create_datagram_endpoint(lambda: DNSProtocol(self), sock=sock)
+        )
+        try:
+            self.loop.run_forever()
+        finally:
+            self.transport.close()
+            self.loop.close()
+
+    def stop(self) -> None:
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        log(f"DNS: {self.fast} fast path, {self.fallback} dnslib, {self.dropped} dropped")
+
+    def isAlive(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+
+class DNSProtocol(asyncio.DatagramProtocol):
+    """
+    Hands the queries over to the server and sends the replies back.
+    """
+
+    def __init__(self, server: AsyncDNSServer):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, client_address: tuple) -> None:
+        try:
+            reply = self.server.reply(data, client_address)
+        except Exception as e:
+            log(f"DNS: {client_address[0]}: {e!r}")
+            return
+        if reply is not None:
+            self.transport.sendto(reply, client_address)
+
+    def error_received(self, exc: Exception) -> None:
+        pass  # e.g. ICMP port unreachable from a client that went away
@@ -0,0 +1,413 @@
+import asyncio
+import contextlib
+import functools
+import http
+import socket
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import compression
+from cache import DiskSlice, RepliCache, tier_of
+from metrics import METRICS
+from origin import FETCH_ERRORS, OriginError
+from peers import PEER_HEADER
+from ringlog import log
+from streaming import ArticleStream
+
+MAX_HEADER_SIZE = 64 * 1024
+LINGER_RESET = struct.pack("ii", 1, 0)  # SO_LINGER on, with a timeout of 0
+
+
+class BadRequest(Exception):
+    """
+    Raised when a request can't be parsed.
+    """
+
+    pass
+
+
+@contextlib.contextmanager
+def wake_ups(stream: ArticleStream):
+    """
+    :return: an event the stream sets, from whichever thread writes to it, whenever
+    there's something new. Waiting on it doesn't take up a thread.
+    """
+
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+
+    def wake_up():
+        with contextlib.suppress(RuntimeError):  # the loop is closed
+            loop.call_soon_threadsafe(event.set)
+
+    stream.subscribe(wake_up)
+    try:
+        yield event
+    finally:
+        stream.unsubscribe(wake_up)
+
+
+class AsyncReplicaServer:
+    """
+    This class represents an asyncio-based engine for the replica's http server.
+
+    A single event loop serves all the connections instead of one OS thread per
+    connection. Connections are kept alive as per HTTP/1.1 until they have been idle
+    for keepalive_timeout seconds, and at most max_connections are served at once.
+    The rest are accepted all the same but wait for one of them to close before
+    their requests are read, and an idle keep-alive connection holds on to its slot
+    until it times out. Anything that might block, i.e. origin fetches,
+    disk reads and the routes other than articles, runs on a bounded thread pool.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        repli_cache: RepliCache,
+        get_routes: dict,
+        post_routes: dict,
+        max_connections: int = 512,
+        keepalive_timeout: float = 15.0,
+        workers: int = 32,
+        reuse_port: bool = False,
+    ):
+        """
+        :param host: the address the server will bind to
+        :param port: the port number the server will bind to
+        :param repli_cache: the cache the articles are served from
+        :param get_routes: maps paths other than articles to functions returning (status, content type, body)
+        :param post_routes: same as get_routes, but the functions take the body of the request
+        :param max_connections: the max number of connections served at once
+        :param keepalive_timeout: seconds an idle connection is kept open
+        :param workers: the number of threads for blocking work
+        :param reuse_port: whether to share the port with other processes (SO_REUSEPORT)
+        """
+
+        self.host = host
+        self.port = port
+        self.repli_cache = repli_cache
+        self.get_routes = get_routes
+        self.post_routes = post_routes
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.reuse_port = reuse_port
+        self.hostname = socket.gethostname()
+        self.server = None
+
+    def serve_forever(self) -> None:
+        """
+        Starts the event loop and serves until interrupted.
+        """
+
+        asyncio.run(self.serve())
+
+    def server_close(self) -> None:
+        """
+        Stops accepting connections and shuts down the thread pool.
+        """
+
+        if self.server is not None:
+            self.server.close()
+        self.executor.shutdown(wait=False)
+
+    async def serve(self) -> None:
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(self.executor)
+        self.connection_slots = asyncio.Semaphore(self.max_connections)
+        self.server = await asyncio.start_server(
+            self.handle_connection,
+            self.host,
+            self.port,
+            limit=MAX_HEADER_SIZE,
+            reuse_address=True,
+            reuse_port=self.reuse_port,
+            backlog=1024,
+        )
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Serves requests on a connection for as long as it is kept alive.
+        """
+
+        async with self.connection_slots:
+            try:
+                keep_alive = True
+                while keep_alive:
+                    keep_alive = await self.handle_request(reader, writer)
+            except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                pass  # the client went away or was idle for too long
+            finally:
+                writer.close()
+
+    async def handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        """
+        Reads a request from the connection and fulfills it.
+
+        :return: whether the connection should be kept alive
+        """
+
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.keepalive_timeout)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            return False  # the client closed the connection between requests
+        except asyncio.LimitOverrunError:
+            await self.send_response(writer, http.HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, keep_alive=False)
+            return False
+
+        try:
+            method, path, version, headers = self.parse_head(head)
+        except BadRequest:
+            await self.send_response(writer, http.HTTPStatus.BAD_REQUEST, keep_alive=False)
+            return False
+
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = connection != "close"
+        else:
+            keep_alive = connection == "keep-alive"
+
+        loop = asyncio.get_running_loop()
+        if method == "GET":
+            if path in self.get_routes:
+                response = await loop.run_in_executor(None, self.get_routes[path])
+                await self.send_response(writer, *response, keep_alive=keep_alive)
+            else:
+                encoding = compression.negotiate(headers.get("accept-encoding"))
+                if encoding is None:  # the client accepts neither gzip nor identity
+                    await self.send_response(writer, http.HTTPStatus.NOT_ACCEPTABLE, keep_alive=keep_alive)
+                else:
+                    from_peer = PEER_HEADER.lower() in headers
+                    chunked = version == "HTTP/1.1"
+                    keep_alive = await self.send_article(
+                        writer, path, encoding, keep_alive, from_peer, chunked, headers
+                    )
+        elif method == "POST":
+            try:
+                content_length = int(headers.get("content-length", 0))
+            except ValueError:
+                content_length = -1
+            if content_length < 0:
+                await self.send_response(writer, http.HTTPStatus.BAD_REQUEST, keep_alive=False)
+                return False
+            post_data = await reader.readexactly(content_length)
+            if path in self.post_routes:
+                response = await loop.run_in_executor(None, self.post_routes[path], post_data)
+                await self.send_response(writer, *response, keep_alive=keep_alive)
+            else:
+                await self.send_response(writer, http.HTTPStatus.NOT_FOUND, keep_alive=keep_alive)
+        else:
+            await self.send_response(writer, http.HTTPStatus.NOT_IMPLEMENTED, keep_alive=False)
+            return False
+
+        return keep_alive
+
+    @staticmethod
+    def parse_head(head: bytes) -> (str, str, str, dict):
+        """
+        Parses the request line and the headers of a request.
+
+        :return: the method, path, http version and headers (with lowercase names)
+        """
+
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, path, version = lines[0].split(" ")
+        except ValueError as e:
+            raise BadRequest(lines[0]) from e
+        if not version.startswith("HTTP/"):
+            raise BadRequest(lines[0])
+
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(":")
+            if not sep:
+                raise BadRequest(line)
+            headers[name.strip().lower()] = value.strip()
+
+        return method, path, version, headers
+
+    async def send_article(
+        self,
+        writer: asyncio.StreamWriter,
+        path: str,
+        encoding: str,
+        keep_alive: bool,
+        from_peer: bool = False,
+        chunked: bool = True,
+        request_headers: dict = None,
+    ) -> bool:
+        """
+        Sends an article from the cache. Looking it up might mean going to the origin,
+        so that happens on the thread pool. A miss that's streamed is waited for here
+        instead, so that slow misses can't take up the threads the hits need. Disk hits
+        are sent with sendfile(), unless the article has to be decompressed for the
+        client. Conditional requests for the version we have get a 304 instead.
+
+        :param from_peer: whether another replica is asking for it (see peers.py)
+        :param chunked: whether the client understands chunked transfer encoding
+        :param request_headers: the headers of the request (with lowercase names)
+        :return: whether the connection can be kept alive
+        """
+
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        lookup = functools.partial(self.repli_cache.get, path, from_peer, wait=False)
+        try:
+            found, data, freshness = await loop.run_in_executor(None, lookup)
+        except FETCH_ERRORS as e:
+            log(f"{path}: Fetching failed: {e!r}")
+            await self.send_response(writer, http.HTTPStatus.BAD_GATEWAY, keep_alive=keep_alive)
+            return keep_alive
+        if isinstance(data, ArticleStream):
+            try:
+                await self.wait_started(data)
+            except Exception as e:
+                if not isinstance(e, OriginError) or e.status != http.HTTPStatus.NOT_FOUND:
+                    log(f"{data.article}: Streaming failed: {e!r}")
+                    await self.send_response(writer, http.HTTPStatus.BAD_GATEWAY, keep_alive=keep_alive)
+                    return keep_alive
+                found = False
+            freshness = data.freshness
+        if not found:  # if the article object doesn't exist
+            METRICS.count("requests.not_found")
+            await self.send_response(writer, http.HTTPStatus.NOT_FOUND, keep_alive=keep_alive)
+            return keep_alive
+
+        tier = tier_of(data)
+        try:
+            request_headers = request_headers or {}
+            if freshness is not None and freshness.not_modified(
+                request_headers.get("if-none-match"), request_headers.get("if-modified-since")
+            ):
+                # The client's copy is the one we have
+                METRICS.count("requests.not_modified")
+                headers = {"Vary": "Accept-Encoding", **freshness.response_headers()}
+                writer.write(self.format_head(http.HTTPStatus.NOT_MODIFIED, headers, keep_alive))
+                await writer.drain()
+                return keep_alive
+
+            headers = {"Content-Type": "text/html; charset=utf-8"}
+            if encoding == compression.IDENTITY:
+                body = await loop.run_in_executor(None, compression.decompress, data)
+            else:
+                body = data
+                headers["Content-Encoding"] = encoding
+            headers["Vary"] = "Accept-Encoding"
+            if freshness is not None:
+                headers.update(freshness.response_headers())
+            if isinstance(body, ArticleStream):  # a miss that is still coming in from the origin
+                return await self.send_stream(writer, body, headers, keep_alive, chunked)
+            headers["Content-Length"] = str(len(body))
+            writer.write(self.format_head(http.HTTPStatus.OK, headers, keep_alive))
+            if isinstance(body, DiskSlice):
+                await writer.drain()
+                await loop.sendfile(writer.transport, body.file, body.offset, body.length)
+            else:
+                writer.write(body)
+                await writer.drain()
+            METRICS.count("bytes.sent", len(body))
+        finally:
+            self.repli_cache.release(data)
+            METRICS.count(f"requests.{tier}")
+            METRICS.observe(f"latency.{tier}", time.perf_counter() - start)
+        return keep_alive
+
+    @staticmethod
+    async def wait_started(stream: ArticleStream) -> None:
+        """
+        Same as ArticleStream.wait_started(), without taking up a thread.
+        """
+
+        with wake_ups(stream) as more:
+            while True:
+                more.clear()
+                if stream.has_started():
+                    return
+                await more.wait()
+
+    async def send_stream(
+        self, writer: asyncio.StreamWriter, stream: ArticleStream, headers: dict, keep_alive: bool, chunked: bool
+    ) -> bool:
+        """
+        Sends an article as it comes in from the origin, with chunked transfer encoding,
+        or until the connection is closed for clients that don't understand it. If the
+        fetch fails halfway, the connection is reset, so that the client can tell the
+        article is cut short. The stream wakes the event loop up when there's more,
+        so waiting for the origin doesn't take up a thread of the pool.
+
+        :return: whether the connection can be kept alive
+        """
+
+        if chunked:
+            headers["Transfer-Encoding"] = "chunked"
+        else:
+            keep_alive = False
+        writer.write(self.format_head(http.HTTPStatus.OK, headers, keep_alive))
+
+        with wake_ups(stream) as more:
+            offset = 0
+            while True:
+                more.clear()
+                try:
+                    chunk = stream.read_nowait(offset)
+                except Exception as e:
+                    log(f"{stream.article}: Streaming failed: {e!r}")
+                    # Close it right away with a zero linger time, which sends a reset instead of the end of the stream
+                    writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, LINGER_RESET)
+                    writer.transport.abort()
+                    return False
+                if chunk is None:
+                    await more.wait()
+                    continue
+                if not chunk:
+                    break
+                offset += len(chunk)
+                writer.write(b"%x\r\n%b\r\n" % (len(chunk), chunk) if chunked else chunk)
+                await writer.drain()
+
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        METRICS.count("bytes.sent", offset)
+        return keep_alive
+
+    async def send_response(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        content_type: str = None,
+        body: bytes = b"",
+        keep_alive: bool = True,
+    ) -> None:
+        """
+        Sends a complete response.
+        """
+
+        headers = {}
+        if content_type is not None:
+            headers["Content-Type"] = content_type
+        if status != http.HTTPStatus.NO_CONTENT:
+            headers["Content-Length"] = str(len(body))
+        writer.write(self.format_head(status, headers, keep_alive) + body)
+        await writer.drain()
+
+    def format_head(self, status: int, headers: dict, keep_alive: bool) -> bytes:
+        """
+        :return: the status line and headers of a response
+        """
+
+        status = http.HTTPStatus(status)
+        lines = [f"HTTP/1.1 {status.value} {status.phrase}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        lines.append(f"Host: {self.hostname}")
+        lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
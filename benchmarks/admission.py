@@ -0,0 +1,211 @@
+"""
+Simulation of the cache under scan-like and long-tail traffic, with and without
+admission mode (the TinyLFU frequency sketch, see admission.py).
+
+Drives a real RepliCache in-process, with an origin stand-in that answers right
+away, through three traces:
+
+ - zipf:      requests for the articles in pageviews.csv, weighted by their views
+ - scan:      the zipf trace with a scan of articles that are requested only once
+              mixed in, e.g. a crawler
+ - long-tail: the zipf trace mixed with requests for a large number of articles
+              that aren't in pageviews.csv, themselves Zipf distributed, some of
+              which the origin doesn't have
+
+Modes:
+
+ - views:    the default, only the articles in pageviews.csv are served and the
+             rest get a 404 without going to the origin
+ - tinylfu:  admission mode, any article the origin has is served
+ - exact:    admission mode with an exact count per article instead of the sketch,
+             i.e. what it would take to track every article ever requested
+
+Reports the hit ratio over all the requests the mode serves and over the ones for
+articles in pageviews.csv, the origin requests, and how many articles are tracked
+and how much memory their popularity takes.
+
+Usage (from the repository root):
+    python -m benchmarks.admission [-n REQUESTS] [--tail-articles N] [--seed SEED] [--json]
+"""
+import contextlib
+import gzip
+import json
+import os
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from benchmarks.loadgen import REPO_ROOT, load_articles
+from benchmarks.stub_origin import make_page
+from cache import RepliCache
+from origin import OriginError, OriginResponse
+
+TRACES = ("zipf", "scan", "long-tail")
+MODES = ("views", "tinylfu", "exact")
+PAGE_VARIANTS = 32  # distinct pages the origin stand-in serves, picked by path
+MISSING_SHARE = 0.05  # share of the long tail articles the origin doesn't have
+
+
+class InstantOrigin:
+    """
+    Stands in for the origin pool: serves gzipped synthetic pages right away.
+    """
+
+    def __init__(self, missing: set):
+        self.pages = [gzip.compress(make_page(f"/page{i}"), 6) for i in range(PAGE_VARIANTS)]
+        self.missing = missing
+        self.requests = 0
+
+    def get(self, path: str, headers: dict = None) -> OriginResponse:
+        self.requests += 1
+        path = "/" + path.lstrip("/")
+        if path in self.missing:
+            raise OriginError(path, 404, "Not Found")
+        body = self.pages[hash(path) % PAGE_VARIANTS]
+        return OriginResponse(200, {"Content-Encoding": "gzip"}, body)
+
+
+class ExactCounter:
+    """
+    An exact count per article, in place of the frequency sketch.
+    """
+
+    def __init__(self):
+        self.counts = {}
+
+    def increment(self, article: str):
+        self.counts[article] = self.counts.get(article, 0) + 1
+
+    def estimate(self, article: str) -> int:
+        return self.counts.get(article, 0)
+
+    def memory(self) -> int:
+        return sys.getsizeof(self.counts) + sum(sys.getsizeof(article) for article in self.counts)
+
+
+def make_traces(count: int, tail_articles: int, rng: random.Random) -> (dict, set):
+    """
+    :return: the traces by name, and the paths the origin doesn't have
+    """
+    articles = load_articles()
+    paths = [path for path, _ in articles]
+    weights = [views for _, views in articles]
+    zipf = rng.choices(paths, weights=weights, k=count)
+
+    scan = list(zipf)
+    for i in range(count // 2):
+        scan.insert(rng.randrange(len(scan)), f"/Scanned_{i}")
+
+    tail = [f"/Tail_{rank}" for rank in range(tail_articles)]
+    tail_weights = [1 / (rank + 1) for rank in range(tail_articles)]
+    long_tail = list(zipf) + rng.choices(tail, weights=tail_weights, k=count)
+    rng.shuffle(long_tail)
+    missing = set(rng.sample(tail, int(tail_articles * MISSING_SHARE)))
+
+    return {"zipf": zipf, "scan": scan, "long-tail": long_tail}, missing
+
+
+def run(mode: str, trace: list, missing: set, listed: set, scratch: str) -> dict:
+    """
+    Replays a trace against a fresh cache.
+
+    :param scratch: where to put the cache's files, which outlive the run since its background threads do
+    """
+    workdir = tempfile.mkdtemp(dir=scratch)
+    shutil.copy(os.path.join(REPO_ROOT, "pageviews.csv"), workdir)
+    cwd = os.getcwd()
+    origin = InstantOrigin(missing)
+    os.chdir(workdir)
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            cache = RepliCache(
+                test_mode=True,
+                origin_pool=origin,
+                disk_cache_dir=os.path.join(workdir, "disk_cache"),
+                admission=mode != "views",
+                streaming=False,
+            )
+            if mode == "exact":
+                cache.sketch = ExactCounter()
+
+            served = hits = listed_requests = listed_hits = not_found = 0
+            start = time.perf_counter()
+            for path in trace:
+                before = origin.requests
+                found, data, _ = cache.get(path)
+                if not found:
+                    not_found += 1
+                    continue
+                cache.release(data)
+                hit = origin.requests == before
+                served += 1
+                hits += hit
+                if path in listed:
+                    listed_requests += 1
+                    listed_hits += hit
+            elapsed = time.perf_counter() - start
+
+            # Don't let this run's recompression slow the next one down
+            with contextlib.suppress(queue.Empty):
+                while True:
+                    cache.recompress_queue.get_nowait()
+    finally:
+        os.chdir(cwd)
+
+    if mode == "exact":
+        popularity_bytes = cache.sketch.memory()
+    elif mode == "tinylfu":
+        popularity_bytes = cache.sketch.stats()["bytes"]
+    else:
+        popularity_bytes = 0
+    return {
+        "served": served,
+        "not_found": not_found,
+        "hit_ratio": hits / served if served else 0.0,
+        "listed_hit_ratio": listed_hits / listed_requests if listed_requests else 0.0,
+        "origin_requests": origin.requests,
+        "tracked_articles": len(cache.articles),
+        "popularity_bytes": popularity_bytes,
+        "negative_cache_hits": cache.negative_cache.hits,
+        "requests_per_second": len(trace) / elapsed,
+    }
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", type=int, default=20000, help="number of requests in the zipf trace")
+    parser.add_argument("--tail-articles", type=int, default=100000, help="number of long tail articles")
+    parser.add_argument("--seed", type=int, default=5700, help="seed for the traces")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    traces, missing = make_traces(args.n, args.tail_articles, random.Random(args.seed))
+    listed = {path for path, _ in load_articles()}
+    scratch = tempfile.mkdtemp(prefix="admission-")
+    try:
+        results = {
+            f"{trace}/{mode}": run(mode, traces[trace], missing, listed, scratch)
+            for trace in TRACES
+            for mode in MODES
+        }
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for name, result in results.items():
+        print(
+            f"{name:>17}: hit ratio {result['hit_ratio']:6.1%} ({result['listed_hit_ratio']:6.1%} listed), "
+            f"{result['origin_requests']:6d} origin requests, {result['not_found']:6d} 404s, "
+            f"{result['tracked_articles']:6d} articles tracked, popularity in {result['popularity_bytes'] / 1024:7.0f}KB"
+        )
+
+
+if __name__ == "__main__":
+    main()
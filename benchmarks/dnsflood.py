@@ -0,0 +1,203 @@
+"""
+Load test comparing the two DNS server engines: dnslib's threaded DNSServer and
+the asyncio front end with pre-encoded answers (async_dns.py).
+
+Starts dnsserver on loopback for each engine and floods it with UDP queries from
+one or more client processes, each keeping a window of queries in flight. Reports
+queries/sec, p50/p99 latency and lost queries for:
+
+ - a: A queries for the CDN name, which the asyncio engine answers on its fast path
+ - aaaa: AAAA queries for the CDN name, which it leaves to dnslib like any other
+         unusual query, so this measures its fallback path
+
+All the queries come from 127.0.0.1, so after the first one the replica comes from
+the routing cache in geo.py, and what's measured is the DNS handling itself.
+
+GeoLite2-City.mmdb can't be redistributed, so if it's not there, the servers run
+against a synthetic database of the same shape (see benchmarks.synthetic_mmdb).
+
+Usage (from the repository root):
+    python -m benchmarks.dnsflood [-n QUERIES] [-w WINDOW] [--clients N] [--json]
+"""
+import contextlib
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from dnslib import QTYPE, DNSRecord
+
+from benchmarks.loadgen import REPO_ROOT, free_port, percentile
+from benchmarks.synthetic_mmdb import make_database
+
+ENGINES = ("threads", "asyncio")
+QUERY_TYPES = ("a", "aaaa")
+CDN_NAME = "cs5700cdn.example.com"
+GEOIP_DB = "GeoLite2-City.mmdb"
+
+
+def query(address: tuple, packet: bytes, timeout: float = 1.0) -> bytes:
+    """
+    Sends one query and waits for the reply.
+
+    :raises socket.timeout: if there's no reply
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(packet, address)
+        return sock.recv(4096)
+
+
+@contextlib.contextmanager
+def dns_server_process(engine: str, database: bytes = None):
+    """
+    Runs dnsserver in its own process on loopback, in a scratch directory with
+    the GeoIP database geo.py opens.
+
+    :param engine: the engine to run
+    :param database: the contents of a synthetic GeoIP database, None to use the real one
+    :return: the (host, port) of the server
+    """
+    workdir = tempfile.mkdtemp(prefix="dns-")
+    if database is None:
+        shutil.copy(os.path.join(REPO_ROOT, GEOIP_DB), workdir)
+    else:
+        with open(os.path.join(workdir, GEOIP_DB), "wb") as db_file:
+            db_file.write(database)
+
+    address = ("127.0.0.1", free_port())
+    command = [sys.executable, os.path.join(REPO_ROOT, "dnsserver"), "-p", str(address[1]), "-n", CDN_NAME]
+    command += ["-a", address[0], "--engine", engine]
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 30
+        probe = DNSRecord.question(CDN_NAME).pack()
+        while True:
+            try:
+                query(address, probe, timeout=0.2)
+                break
+            except OSError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise TimeoutError(f"dnsserver ({engine}) didn't come up")
+        yield address
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def flood(address: tuple, packet: bytes, count: int, window: int, timeout: float) -> dict:
+    """
+    Sends count queries, keeping window of them in flight. A query that isn't
+    answered within timeout is counted as lost.
+
+    :param packet: the query, whose transaction ID gets replaced
+    :return: the latencies of the answered queries, the number of lost ones and when the flood started and ended
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(address)
+    sock.settimeout(timeout)
+    body = packet[2:]
+    outstanding = {}  # transaction ID -> when it was sent
+    latencies = []
+    lost = 0
+    sent = 0
+
+    def send():
+        nonlocal sent
+        transaction_id = sent & 0xFFFF
+        outstanding[transaction_id] = time.perf_counter()
+        sock.send(transaction_id.to_bytes(2, "big") + body)
+        sent += 1
+
+    start = time.time()
+    for _ in range(min(window, count)):
+        send()
+    while outstanding:
+        try:
+            reply = sock.recv(4096)
+        except socket.timeout:
+            lost += len(outstanding)
+            outstanding.clear()
+            for _ in range(min(window, count - sent)):
+                send()
+            continue
+        sent_at = outstanding.pop(int.from_bytes(reply[:2], "big"), None)
+        if sent_at is None:
+            continue  # the reply to a query that was given up on
+        latencies.append(time.perf_counter() - sent_at)
+        if sent < count:
+            send()
+    end = time.time()
+    sock.close()
+    return {"latencies": latencies, "lost": lost, "start": start, "end": end}
+
+
+def run(address: tuple, qtype: str, count: int, window: int, clients: int, timeout: float) -> dict:
+    """
+    Floods a server from clients processes at once.
+
+    :return: queries/sec, latency percentiles, lost queries and the answer the server gave
+    """
+    packet = DNSRecord.question(CDN_NAME, qtype.upper()).pack()
+    answer = DNSRecord.parse(query(address, packet))
+    args = [(address, packet, count // clients, window, timeout)] * clients
+    with multiprocessing.Pool(clients) as pool:
+        floods = pool.starmap(flood, args)
+
+    latencies = sorted(latency for result in floods for latency in result["latencies"])
+    elapsed = max(result["end"] for result in floods) - min(result["start"] for result in floods)
+    return {
+        "queries_per_second": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "answered": len(latencies),
+        "lost": sum(result["lost"] for result in floods),
+        "answer": [f"{QTYPE[rr.rtype]} {rr.rdata}" for rr in answer.rr],
+    }
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", type=int, default=20000, help="number of queries per engine and query type")
+    parser.add_argument("-w", type=int, default=32, help="number of queries in flight per client")
+    parser.add_argument("--clients", type=int, default=1, help="number of client processes")
+    parser.add_argument("--timeout", type=float, default=1.0, help="seconds after which a query counts as lost")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    database = None
+    if not os.path.exists(os.path.join(REPO_ROOT, GEOIP_DB)):
+        database = make_database()
+
+    results = {}
+    for engine in ENGINES:
+        with dns_server_process(engine, database) as address:
+            for qtype in QUERY_TYPES:
+                results[f"{engine}/{qtype}"] = run(address, qtype, args.n, args.w, args.clients, args.timeout)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(
+        f"{args.n} queries per run, {args.clients} client(s) with {args.w} in flight each"
+        + (", synthetic GeoIP database" if database is not None else "")
+    )
+    for name, result in results.items():
+        print(
+            f"{name:>14}: {result['queries_per_second']:8.0f} queries/s, "
+            f"p50 {result['p50_ms']:6.2f}ms, p99 {result['p99_ms']:6.2f}ms, "
+            f"{result['lost']} lost, answer {', '.join(result['answer'])}"
+        )
+
+
+if __name__ == "__main__":
+    main()
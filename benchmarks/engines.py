@@ -0,0 +1,69 @@
+"""
+Load test comparing the two http server engines of the replica: the original
+ThreadingMixIn server and the asyncio one.
+
+Starts a stub origin and, for each engine, a replica on loopback. Each replica is
+warmed up by requesting every article of the trace once, then the same pageviews.csv
+weighted trace is replayed against it over a number of concurrent keep-alive
+connections. Reports requests/sec and p50/p99 latency.
+
+By default the trace only covers the 200 most viewed articles, which fit in the
+cache, so that the run measures the engines rather than origin fetches and
+compression. Pass --top 0 to use every article.
+
+Usage (from the repository root):
+    python -m benchmarks.engines [-n REQUESTS] [-c CONCURRENCY] [--top N] [--origin-latency-ms MS] [--json]
+"""
+import asyncio
+import json
+import random
+from argparse import ArgumentParser
+
+from benchmarks.loadgen import load_articles, replica_process, run_load, stub_origin_process, summarize
+
+ENGINES = ("threads", "asyncio")
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", type=int, default=5000, help="number of requests per engine")
+    parser.add_argument("-c", type=int, default=64, help="number of concurrent connections")
+    parser.add_argument("--top", type=int, default=200, help="only request the N most viewed articles, 0 for all")
+    parser.add_argument("--origin-latency-ms", type=float, default=20, help="latency of the stub origin")
+    parser.add_argument("--seed", type=int, default=5700, help="seed for the trace")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    articles = load_articles()
+    if args.top:
+        articles = articles[: args.top]
+    rng = random.Random(args.seed)
+    trace = rng.choices([path for path, _ in articles], weights=[views for _, views in articles], k=args.n)
+    warmup = [path for path, _ in articles]
+
+    results = {}
+    with stub_origin_process(latency_ms=args.origin_latency_ms) as origin_url:
+        for engine in ENGINES:
+            with replica_process(origin_url, ["--engine", engine]) as (url, _):
+                asyncio.run(run_load(url, warmup, args.c))
+                responses, elapsed = asyncio.run(run_load(url, trace, args.c))
+                results[engine] = summarize(responses, elapsed)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(
+        f"{args.n} requests for {len(articles)} articles over {args.c} connections, "
+        f"origin latency {args.origin_latency_ms}ms"
+    )
+    for engine, summary in results.items():
+        print(
+            f"{engine:>8}: {summary['requests_per_second']:8.1f} req/s, "
+            f"p50 {summary['p50_ms']:7.2f}ms, p99 {summary['p99_ms']:7.2f}ms, "
+            f"{summary['errors']} errors"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Micro-benchmark for the cache eviction policy.
+
+Replays traffic drawn from the pageviews.csv distribution (an article is requested
+with probability proportional to its views) against two simulated caches:
+
+ - legacy:  the old list + heapq.heapify policy, which compares the new article
+            against the single least viewed article only.
+ - indexed: the IndexedMinHeap policy used by RepliCache, with in-place priority
+            updates on hits and multi-victim eviction (as long as the victims together
+            have fewer views than the new article).
+
+Article sizes come from the compressed articles in cache/. Articles that aren't in
+cache/ get a size drawn from the same distribution. Both caches are a single tier
+with the given byte budget; the tiering in RepliCache doesn't change which articles
+get picked as victims.
+
+Usage (from the repository root):
+    python -m benchmarks.eviction [-n REQUESTS] [--budget-mb MB] [--seed SEED]
+"""
+import csv
+import heapq
+import os
+import random
+import time
+from argparse import ArgumentParser
+from urllib.parse import quote
+
+from indexed_heap import IndexedMinHeap
+
+
+class Entry:
+    def __init__(self, name: str, views: int, size: int):
+        self.name = name
+        self.views = views
+        self.size = size
+        self.cached = False
+
+    def __lt__(self, other: "Entry") -> bool:
+        return self.views < other.views
+
+
+class LegacyPolicy:
+    """
+    The old policy: heapify the whole list on every miss and only ever
+    look at the single least viewed article.
+    """
+
+    name = "legacy"
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.used = 0
+        self.heap = []
+
+    def hit(self, entry: Entry):
+        pass  # views are mutated in place, the heap isn't told
+
+    def miss(self, entry: Entry):
+        if self.used + entry.size <= self.budget:
+            self.admit(entry)
+            return
+
+        heapq.heapify(self.heap)
+        victim = heapq.heappop(self.heap)
+        if victim.views < entry.views and self.used - victim.size + entry.size <= self.budget:
+            victim.cached = False
+            self.used -= victim.size
+            self.admit(entry)
+        else:
+            self.heap.append(victim)
+
+    def admit(self, entry: Entry):
+        entry.cached = True
+        self.used += entry.size
+        self.heap.append(entry)
+
+
+class IndexedPolicy:
+    """
+    The new policy: an indexed min-heap updated on every hit, and as many victims
+    as needed to make room, as long as together they are less viewed than the new article.
+    """
+
+    name = "indexed"
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.used = 0
+        self.heap = IndexedMinHeap(priority=lambda e: e.views, key=lambda e: e.name)
+
+    def hit(self, entry: Entry):
+        self.heap.update(entry)
+
+    def miss(self, entry: Entry):
+        if self.used + entry.size <= self.budget:
+            self.admit(entry)
+            return
+
+        victims, freed, victim_views = [], 0, 0
+        while self.heap and victim_views + self.heap.peek().views < entry.views:
+            victim = self.heap.pop()
+            victims.append(victim)
+            freed += victim.size
+            victim_views += victim.views
+            if self.used - freed + entry.size <= self.budget:
+                for evicted in victims:
+                    evicted.cached = False
+                self.used -= freed
+                self.admit(entry)
+                return
+
+        for victim in victims:
+            self.heap.push(victim)
+
+    def admit(self, entry: Entry):
+        entry.cached = True
+        self.used += entry.size
+        self.heap.push(entry)
+
+
+def load_articles(rng: random.Random) -> list:
+    """
+    :return: a list of (article, views, size) tuples in pageviews.csv order
+    """
+    rows = []
+    with open("pageviews.csv") as article_file:
+        for row in csv.DictReader(article_file):
+            article = quote(row["article"].replace(" ", "_"))
+            path = f"cache/{article}"
+            size = os.path.getsize(path) if os.path.exists(path) else None
+            rows.append((article, int(row["views"]), size))
+
+    known_sizes = [size for _, _, size in rows if size is not None]
+    return [
+        (article, views, size if size is not None else rng.choice(known_sizes))
+        for article, views, size in rows
+    ]
+
+
+def replay(policy_class, articles: list, trace: list, budget: int) -> dict:
+    entries = {article: Entry(article, views, size) for article, views, size in articles}
+    policy = policy_class(budget)
+
+    hits = 0
+    start = time.process_time()
+    for article in trace:
+        entry = entries[article]
+        entry.views += 1
+        if entry.cached:
+            hits += 1
+            policy.hit(entry)
+        else:
+            policy.miss(entry)
+    cpu_time = time.process_time() - start
+
+    return {
+        "policy": policy.name,
+        "hit_ratio": hits / len(trace),
+        "cpu_us_per_request": cpu_time / len(trace) * 1e6,
+        "cached_articles": sum(entry.cached for entry in entries.values()),
+        "bytes_used": policy.used,
+    }
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", type=int, default=200_000, help="number of requests to replay")
+    parser.add_argument("--budget-mb", type=float, default=19, help="cache size in MB")
+    parser.add_argument("--seed", type=int, default=5700, help="seed for the traffic and sizes")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    articles = load_articles(rng)
+    trace = rng.choices(
+        [article for article, _, _ in articles],
+        weights=[views for _, views, _ in articles],
+        k=args.n,
+    )
+    budget = int(args.budget_mb * 1024 * 1024)
+
+    print(f"{args.n} requests over {len(articles)} articles, {args.budget_mb}MB budget")
+    for policy_class in (LegacyPolicy, IndexedPolicy):
+        result = replay(policy_class, articles, trace, budget)
+        print(
+            f"{result['policy']:>8}: hit ratio {result['hit_ratio']:.4f}, "
+            f"{result['cpu_us_per_request']:.2f}us CPU/request, "
+            f"{result['cached_articles']} articles in {result['bytes_used'] / 1024 / 1024:.2f}MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
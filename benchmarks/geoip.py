@@ -0,0 +1,115 @@
+"""
+Micro-benchmark for GeoIP lookups with the vendored MaxMind DB reader.
+
+Looks up a sample of IPv4 addresses and reports lookups/sec for every combination of:
+
+ - mode:       MODE_MMAP (read through a memory map) or MODE_MEMORY (the whole file in a bytes object)
+ - cache:      with or without the decoded record cache (keyed by offset in the data section)
+ - projection: decoding the whole record, or only location.latitude and location.longitude
+               like geo.py does, skipping the rest of the record without decoding it
+
+The sample is drawn from a fixed set of /24 networks with a Zipf-like skew, since DNS
+queries come from a limited set of resolvers and clients, some of them much busier than others.
+
+GeoLite2-City.mmdb can't be redistributed, so if it's not there, the benchmark runs
+against a synthetic database of the same shape (see benchmarks.synthetic_mmdb).
+
+Usage (from the repository root):
+    python -m benchmarks.geoip [--db PATH] [-n LOOKUPS] [--networks N] [--cache-size N] [--seed SEED] [--json]
+"""
+import ipaddress
+import json
+import os
+import random
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from benchmarks.synthetic_mmdb import make_database
+from vendor import maxminddb
+
+MODES = {"mmap": maxminddb.MODE_MMAP, "memory": maxminddb.MODE_MEMORY}
+LOCATION = maxminddb.Projection([("location", "latitude"), ("location", "longitude")])
+
+
+def sample_addresses(count: int, networks: int, rng: random.Random) -> list:
+    """
+    :return: count IPv4 addresses from networks random /24s, the first ones being the most popular
+    """
+    prefixes = []
+    while len(prefixes) < networks:
+        address = ipaddress.IPv4Address(rng.getrandbits(32))
+        if address.is_global:
+            prefixes.append(int(address) & ~0xFF)
+    weights = [1 / (rank + 1) for rank in range(networks)]
+    return [
+        str(ipaddress.IPv4Address(prefix | rng.getrandbits(8)))
+        for prefix in rng.choices(prefixes, weights=weights, k=count)
+    ]
+
+
+def run(path: str, mode: int, cache_size: int, projection, addresses: list) -> dict:
+    reader = maxminddb.open_database(path, mode, cache_size=cache_size)
+    try:
+        start = time.perf_counter()
+        found = 0
+        for address in addresses:
+            if reader.get(address, projection) is not None:
+                found += 1
+        elapsed = time.perf_counter() - start
+        return {
+            "lookups_per_second": len(addresses) / elapsed,
+            "found": found,
+            "cache": reader.cache_stats(),
+        }
+    finally:
+        reader.close()
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--db", default="GeoLite2-City.mmdb", help="the MaxMind DB to look the addresses up in")
+    parser.add_argument("-n", type=int, default=20000, help="number of lookups per combination")
+    parser.add_argument("--networks", type=int, default=5000, help="number of distinct /24s in the sample")
+    parser.add_argument("--cache-size", type=int, default=4096, help="max number of decoded records to cache")
+    parser.add_argument("--seed", type=int, default=5700, help="seed for the sample")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    path = args.db
+    synthetic = not os.path.exists(path)
+    if synthetic:
+        fd, path = tempfile.mkstemp(suffix=".mmdb")
+        with os.fdopen(fd, "wb") as db_file:
+            db_file.write(make_database(seed=args.seed))
+
+    try:
+        addresses = sample_addresses(args.n, args.networks, random.Random(args.seed))
+        results = {}
+        for mode_name, mode in MODES.items():
+            for cache_size in (0, args.cache_size):
+                for projection_name, projection in (("full", None), ("location", LOCATION)):
+                    name = f"{mode_name}/{'cache' if cache_size else 'no-cache'}/{projection_name}"
+                    results[name] = run(path, mode, cache_size, projection, addresses)
+    finally:
+        if synthetic:
+            os.remove(path)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    database = "a synthetic database" if synthetic else args.db
+    print(f"{args.n} lookups from {args.networks} /24s against {database}")
+    baseline = results["mmap/no-cache/full"]["lookups_per_second"]
+    for name, result in results.items():
+        cache = result["cache"]
+        hit_ratio = cache["hits"] / (cache["hits"] + cache["misses"]) if cache["hits"] + cache["misses"] else 0.0
+        print(
+            f"  {name:26} {result['lookups_per_second']:>10.0f} lookups/s "
+            f"({result['lookups_per_second'] / baseline:.1f}x)  cache hit ratio {hit_ratio:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
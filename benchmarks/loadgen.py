@@ -0,0 +1,219 @@
+"""
+Shared helpers for the end-to-end benchmarks: launching a stub origin and a replica
+as separate processes on loopback, and an asyncio HTTP/1.1 load generator.
+"""
+import asyncio
+import contextlib
+import csv
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from urllib.parse import quote
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url: str, timeout: float = 30.0):
+    """
+    Polls url until it answers, or raises TimeoutError.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{url} didn't come up in {timeout}s")
+            time.sleep(0.1)
+
+
+@contextlib.contextmanager
+def stub_origin_process(latency_ms: float = 0, bandwidth_kbps: float = 0, serve_gzip: bool = False):
+    """
+    Runs benchmarks.stub_origin in its own process.
+
+    :return: the URL of the stub origin
+    """
+    port = free_port()
+    command = [sys.executable, "-m", "benchmarks.stub_origin", "-p", str(port)]
+    command += ["--latency-ms", str(latency_ms), "--bandwidth-kbps", str(bandwidth_kbps)]
+    if serve_gzip:
+        command.append("--gzip")
+    process = subprocess.Popen(command, cwd=REPO_ROOT, stdout=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        wait_for(f"{url}/Main_Page")
+        yield url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+@contextlib.contextmanager
+def replica_process(origin_url: str, extra_args: list = (), warm_cache: bool = False, port: int = None):
+    """
+    Runs httpserver in its own process, in a scratch directory so that the
+    cache it builds (and deletes from) isn't the one in the repository.
+
+    :param origin_url: where the replica fetches articles from
+    :param extra_args: extra command line arguments for httpserver
+    :param warm_cache: whether to start with a copy of the articles in cache/
+    :param port: the port to serve on, None for any free one
+    :return: (the URL of the replica, its process)
+    """
+    workdir = tempfile.mkdtemp(prefix="replica-")
+    shutil.copy(os.path.join(REPO_ROOT, "pageviews.csv"), workdir)
+    if warm_cache:
+        shutil.copytree(os.path.join(REPO_ROOT, "cache"), os.path.join(workdir, "cache"))
+
+    port = port or free_port()
+    command = [sys.executable, os.path.join(REPO_ROOT, "httpserver"), "-p", str(port)]
+    command += ["--host", "127.0.0.1", "--origin-url", origin_url, *extra_args]
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    with open(os.path.join(workdir, "logs.txt"), "w") as logs:
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=logs, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        wait_for(f"{url}/grading/beacon", timeout=60)
+        yield url, process
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def load_articles() -> list:
+    """
+    :return: (request path, views) for every article in pageviews.csv
+    """
+    with open(os.path.join(REPO_ROOT, "pageviews.csv")) as article_file:
+        return [
+            ("/" + quote(row["article"].replace(" ", "_")), int(row["views"]))
+            for row in csv.DictReader(article_file)
+        ]
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Result:
+    """
+    The outcome of one request.
+    """
+
+    __slots__ = ("path", "status", "latency", "size", "headers")
+
+    def __init__(self, path: str, status: int, latency: float, size: int, headers: dict):
+        self.path = path
+        self.status = status
+        self.latency = latency
+        self.size = size
+        self.headers = headers
+
+
+async def read_response(reader: asyncio.StreamReader) -> (int, dict, int):
+    """
+    Reads one response, supporting both Content-Length and chunked bodies.
+
+    :return: the status, headers (lowercase names) and body size
+    """
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    version, status, _ = lines[0].split(" ", 2)
+    status = int(status)
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    if version == "HTTP/1.0" and headers.get("connection", "").lower() != "keep-alive":
+        headers["connection"] = "close"
+
+    size = 0
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            chunk_size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            await reader.readexactly(chunk_size + 2)
+            size += chunk_size
+            if chunk_size == 0:
+                break
+    elif "content-length" in headers:
+        size = int(headers["content-length"])
+        await reader.readexactly(size)
+    elif status not in (204, 304):
+        size = len(await reader.read())
+    return status, headers, size
+
+
+async def connection_worker(host: str, port: int, paths, results: list, request_headers: dict):
+    """
+    Sends requests one after the other over a keep-alive connection, reconnecting
+    whenever the server closes it.
+    """
+    reader = writer = None
+    extra = "".join(f"{name}: {value}\r\n" for name, value in request_headers.items())
+    for path in paths:
+        if writer is None:
+            reader, writer = await asyncio.open_connection(host, port, limit=1 << 20)
+        request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\nAccept-Encoding: gzip\r\n{extra}\r\n"
+        start = time.perf_counter()
+        try:
+            writer.write(request.encode())
+            status, headers, size = await read_response(reader)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            results.append(Result(path, -1, time.perf_counter() - start, 0, {"error": repr(e)}))
+            writer.close()
+            writer = None
+            continue
+        results.append(Result(path, status, time.perf_counter() - start, size, headers))
+        if headers.get("connection", "").lower() == "close":
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def run_load(url: str, trace: list, concurrency: int, request_headers: dict = None) -> (list, float):
+    """
+    Replays a trace of request paths against url over concurrency connections.
+
+    :return: the results and the wall clock time it took
+    """
+    host, port = url.split("//")[1].split(":")
+    results = []
+    shards = [trace[i::concurrency] for i in range(concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(connection_worker(host, int(port), shard, results, request_headers or {}) for shard in shards)
+    )
+    return results, time.perf_counter() - start
+
+
+def summarize(results: list, elapsed: float) -> dict:
+    latencies = sorted(result.latency for result in results)
+    errors = sum(1 for result in results if result.status != 200)
+    return {
+        "requests": len(results),
+        "errors": errors,
+        "requests_per_second": len(results) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "bytes": sum(result.size for result in results),
+    }
@@ -0,0 +1,181 @@
+"""
+Benchmark for the active measurement pipeline between the DNS server and the
+replicas, with a stub in place of scamper so that it can run with thousands of
+synthetic clients.
+
+Runs a number of measurement rounds, with new clients showing up before each one,
+and compares:
+
+ - full:   every round, the DNS server sends every client it knows of to every
+           replica, and the replicas ping all of them (as it used to be)
+ - delta:  the DNS server only sends the clients that are new or whose RTT is stale,
+           and the replicas only ping the ones that aren't in their RTT table or are stale
+ - subnet: same as delta, but clients are grouped in /24s and only one address
+           per /24 is pinged
+
+The clients are hosts in a set of /24s, which grows along with them.
+
+The stub takes per_client_ms per client it pings, and the replicas get slower and
+slower (the last one is --replicas times slower than the first), so that the
+rounds show the benefit of merging the results of each replica as they come in.
+Reports the pings, the bytes sent and received, the size of the DNS server's
+table, and how long it took until the first and the last replica's RTTs were
+merged, per round.
+
+Usage (from the repository root):
+    python -m benchmarks.measurement_pipeline [--clients N] [--new-clients N] [--hosts-per-network N] [--rounds N] [--json]
+"""
+import json
+import random
+import threading
+import time
+import zlib
+from argparse import ArgumentParser
+
+from measurements import MeasurementCollector, RttTable, UNREACHABLE
+from subnets import SubnetTable
+
+MODES = ("full", "delta", "subnet")
+
+
+class StubScamper:
+    """
+    Stands in for scamper_ping(): takes per_client_ms for each client and makes up
+    an RTT that only depends on the replica and the client.
+    """
+
+    def __init__(self, replica: str, per_client_ms: float, unreachable_ratio: float = 0.05):
+        self.replica = replica
+        self.per_client_ms = per_client_ms
+        self.unreachable_ratio = unreachable_ratio
+
+    def __call__(self, client_ips: list) -> dict:
+        time.sleep(len(client_ips) * self.per_client_ms / 1000)
+        rtts = {}
+        for client in client_ips:
+            seed = zlib.crc32(f"{self.replica} {client}".encode())
+            if seed % 1000 < self.unreachable_ratio * 1000:
+                rtts[client] = UNREACHABLE
+            else:
+                rtts[client] = 5 + seed % 200
+        return rtts
+
+
+def synthetic_clients(count: int, hosts_per_network: int, networks: list, rng: random.Random) -> list:
+    """
+    :param networks: the /24s the clients are in so far, as their first three octets, grows as needed
+    :return: count clients, on average hosts_per_network per /24
+    """
+    clients = []
+    for _ in range(count):
+        if rng.random() < 1 / hosts_per_network:
+            networks.append(f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}")
+        clients.append(f"{rng.choice(networks)}.{rng.randint(1, 254)}")
+    return clients
+
+
+def run(mode: str, args, rng: random.Random) -> dict:
+    max_age = 0.0 if mode == "full" else args.max_age
+    subnets = SubnetTable(ipv4_prefix_len=24 if mode == "subnet" else 32)
+    replicas = [f"10.0.0.{index + 1}" for index in range(args.replicas)]
+    tables = {
+        replica: RttTable(StubScamper(replica, args.per_client_ms * (index + 1)), max_age=max_age)
+        for index, replica in enumerate(replicas)
+    }
+    traffic = {"sent_bytes": 0, "received_bytes": 0}
+    traffic_lock = threading.Lock()
+
+    def request(replica: str, clients: list) -> dict:
+        # Same encoding as the POST to /measure and its response
+        body = json.dumps(clients).encode()
+        response = json.dumps({"rtts": tables[replica].measure(json.loads(body)), "cpu": 0.0}).encode()
+        with traffic_lock:
+            traffic["sent_bytes"] += len(body)
+            traffic["received_bytes"] += len(response)
+        return json.loads(response)["rtts"]
+
+    networks = [f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}"]
+    clients = set()
+
+    def add_clients(count: int):
+        for client in synthetic_clients(count, args.hosts_per_network, networks, rng):
+            clients.add(client)
+            subnets.touch(client)
+
+    add_clients(args.clients)
+    collector = MeasurementCollector(replicas, subnets, request, max_age=max_age)
+
+    rounds = []
+    for number in range(args.rounds):
+        if number:
+            add_clients(args.new_clients)
+        finished = []
+        start = time.perf_counter()
+
+        def measure(replica: str):
+            collector.measure(replica)
+            finished.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=measure, args=(replica,)) for replica in replicas]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        rounds.append(
+            {
+                "clients": len(clients),
+                "networks": len(subnets),
+                "first_merge_s": min(finished),
+                "last_merge_s": max(finished),
+            }
+        )
+
+    return {
+        "pinged": sum(table.pinged for table in tables.values()),
+        "requested": collector.sent,
+        **traffic,
+        "table_entries": len(subnets),
+        "measured": subnets.stats()["measured"],
+        "rounds": rounds,
+    }
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--clients", type=int, default=5000, help="number of clients before the first round")
+    parser.add_argument("--new-clients", type=int, default=200, help="number of new clients before every other round")
+    parser.add_argument("--hosts-per-network", type=float, default=5, help="average number of clients per /24")
+    parser.add_argument("--rounds", type=int, default=5, help="number of measurement rounds")
+    parser.add_argument("--replicas", type=int, default=7, help="number of replicas")
+    parser.add_argument("--per-client-ms", type=float, default=0.05, help="how long the fastest replica takes per ping")
+    parser.add_argument("--max-age", type=float, default=120.0, help="seconds after which an RTT is stale (delta)")
+    parser.add_argument("--seed", type=int, default=5700, help="seed for the synthetic clients")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = {mode: run(mode, args, random.Random(args.seed)) for mode in MODES}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(
+        f"{args.rounds} rounds, {args.clients} clients + {args.new_clients} new per round, "
+        f"{args.replicas} replicas, {args.per_client_ms}ms per ping on the fastest one"
+    )
+    for mode, result in results.items():
+        print(
+            f"{mode:>6}: {result['pinged']} pings, {result['sent_bytes'] / 1024:.0f}KiB sent, "
+            f"{result['received_bytes'] / 1024:.0f}KiB received, "
+            f"{result['table_entries']} table entries, {result['measured']} of them measured"
+        )
+        for number, measured in enumerate(result["rounds"]):
+            print(
+                f"        round {number}: {measured['clients']} clients in {measured['networks']} entries, "
+                f"first replica merged after "
+                f"{measured['first_merge_s']:.3f}s, last after {measured['last_merge_s']:.3f}s"
+            )
+
+
+if __name__ == "__main__":
+    main()
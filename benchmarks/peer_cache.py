@@ -0,0 +1,119 @@
+"""
+Simulation of the cooperative peer cache (see peers.py): how much of the traffic
+that a fleet of replicas can't serve from its own caches still reaches the origin.
+
+Starts a stub origin and a fleet of replicas on loopback, twice: once with every
+replica on its own, and once with --peers, where a miss is first filled from the
+replica that owns the article. The same pageviews.csv weighted trace is replayed
+against the fleet each time, with every request going to a random replica, as if
+the DNS server spread the clients out. The caches start out empty and the warmer
+is off, so everything that gets cached is down to the trace.
+
+Reports the requests that reached the origin, the origin offload (the share of
+the isolated fleet's origin requests that peer fill saved), the misses filled by
+a peer, and the latency seen by the clients.
+
+Usage (from the repository root):
+    python -m benchmarks.peer_cache [-n REQUESTS] [-r REPLICAS] [-c CONCURRENCY] [--origin-latency-ms MS] [--json]
+"""
+import asyncio
+import contextlib
+import json
+import random
+import urllib.request
+from argparse import ArgumentParser
+
+from benchmarks.loadgen import free_port, load_articles, replica_process, run_load, summarize
+from benchmarks.stub_origin import StubOrigin
+
+MODES = ("isolated", "peers")
+
+
+def peer_stats(url: str) -> dict:
+    with urllib.request.urlopen(f"{url}/debug/peers", timeout=5) as response:
+        return json.loads(response.read())
+
+
+async def replay(urls: list, trace: list, concurrency: int) -> (list, float):
+    """
+    Replays a trace against a fleet, each request going to a random replica.
+
+    :return: the results of all the replicas and the wall clock time it took
+    """
+    rng = random.Random(len(trace))
+    shares = {url: [] for url in urls}
+    for path in trace:
+        shares[rng.choice(urls)].append(path)
+
+    loads = await asyncio.gather(
+        *(run_load(url, shares[url], max(1, concurrency // len(urls))) for url in urls)
+    )
+    return [result for results, _ in loads for result in results], max(elapsed for _, elapsed in loads)
+
+
+def run(mode: str, origin: StubOrigin, replicas: int, trace: list, concurrency: int) -> dict:
+    """
+    Runs a fleet and replays the trace against it.
+
+    :return: the summary of the responses, along with the origin requests and the peer hits
+    """
+    ports = [free_port() for _ in range(replicas)]
+    urls = [f"http://127.0.0.1:{port}" for port in ports]
+    extra_args = ["--no-warm"]
+    if mode == "peers":
+        extra_args += ["--peers", ",".join(urls)]
+
+    before = origin.stats()["requests"]
+    with contextlib.ExitStack() as stack:
+        for port in ports:
+            stack.enter_context(replica_process(origin.url, extra_args, port=port))
+        results, elapsed = asyncio.run(replay(urls, trace, concurrency))
+        peer_hits = sum(peer_stats(url).get("hits", 0) for url in urls)
+
+    summary = summarize(results, elapsed)
+    summary["origin_requests"] = origin.stats()["requests"] - before
+    summary["peer_hits"] = peer_hits
+    return summary
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", type=int, default=6000, help="number of requests per run")
+    parser.add_argument("-r", type=int, default=3, help="number of replicas in the fleet")
+    parser.add_argument("-c", type=int, default=24, help="number of concurrent connections across the fleet")
+    parser.add_argument("--origin-latency-ms", type=float, default=20, help="latency of the stub origin")
+    parser.add_argument("--seed", type=int, default=5700, help="seed for the trace")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    articles = load_articles()
+    rng = random.Random(args.seed)
+    trace = rng.choices([path for path, _ in articles], weights=[views for _, views in articles], k=args.n)
+
+    origin = StubOrigin(latency=args.origin_latency_ms / 1000).start()
+    try:
+        results = {mode: run(mode, origin, args.r, trace, args.c) for mode in MODES}
+    finally:
+        origin.stop()
+
+    isolated = results["isolated"]["origin_requests"]
+    offload = 1 - results["peers"]["origin_requests"] / isolated if isolated else 0.0
+    if args.json:
+        print(json.dumps({"results": results, "origin_offload": offload}, indent=2))
+        return
+
+    print(
+        f"{args.n} requests for {len(set(trace))} articles across {args.r} replicas, "
+        f"{args.c} connections, origin latency {args.origin_latency_ms}ms"
+    )
+    for mode, summary in results.items():
+        print(
+            f"{mode:>9}: {summary['origin_requests']:5d} origin requests, {summary['peer_hits']:5d} peer hits, "
+            f"{summary['requests_per_second']:7.1f} req/s, p50 {summary['p50_ms']:7.2f}ms, "
+            f"p99 {summary['p99_ms']:7.2f}ms, {summary['errors']} errors"
+        )
+    print(f"origin offload: {offload:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+"""
+End-to-end benchmark of a replica: replays a request trace against httpserver,
+with dnsserver and a stub origin, all on loopback, and reports how it went as
+JSON, so that runs before and after a change to RepliCache or the handlers can be
+compared.
+
+Starts a throttled stub origin (see benchmarks.stub_origin), a replica with an
+empty cache, and dnsserver. Every client connection first looks the CDN name up,
+then replays its share of the trace over keep-alive. The answers name the real
+replicas, so the lookups are only timed, and the requests go to the local replica
+regardless. The warmer is off unless --warm is given, so that what gets cached is
+down to the trace.
+
+The trace is drawn from pageviews.csv: by default the articles are requested in
+proportion to their views, and with --zipf S, following a Zipf distribution of
+exponent S over their rank by views. The same seed gives the same trace.
+--save-trace writes it out, one path per line, and --trace replays a saved (or
+recorded) one instead.
+
+Reports:
+
+ - throughput: the requests and bytes per second the clients got
+ - latency:    the clients' p50/p95/p99 over all the requests, and per cache tier
+               (memory, disk, miss) as the replica measured them (/debug/metrics)
+ - hit_ratio:  the share of the articles served that were in cache
+ - origin:     the requests and bytes that went to the origin
+ - rss:        the resident memory of the replica's processes at the end and at
+               their peak, summed, so pages the workers share count once per worker
+ - dns:        how long the lookups took
+
+With --compare, the run is also compared with an earlier report, and the exit
+status is 1 if throughput, latency, hit ratio, origin traffic or memory got worse
+by more than --tolerance.
+
+Usage (from the repository root):
+    python -m benchmarks.replay [-n REQUESTS] [-c CONCURRENCY] [--zipf S] [--engine ENGINE] [--workers N]
+        [--origin-latency-ms MS] [--origin-bandwidth-kbps KBPS] [--trace FILE] [--save-trace FILE]
+        [--output FILE] [--compare BASELINE] [--json]
+"""
+import asyncio
+import contextlib
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+from argparse import ArgumentParser
+
+from dnslib import DNSRecord
+
+from benchmarks.dnsflood import CDN_NAME, GEOIP_DB, dns_server_process, query
+from benchmarks.loadgen import REPO_ROOT, load_articles, percentile, replica_process, run_load
+from benchmarks.loadgen import stub_origin_process, summarize
+from benchmarks.synthetic_mmdb import make_database
+
+TIERS = ("memory", "disk", "miss")
+METRICS_TIMEOUT = 15.0  # seconds to wait for the workers to push the metrics of the last requests
+# (where in the report, whether higher is better) of what --compare looks at
+COMPARED = [
+    (("throughput", "requests_per_second"), True),
+    (("latency", "all", "p50_ms"), False),
+    (("latency", "all", "p95_ms"), False),
+    (("latency", "all", "p99_ms"), False),
+    *((("latency", tier, "p99_ms"), False) for tier in TIERS),
+    (("hit_ratio",), True),
+    (("origin", "bytes"), False),
+    (("rss", "peak_rss_mb"), False),
+]
+
+
+def make_trace(count: int, top: int, zipf: float, rng: random.Random) -> list:
+    """
+    :param count: the number of requests
+    :param top: only request the top most viewed articles, 0 for all of them
+    :param zipf: the exponent of the Zipf distribution over the articles' ranks, None to go by their views
+    :return: the request paths
+    """
+    articles = sorted(load_articles(), key=lambda article: article[1], reverse=True)
+    if top:
+        articles = articles[:top]
+    paths = [path for path, _ in articles]
+    if zipf is None:
+        weights = [views for _, views in articles]
+    else:
+        weights = [1 / rank**zipf for rank in range(1, len(articles) + 1)]
+    return rng.choices(paths, weights=weights, k=count)
+
+
+def read_trace(path: str) -> list:
+    """
+    :return: the request paths in a trace file, one per line, skipping blank lines and # comments
+    """
+    with open(path) as trace_file:
+        lines = (line.strip() for line in trace_file)
+        return ["/" + line.lstrip("/") for line in lines if line and not line.startswith("#")]
+
+
+def resolve(address: tuple, lookups: int) -> dict:
+    """
+    Looks the CDN name up, once per client connection.
+
+    :return: the latency of the lookups, how many failed and the answer
+    """
+    packet = DNSRecord.question(CDN_NAME).pack()
+    latencies, failures, answer = [], 0, []
+    for _ in range(lookups):
+        start = time.perf_counter()
+        try:
+            reply = query(address, packet)
+        except OSError:
+            failures += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+        answer = [str(rr.rdata) for rr in DNSRecord.parse(reply).rr]
+    latencies.sort()
+    return {
+        "lookups": lookups,
+        "failures": failures,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "answer": answer,
+    }
+
+
+def replica_metrics(url: str, served: int) -> dict:
+    """
+    :param served: the number of requests the clients got an answer to, which the
+    metrics have to account for. Workers only push theirs every few seconds.
+    :return: the replica's /debug/metrics
+    """
+    deadline = time.monotonic() + METRICS_TIMEOUT
+    while True:
+        with urllib.request.urlopen(f"{url}/debug/metrics", timeout=5) as response:
+            metrics = json.loads(response.read())
+        counted = sum(value for name, value in metrics["counters"].items() if name.startswith("requests."))
+        if counted >= served or time.monotonic() > deadline:
+            return metrics
+        time.sleep(0.5)
+
+
+def process_tree(pid: int) -> list:
+    """
+    :return: pid and the pids of all its descendants, e.g. the replica's workers
+    """
+    pids = [pid]
+    for parent in pids:  # grows as the children are found
+        with contextlib.suppress(OSError):
+            for task in os.listdir(f"/proc/{parent}/task"):
+                with open(f"/proc/{parent}/task/{task}/children") as children:
+                    pids.extend(int(child) for child in children.read().split())
+    return pids
+
+
+def memory_usage(pid: int) -> dict:
+    """
+    :return: the resident memory of a process and its descendants, now and at
+    their peak, or None if /proc isn't there to tell
+    """
+    rss = peak = 0
+    pids = process_tree(pid)
+    for process in pids:
+        with contextlib.suppress(OSError):
+            with open(f"/proc/{process}/status") as status:
+                for line in status:
+                    name, _, value = line.partition(":")
+                    if name == "VmRSS":
+                        rss += int(value.split()[0])
+                    elif name == "VmHWM":
+                        peak += int(value.split()[0])
+    if not rss:
+        return {"processes": len(pids), "rss_mb": None, "peak_rss_mb": None}
+    return {"processes": len(pids), "rss_mb": round(rss / 1024, 1), "peak_rss_mb": round(peak / 1024, 1)}
+
+
+def git_commit() -> str:
+    """
+    :return: the commit the tree is at, to tell reports apart, or None outside a git checkout
+    """
+    try:
+        command = ["git", "rev-parse", "--short", "HEAD"]
+        return subprocess.run(command, cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, trace: list) -> dict:
+    """
+    Starts the stub origin, dnsserver and the replica, and replays the trace.
+
+    :return: the report
+    """
+    replica_args = ["--engine", args.engine, *args.replica_arg]
+    if args.workers:
+        replica_args += ["--workers", str(args.workers)]
+    if not args.warm:
+        replica_args.append("--no-warm")
+
+    with contextlib.ExitStack() as stack:
+        origin_url = stack.enter_context(
+            stub_origin_process(args.origin_latency_ms, args.origin_bandwidth_kbps, args.origin_gzip)
+        )
+        dns = None
+        if not args.no_dns:
+            database = None if os.path.exists(os.path.join(REPO_ROOT, GEOIP_DB)) else make_database()
+            dns_address = stack.enter_context(dns_server_process(args.dns_engine, database))
+            dns = resolve(dns_address, args.c)
+        url, process = stack.enter_context(replica_process(origin_url, replica_args))
+
+        results, elapsed = asyncio.run(run_load(url, trace, args.c))
+        served = sum(1 for result in results if result.status > 0)
+        metrics = replica_metrics(url, served)
+        rss = memory_usage(process.pid)
+
+    summary = summarize(results, elapsed)
+    counters, histograms = metrics["counters"], metrics["latency"]
+    latency = {"all": {name: summary[name] for name in ("p50_ms", "p95_ms", "p99_ms")}}
+    for tier in TIERS:
+        histogram = histograms.get(f"latency.{tier}", {})
+        latency[tier] = {
+            "requests": counters.get(f"requests.{tier}", 0),
+            **{name: histogram.get(name, 0.0) for name in ("p50_ms", "p95_ms", "p99_ms")},
+        }
+    hits = counters.get("requests.memory", 0) + counters.get("requests.disk", 0)
+    fetched = hits + counters.get("requests.miss", 0)
+
+    return {
+        "config": {
+            "commit": git_commit(),
+            "requests": len(trace),
+            "concurrency": args.c,
+            "trace": args.trace or ("views" if args.zipf is None else f"zipf {args.zipf}"),
+            "seed": args.seed,
+            "engine": args.engine,
+            "workers": args.workers,
+            "replica_args": replica_args,
+            "origin_latency_ms": args.origin_latency_ms,
+            "origin_bandwidth_kbps": args.origin_bandwidth_kbps,
+        },
+        "throughput": {
+            "requests": summary["requests"],
+            "errors": summary["errors"],
+            "seconds": elapsed,
+            "requests_per_second": summary["requests_per_second"],
+            "megabytes_per_second": summary["bytes"] / elapsed / 1e6 if elapsed else 0.0,
+        },
+        "latency": latency,
+        "hit_ratio": hits / fetched if fetched else 0.0,
+        "origin": {
+            "requests": histograms.get("origin.fetch", {}).get("count", 0),
+            "bytes": counters.get("origin.bytes", 0),
+        },
+        "rss": rss,
+        "dns": dns,
+    }
+
+
+def lookup(report: dict, path: tuple):
+    for key in path:
+        if not isinstance(report, dict) or key not in report:
+            return None
+        report = report[key]
+    return report
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> (list, bool):
+    """
+    :return: a line per compared value, and whether any of them got worse by more than tolerance
+    """
+    lines, regressed = [], False
+    differences = [
+        name for name, value in report["config"].items() if name != "commit" and baseline["config"].get(name) != value
+    ]
+    if differences:
+        lines.append(f"Warning: the runs differ in {', '.join(differences)}")
+    for path, higher_is_better in COMPARED:
+        now, before = lookup(report, path), lookup(baseline, path)
+        if not isinstance(now, (int, float)) or not isinstance(before, (int, float)) or not before:
+            continue
+        if path[0] == "latency" and not now:
+            continue  # no requests for that tier this time
+        change = (now - before) / before
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > tolerance:
+            flag = "  REGRESSION"
+            regressed = True
+        lines.append(f"{'.'.join(path):>30}: {before:14.2f} -> {now:14.2f} ({change:+7.1%}){flag}")
+    return lines, regressed
+
+
+def print_report(report: dict) -> None:
+    config, throughput, latency = report["config"], report["throughput"], report["latency"]
+    workers = f", {config['workers']} workers" if config["workers"] else ""
+    print(
+        f"{config['requests']} requests ({config['trace']}) over {config['concurrency']} connections, "
+        f"{config['engine']} engine{workers}, origin latency {config['origin_latency_ms']}ms"
+    )
+    print(
+        f"{throughput['requests_per_second']:8.1f} req/s, {throughput['megabytes_per_second']:6.1f}MB/s, "
+        f"{throughput['errors']} errors, hit ratio {report['hit_ratio']:.1%}, "
+        f"{report['origin']['requests']} origin requests ({report['origin']['bytes'] / 1e6:.1f}MB)"
+    )
+    for tier, summary in latency.items():
+        requests = f"{summary['requests']:6d} requests, " if "requests" in summary else " " * 17
+        print(
+            f"{tier:>8}: {requests}p50 {summary['p50_ms']:8.2f}ms, "
+            f"p95 {summary['p95_ms']:8.2f}ms, p99 {summary['p99_ms']:8.2f}ms"
+        )
+    rss = report["rss"]
+    if rss["rss_mb"] is not None:
+        print(f"     rss: {rss['rss_mb']:.1f}MB, peak {rss['peak_rss_mb']:.1f}MB over {rss['processes']} process(es)")
+    if report["dns"]:
+        dns = report["dns"]
+        print(f"     dns: p50 {dns['p50_ms']:.2f}ms, p99 {dns['p99_ms']:.2f}ms, {dns['failures']} failed lookups")
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", type=int, default=5000, help="number of requests in the trace")
+    parser.add_argument("-c", type=int, default=32, help="number of concurrent connections")
+    parser.add_argument("--top", type=int, default=0, help="only request the N most viewed articles, 0 for all")
+    parser.add_argument("--zipf", type=float, help="Zipf exponent over the articles' ranks, instead of their views")
+    parser.add_argument("--seed", type=int, default=5700, help="seed for the trace")
+    parser.add_argument("--trace", help="replay the request paths in this file instead")
+    parser.add_argument("--save-trace", help="write the trace to this file, one path per line")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads", help="the replica's engine")
+    parser.add_argument("--workers", type=int, default=0, help="the replica's number of worker processes")
+    parser.add_argument("--warm", action="store_true", help="leave the replica's warmer on")
+    parser.add_argument(
+        "--replica-arg", action="append", default=[], help="extra argument for httpserver, e.g. --replica-arg=--no-stream"
+    )
+    parser.add_argument("--dns-engine", choices=["threads", "asyncio"], default="threads", help="dnsserver's engine")
+    parser.add_argument("--no-dns", action="store_true", help="don't run dnsserver")
+    parser.add_argument("--origin-latency-ms", type=float, default=50, help="latency of the stub origin")
+    parser.add_argument("--origin-bandwidth-kbps", type=float, default=0, help="per connection bandwidth of the stub origin, 0 for unlimited")
+    parser.add_argument("--origin-gzip", action="store_true", help="have the stub origin serve gzipped pages")
+    parser.add_argument("-o", "--output", help="write the report to this file as JSON")
+    parser.add_argument("--compare", help="compare the run with the report in this file")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="how much worse a value may get before --compare fails")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    if args.trace:
+        trace = read_trace(args.trace)
+    else:
+        trace = make_trace(args.n, args.top, args.zipf, random.Random(args.seed))
+    if args.save_trace:
+        with open(args.save_trace, "w") as trace_file:
+            trace_file.write("".join(f"{path}\n" for path in trace))
+
+    report = run(args, trace)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        lines, regressed = compare(report, baseline, args.tolerance)
+        out = sys.stderr if args.json else sys.stdout
+        print(f"Compared with {args.compare} (commit {baseline['config'].get('commit')}):", file=out)
+        for line in lines:
+            print(line, file=out)
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
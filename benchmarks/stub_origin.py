@@ -0,0 +1,173 @@
+"""
+A local stand-in for the origin server, for benchmarks.
+
+Serves a synthetic HTML page for any path. Page sizes are drawn from a log-normal
+distribution around the size of an average Wikipedia article, and the text is made
+of random words so that it compresses about as well as the real thing. The same path
+always gets the same page.
+
+Latency (per request) and bandwidth (per connection) can be throttled to mimic a
+distant origin.
+
+Usage (from the repository root):
+    python -m benchmarks.stub_origin [-p PORT] [--latency-ms MS] [--bandwidth-kbps KBPS] [--gzip]
+"""
+import gzip
+import math
+import random
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Roughly the median and spread of the uncompressed size of the articles in pageviews.csv
+MEDIAN_PAGE_SIZE = 350 * 1024
+PAGE_SIZE_SIGMA = 0.6
+MAX_PAGE_SIZE = 2 * 1024 * 1024
+
+VOCABULARY = [
+    "the", "of", "and", "in", "was", "film", "season", "world", "war", "king", "state",
+    "university", "released", "series", "album", "election", "party", "minister", "cup",
+    "league", "football", "born", "american", "british", "indian", "history", "government",
+    "references", "retrieved", "archived", "original", "<p>", "</p>", "<a href=\"/wiki/",
+    "\">", "</a>", "<li>", "</li>", "class=\"mw-", "citation", "2022", "October", "2021",
+]
+AVERAGE_WORD_LENGTH = sum(len(word) + 1 for word in VOCABULARY) // len(VOCABULARY)
+
+
+def page_size(path: str) -> int:
+    """
+    :return: the size of the page served for path, in bytes
+    """
+    rng = random.Random(path)
+    size = int(MEDIAN_PAGE_SIZE * math.exp(rng.gauss(0, PAGE_SIZE_SIGMA)))
+    return max(1024, min(size, MAX_PAGE_SIZE))
+
+
+def make_page(path: str) -> bytes:
+    """
+    :return: the synthetic page served for path
+    """
+    size = page_size(path)
+    rng = random.Random(path)
+    words = rng.choices(VOCABULARY, k=size // AVERAGE_WORD_LENGTH + 1)
+    return f"<html><head><title>{path}</title></head><body>{' '.join(words)}</body></html>".encode()[:size]
+
+
+class StubOrigin:
+    """
+    A throttled HTTP/1.1 origin serving synthetic pages on loopback.
+    """
+
+    def __init__(
+        self,
+        port: int = 0,
+        latency: float = 0.0,
+        bandwidth: int = 0,
+        serve_gzip: bool = False,
+        missing: set = None,
+    ):
+        """
+        :param port: the port to bind to, 0 for any free port
+        :param latency: seconds to wait before answering each request
+        :param bandwidth: max bytes per second per connection, 0 for unlimited
+        :param serve_gzip: whether to gzip responses for clients that accept it
+        :param missing: paths to answer with a 404
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.serve_gzip = serve_gzip
+        self.missing = missing or set()
+        self.pages = {}
+        self.pages_lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.stats_lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.make_handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_port
+        self.url = f"http://127.0.0.1:{self.port}"
+
+    def page(self, path: str, encoding: str) -> bytes:
+        with self.pages_lock:
+            if (path, encoding) not in self.pages:
+                page = make_page(path)
+                self.pages[(path, encoding)] = gzip.compress(page, 6) if encoding == "gzip" else page
+            return self.pages[(path, encoding)]
+
+    def make_handler(self):
+        origin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                if origin.latency:
+                    time.sleep(origin.latency)
+                if self.path in origin.missing:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                accepts_gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+                encoding = "gzip" if origin.serve_gzip and accepts_gzip else "identity"
+                body = origin.page(self.path, encoding)
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                if encoding == "gzip":
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.write_throttled(body)
+
+                with origin.stats_lock:
+                    origin.requests += 1
+                    origin.bytes_sent += len(body)
+
+            def write_throttled(self, body: bytes):
+                if not origin.bandwidth:
+                    self.wfile.write(body)
+                    return
+                chunk_size = max(1024, origin.bandwidth // 100)
+                for start in range(0, len(body), chunk_size):
+                    self.wfile.write(body[start : start + chunk_size])
+                    time.sleep(chunk_size / origin.bandwidth)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "StubOrigin":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            return {"requests": self.requests, "bytes_sent": self.bytes_sent}
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-p", type=int, default=0, help="the port to bind to")
+    parser.add_argument("--latency-ms", type=float, default=0, help="delay before every response")
+    parser.add_argument("--bandwidth-kbps", type=float, default=0, help="per connection bandwidth, 0 for unlimited")
+    parser.add_argument("--gzip", action="store_true", help="gzip responses for clients that accept it")
+    args = parser.parse_args()
+
+    origin = StubOrigin(args.p, args.latency_ms / 1000, int(args.bandwidth_kbps * 1000 / 8), args.gzip)
+    print(f"Stub origin at {origin.url}", flush=True)
+    try:
+        origin.server.serve_forever()
+    except KeyboardInterrupt:
+        origin.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+Writes a synthetic GeoIP2-City-like MaxMind DB, for benchmarking the GeoIP lookups
+where GeoLite2-City.mmdb isn't available (it can't be redistributed).
+
+The records are shaped like GeoLite2-City ones: city and subdivision names in
+several languages, a continent and a country shared between many records through
+pointers, postal code and location. Map keys are pointers to a table of strings,
+and many networks share the same city record, like in the real thing. Every IPv4
+address is in one of the networks.
+
+Usage (from the repository root):
+    python -m benchmarks.synthetic_mmdb [-o PATH] [--cities N] [--seed SEED]
+"""
+import random
+import struct
+from argparse import ArgumentParser
+
+METADATA_MARKER = b"\xAB\xCD\xEFMaxMind.com"
+DATA_SECTION_SEPARATOR = b"\x00" * 16
+RECORD_SIZE = 32
+
+LANGUAGES = ["de", "en", "es", "fr", "ja", "pt-BR", "ru", "zh-CN"]
+CONTINENTS = ["AF", "AN", "AS", "EU", "NA", "OC", "SA"]
+SPLIT_RATIO = 1 / 64  # share of the /16s that are split into /24s
+
+
+class DataWriter:
+    """
+    Encodes values in the MaxMind DB data section format.
+    """
+
+    def __init__(self, pointer_keys: bool = True):
+        """
+        :param pointer_keys: whether map keys are written once and pointed to
+        """
+        self.data = bytearray()
+        self.pointer_keys = pointer_keys
+        self.keys = {}  # map key -> offset of the string
+
+    @staticmethod
+    def control(type_num: int, size: int) -> bytes:
+        extended = type_num > 7
+        first = (0 if extended else type_num) << 5
+        if size < 29:
+            head, extra = bytes([first | size]), b""
+        elif size < 285:
+            head, extra = bytes([first | 29]), bytes([size - 29])
+        elif size < 65821:
+            head, extra = bytes([first | 30]), struct.pack("!H", size - 285)
+        else:
+            head, extra = bytes([first | 31]), struct.pack("!I", size - 65821)[1:]
+        return head + (bytes([type_num - 7]) if extended else b"") + extra
+
+    def encode(self, value) -> bytes:
+        if isinstance(value, Pointer):
+            return bytes([(1 << 5) | (3 << 3)]) + struct.pack("!I", value.offset)
+        if isinstance(value, str):
+            encoded = value.encode()
+            return self.control(2, len(encoded)) + encoded
+        if isinstance(value, float):
+            return self.control(3, 8) + struct.pack("!d", value)
+        if isinstance(value, bool):
+            return self.control(14, int(value))
+        if isinstance(value, int):
+            encoded = value.to_bytes(max(1, (value.bit_length() + 7) // 8), "big")
+            return self.control(6 if len(encoded) <= 4 else 9, len(encoded)) + encoded
+        if isinstance(value, dict):
+            body = b"".join(self.encode(self.key(key)) + self.encode(item) for key, item in value.items())
+            return self.control(7, len(value)) + body
+        if isinstance(value, list):
+            return self.control(11, len(value)) + b"".join(self.encode(item) for item in value)
+        raise TypeError(f"can't encode {value!r}")
+
+    def key(self, key: str):
+        if not self.pointer_keys:
+            return key
+        if key not in self.keys:
+            self.keys[key] = self.write(key).offset
+        return Pointer(self.keys[key])
+
+    def write(self, value) -> "Pointer":
+        """
+        Appends a value to the data section.
+
+        :return: a pointer to it
+        """
+        encoded = self.encode(value)  # might write keys first
+        offset = len(self.data)
+        self.data += encoded
+        return Pointer(offset)
+
+
+class Pointer:
+    __slots__ = ("offset",)
+
+    def __init__(self, offset: int):
+        self.offset = offset
+
+
+def names(rng: random.Random) -> dict:
+    base = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(5, 12))).title()
+    return {language: f"{base} ({language})" for language in LANGUAGES}
+
+
+def make_search_tree(networks: dict) -> (bytes, int):
+    """
+    Builds the binary search tree for IPv4 networks.
+
+    :param networks: (network bits, prefix length) -> offset of the record in the data section
+    :return: the tree and the number of nodes in it
+    """
+    # Children of every node, the root is node 0
+    children = [[None, None]]
+    leaves = {}  # (node, bit) -> data offset
+    for (bits, prefix_len), data_offset in networks.items():
+        node = 0
+        for depth in range(prefix_len):
+            bit = (bits >> (prefix_len - depth - 1)) & 1
+            if depth == prefix_len - 1:
+                leaves[(node, bit)] = data_offset
+            else:
+                if children[node][bit] is None:
+                    children.append([None, None])
+                    children[node][bit] = len(children) - 1
+                node = children[node][bit]
+
+    node_count = len(children)
+    tree = bytearray()
+    for node, (left, right) in enumerate(children):
+        for bit, child in enumerate((left, right)):
+            if (node, bit) in leaves:
+                record = node_count + len(DATA_SECTION_SEPARATOR) + leaves[(node, bit)]
+            elif child is not None:
+                record = child
+            else:
+                record = node_count  # empty
+            tree += struct.pack("!I", record)
+    return bytes(tree), node_count
+
+
+def make_database(city_count: int = 20000, seed: int = 0) -> bytes:
+    """
+    :param city_count: the number of distinct city records, shared by all the networks
+    :return: the contents of the database file
+    """
+    rng = random.Random(seed)
+    writer = DataWriter()
+
+    continents = [writer.write({"code": code, "geoname_id": rng.getrandbits(24), "names": names(rng)}) for code in CONTINENTS]
+    countries = [
+        writer.write(
+            {
+                "geoname_id": rng.getrandbits(24),
+                "iso_code": "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(2)),
+                "names": names(rng),
+            }
+        )
+        for _ in range(200)
+    ]
+
+    cities = []
+    for _ in range(city_count):
+        record = {
+            "city": {"geoname_id": rng.getrandbits(24), "names": names(rng)},
+            "continent": rng.choice(continents),
+            "country": rng.choice(countries),
+            "location": {
+                "accuracy_radius": rng.randint(1, 1000),
+                "latitude": rng.uniform(-60, 70),
+                "longitude": rng.uniform(-180, 180),
+                "time_zone": rng.choice(["Europe/Rome", "America/New_York", "Asia/Kolkata", "Australia/Sydney"]),
+            },
+            "postal": {"code": str(rng.randint(10000, 99999))},
+            "registered_country": rng.choice(countries),
+            "subdivisions": [{"geoname_id": rng.getrandbits(24), "iso_code": "XX", "names": names(rng)}],
+        }
+        cities.append(writer.write(record).offset)
+
+    # Every address is in a network: most /16s are one network, a few are split into /24s
+    networks = {}
+    for block in range(1 << 16):
+        if rng.random() < SPLIT_RATIO:
+            for low in range(256):
+                networks[((block << 8) | low, 24)] = rng.choice(cities)
+        else:
+            networks[(block, 16)] = rng.choice(cities)
+
+    tree, node_count = make_search_tree(networks)
+    metadata = DataWriter(pointer_keys=False)
+    metadata_bytes = metadata.encode(
+        {
+            "binary_format_major_version": 2,
+            "binary_format_minor_version": 0,
+            "build_epoch": 1666000000,
+            "database_type": "Synthetic-City",
+            "description": {"en": "Synthetic GeoIP2-City-like database for benchmarks"},
+            "ip_version": 4,
+            "languages": LANGUAGES,
+            "node_count": node_count,
+            "record_size": RECORD_SIZE,
+        }
+    )
+    return tree + DATA_SECTION_SEPARATOR + bytes(writer.data) + METADATA_MARKER + metadata_bytes
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-o", default="Synthetic-City.mmdb", help="where to write the database")
+    parser.add_argument("--cities", type=int, default=20000, help="the number of distinct city records")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.o, "wb") as fd:
+        fd.write(make_database(args.cities, args.seed))
+    print(f"Wrote {args.o}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,41 @@
 import csv
-import heapq
+import gzip
+import http
+import json
 import os
-from dataclasses import dataclass
+import queue
+import threading
+import time
+import weakref
+from dataclasses import dataclass, field
+from email.utils import formatdate
+from typing import BinaryIO
 from urllib.parse import quote
-from urllib.request import urlopen
 
 import utils
+from admission import FrequencySketch, NegativeCache
+from arena import Arena, NO_SPACE
+from compression import CompressionStats, Compressor
+from freshness import DEFAULT_MAX_AGE, Freshness
+from indexed_heap import IndexedMinHeap
+from metrics import METRICS, report
+from origin import FETCH_ERRORS, OriginConnectionPool, OriginError, OriginResponse
+from peers import PeerGroup
+from ringlog import LOG, format_lines, log
+from segment_store import SegmentStore
+from singleflight import SingleFlight
+from streaming import STREAM_CHUNK_SIZE, ArticleStream
 
 DEFAULT_ORIGIN_URL = "http://cs5700cdnorigin.ccs.neu.edu:8080"
+LEGACY_CACHE_DIR = "cache"  # one file per article, as uploaded by deployCDN
+DISK_CACHE_DIR = "disk_cache"
+# Prefix of the disk store keys holding the freshness of the article of the same
+# name, so that it survives restarts. Article names are quoted, so they never start with #.
+FRESHNESS_PREFIX = "#freshness/"
+FRESHNESS_RESERVE = 256  # bytes of the disk quota set aside for the freshness record of an article
 
 ON_DISK = -1
 NOT_CACHED = -2
-APPEND = -3
 
 
 @dataclass(order=True)
@@ -21,7 +45,7 @@ class LookupInfo:
     an article in the cache. Buffer offset can either be:
      -2  ==> article not cached
      -1  ==> article cached on disk
-     >=0 ==> buffer offset within in-memory buffer
+     >=0 ==> byte offset of the article within the in-memory arena
     """
 
     views: int
@@ -31,79 +55,318 @@ class LookupInfo:
     # LookupInfo and need to determine what article it is.
     article_name: str
 
+    # Size of the compressed article in bytes, 0 if not cached
+    size: int = 0
+
+    # How fresh the article is and what to revalidate it with, None if it was never fetched
+    freshness: Freshness = field(default=None, compare=False)
+
     def increment_views(self):
         self.views += 1
 
 
+@dataclass
+class DiskSlice:
+    """
+    A simple data class that describes where an article lives on disk, so that
+    it can be sent straight from the file to the socket with sendfile() without
+    ever being copied into user space.
+    """
+
+    file: BinaryIO
+    offset: int
+    length: int
+
+    def __len__(self):
+        return self.length
+
+    def read(self) -> bytes:
+        """
+        Reads the article into memory, for writers that aren't sockets.
+        """
+        self.file.seek(self.offset)
+        return self.file.read(self.length)
+
+
+def tier_of(data) -> str:
+    """
+    :param data: an article as returned by get()
+    :return: where it came from: "memory", "disk", or "miss" for the origin (or a peer)
+    """
+    if isinstance(data, memoryview):
+        return "memory"
+    if isinstance(data, DiskSlice):
+        return "disk"
+    return "miss"
+
+
 class RepliCache:
     """
     A dynamic caching layer for the CDN. Uses disk as well as memory for caching articles.
 
     Tracks all the articles that are served via the CDN. If an article is not cached,
     fetches it from the origin and attempts to cache it. Also tracks the disk and memory
-    usage and conservatively stops at 19MB for both.
+    usage and conservatively stops at 19MB for both. On disk, that's everything the
+    disk store takes up, dead records included, so that the two stay under 20MB.
+
+    The cache is shared by all the threads of the HTTP server, so every mutation of the
+    bookkeeping (articles, heap, arena, memory_used and the disk store) happens while holding
+    self.lock. Concurrent misses for the same article are coalesced by self.in_flight so
+    that only one origin fetch and compression runs per article.
+
+    Misses are compressed at a fast level so that the client doesn't wait on it, and
+    recompressed at the max level by a background thread once they're cached.
+
+    If streaming is on, a miss doesn't wait for the whole article either: it's fetched
+    and compressed by a background thread into an ArticleStream, which the request
+    (and any other request for the article in the meantime) sends from as it fills
+    up. It's cached once it's complete.
+
+    By default only the articles in pageviews.csv are served. In admission mode, any
+    article the origin has is, and what gets cached is decided by how often articles
+    were requested lately according to a FrequencySketch: a new article only evicts
+    others if it was requested more often than them, so a scan or a long tail of
+    articles requested once can't churn the cache. Only the articles in pageviews.csv
+    and the cached ones are tracked in self.articles, and the paths the origin doesn't
+    have are remembered for a while in a NegativeCache.
+
+    Cached articles are fresh for max_age seconds (or whatever the origin says) after
+    they were fetched. After that they're stale, but they keep being served while a
+    background thread revalidates them with a conditional request to the origin,
+    which either says they didn't change or sends the new version to cache instead.
     """
 
-    def __init__(self, origin_url: str = DEFAULT_ORIGIN_URL, test_mode: bool = False):
+    def __init__(
+        self,
+        origin_url: str = DEFAULT_ORIGIN_URL,
+        test_mode: bool = False,
+        origin_pool: OriginConnectionPool = None,
+        disk_cache_dir: str = DISK_CACHE_DIR,
+        admission: bool = False,
+        streaming: bool = True,
+        max_age: float = DEFAULT_MAX_AGE,
+        background: bool = True,
+    ):
         self.articles = {}
-        self.heap = []
-        self.buffer = []
+        # The articles in pageviews.csv, which are tracked whether they're cached or not
+        self.listed = set()
+        # Cached articles keyed by name and ordered by views, so the
+        # least viewed one is always at the top.
+        self.heap = IndexedMinHeap(
+            priority=lambda lookup_info: lookup_info.views,
+            key=lambda lookup_info: lookup_info.article_name,
+        )
         self.origin_url = origin_url
-        self.disk_used = 0
+        # Every fetch from the origin goes through this pool of keep-alive connections
+        self.origin_pool = origin_pool or OriginConnectionPool(origin_url)
         self.max_disk_size = 19 * 1024 * 1024  # conservatively stopping at 19MB
+        # All on-disk articles live in a few append-only segment files
+        self.disk_store = SegmentStore(disk_cache_dir, background=False)
         self.memory_used = 0
         self.max_memory_size = 19 * 1024 * 1024  # conservatively stopping at 19MB
+        # All in-memory articles live in this one preallocated region
+        self.arena = Arena(self.max_memory_size)
         self.test_mode = test_mode
+        self.lock = threading.RLock()
+        self.in_flight = SingleFlight()
+        self.streaming = streaming
+        self.streams = {}  # article -> ArticleStream of the miss in flight
+        self.compressor = Compressor()
+        # Articles cached at the fast level, waiting to be recompressed at the max level
+        self.recompress_queue = queue.Queue()
+        self.warmer = None  # a CacheWarmer, if one was started
+        self.peers: PeerGroup = None  # the other replicas, if misses are filled from them
+        # Recent popularity of every requested article, in admission mode
+        self.sketch = FrequencySketch() if admission else None
+        self.negative_cache = NegativeCache()
+        self.rejected = 0  # articles the sketch kept out of the cache
+        # Seconds an article is fresh for, unless the origin says otherwise
+        self.max_age = max_age
+        # Stale articles waiting to be revalidated, and all the ones that are queued up or being revalidated
+        self.revalidate_queue = queue.Queue()
+        self.revalidating = set()
+        self.not_modified = 0  # revalidations the origin answered with a 304
+        self.modified = 0  # revalidations that got a new version
+        self.revalidation_failures = 0
         self.build()
+        # The locks might be held by one of the threads at a fork, and the child would never get them
+        this = weakref.ref(self)
+        os.register_at_fork(after_in_child=lambda: this() is not None and this().after_fork())
+        # Otherwise the owner of a worker pool starts them once the workers are forked
+        if background:
+            self.start()
+
+    def start(self):
+        """
+        Starts the threads that recompress and revalidate articles and look after the disk store.
+        """
 
-    def build(self):
+        threading.Thread(target=self.recompress_forever, daemon=True).start()
+        threading.Thread(target=self.revalidate_forever, daemon=True).start()
+        self.disk_store.start()
+
+    def after_fork(self):
+        """
+        Replaces the locks and queues inherited from the parent with new ones, in a forked
+        child. The parent's threads don't exist in the child, so neither do its misses in flight.
+        """
+
+        self.lock = threading.RLock()
+        self.in_flight = SingleFlight()
+        self.streams = {}
+        self.compressor.lock = threading.Lock()
+        self.negative_cache.lock = threading.Lock()
+        if self.sketch is not None:
+            self.sketch.lock = threading.Lock()
+        self.disk_store.lock = threading.RLock()
+        self.recompress_queue = queue.Queue()
+        self.revalidate_queue = queue.Queue()
+        self.revalidating = set()
+
+    def close(self):
+        """
+        Writes the in-memory articles to the disk store, most viewed first for as long
+        as they fit in the disk quota, and closes it. They don't have a copy on disk
+        while the cache runs, but this way they're cached again after a restart.
         """
-        We go through the CSV file as a starting point and then load
-        those articles from disk. We fit as many as we can into memory
-        and let the rest remain on disk. The ones that are moved to
-        memory get deleted from the disk.
+        with self.lock:
+            in_memory = [lookup_info for lookup_info in self.heap if lookup_info.buffer_offset >= 0]
+            in_memory.sort(key=lambda lookup_info: lookup_info.views, reverse=True)
+            saved = 0
+            for lookup_info in in_memory:
+                article = lookup_info.article_name
+                if article in self.disk_store:
+                    continue  # test mode keeps the copy it was loaded from
+                buffer_offset = lookup_info.buffer_offset
+                compressed_article = self.arena.view[buffer_offset : buffer_offset + lookup_info.size]
+                if self.add_to_disk_cache(article, compressed_article) == NOT_CACHED:
+                    continue
+                self.store_freshness(article, lookup_info.freshness)
+                saved += 1
+            self.disk_store.close()
+        log(f"Saved {saved} of {len(in_memory)} in-memory articles to the disk store")
 
-        This will lead to free space on disk that can be used for caching
-        articles that might get fetched from origin.
+    def build(self):
+        """
+        We go through the CSV file as a starting point for the views and then
+        load the articles in the disk store, most viewed first. We fit as many
+        as we can into memory and let the rest remain on disk.
+
+        The disk store survives restarts, so it's its index that says what's
+        cached. The ones that are moved to memory get deleted from it, which leaves
+        room on disk for articles that might get fetched from origin, and the store
+        is compacted at the end so that their dead records don't take up that room.
+        close() writes them back on the way out. The per-article files uploaded by
+        deployCDN are imported into the store the first time around.
         """
+        if not len(self.disk_store):
+            self.import_legacy_disk_cache()
+
         with open("pageviews.csv") as article_file:
             reader = csv.DictReader(article_file)
             for row in reader:
                 article = quote(row["article"].replace(" ", "_"))
                 views = int(row["views"])
-
-                if os.path.exists(f"cache/{article}"):
-                    compressed_article = self.get_from_disk_cache(article)
-
-                    lookup_info = self.add(article, compressed_article, views)
-                    if lookup_info.buffer_offset == NOT_CACHED:
-                        # Don't break, continue so that any potentially
-                        # smaller article down the line can be cached.
-                        continue
-
-                    # Remove from disk cache if loaded into memory
-                    if not self.test_mode and lookup_info.buffer_offset != ON_DISK:
-                        os.remove(f"cache/{article}")
-                else:
-                    lookup_info = LookupInfo(views, NOT_CACHED, article)
-                    self.articles[article] = lookup_info
-
-        print("Cache built")
-
-    def get(self, article: str) -> (bool, bytes):
+                self.articles[article] = LookupInfo(views, NOT_CACHED, article)
+                self.listed.add(article)
+
+        stored = [key for key in self.disk_store.keys() if not key.startswith(FRESHNESS_PREFIX)]
+        stored.sort(key=lambda article: self.articles[article].views if article in self.articles else 0, reverse=True)
+        disk_kept = 0  # the disk quota taken by the articles that stay on disk
+        for article in stored:
+            lookup_info = self.articles.get(article)
+            if lookup_info is None and self.sketch is not None:
+                # Not in pageviews.csv, but admitted before the restart
+                lookup_info = self.articles[article] = LookupInfo(0, NOT_CACHED, article)
+            if lookup_info is None:
+                # Not an article we serve
+                if not self.test_mode:
+                    self.delete_from_disk_store(article)
+                continue
+
+            size = self.disk_store.length(article)
+            # Its validators, so that revalidating it is a conditional request
+            freshness = self.stored_freshness(article)
+            footprint = self.disk_footprint(article, size)
+            if self.memory_used + size <= self.max_memory_size:
+                compressed_article = self.get_from_disk_cache(article)
+                lookup_info.buffer_offset = self.add_to_in_memory_cache(compressed_article)
+                compressed_article.release()
+
+            if lookup_info.buffer_offset >= 0:
+                # Remove from disk cache if loaded into memory
+                if not self.test_mode:
+                    self.delete_from_disk_store(article)
+            elif disk_kept + footprint <= self.max_disk_size:
+                disk_kept += footprint
+                lookup_info.buffer_offset = ON_DISK
+            else:
+                # Doesn't fit anywhere. Don't break, continue so that any
+                # potentially smaller article down the line can be cached.
+                if not self.test_mode:
+                    self.delete_from_disk_store(article)
+                self.forget(article)
+                continue
+
+            lookup_info.size = size
+            lookup_info.freshness = freshness
+            self.heap.push(lookup_info)
+
+        # The freshness of articles that aren't in the store anymore
+        for key in self.disk_store.keys():
+            if key.startswith(FRESHNESS_PREFIX) and key[len(FRESHNESS_PREFIX) :] not in self.disk_store:
+                if not self.test_mode:
+                    self.disk_store.delete(key)
+
+        # Reclaims the records of the articles moved to memory or deleted above
+        self.disk_store.reclaim()
+        self.disk_store.checkpoint()
+        log("Cache built")
+
+    def import_legacy_disk_cache(self):
+        """
+        Moves the per-article files in the legacy cache directory into the disk store.
+        """
+        if not os.path.isdir(LEGACY_CACHE_DIR):
+            return
+
+        articles = os.listdir(LEGACY_CACHE_DIR)
+        for article in articles:
+            path = os.path.join(LEGACY_CACHE_DIR, article)
+            with open(path, "rb") as fd:
+                self.disk_store.put(article, fd.read())
+            # The file was written when deployCDN fetched the article, which is as good a Last-Modified as any
+            fetched_at = os.path.getmtime(path)
+            freshness = Freshness(fetched_at, self.max_age, last_modified=formatdate(fetched_at, usegmt=True))
+            self.disk_store.put(FRESHNESS_PREFIX + article, freshness.encode())
+            if not self.test_mode:
+                os.remove(path)
+
+        log(f"Imported {len(articles)} articles into the disk store")
+
+    def get(self, article: str, from_peer: bool = False, wait: bool = True) -> (bool, bytes, Freshness):
         """
         Attempt to fetch an article from the cache.
 
         :param article: Request path for the article
+        :param from_peer: whether another replica is asking, in which case a miss goes straight to the origin
+        :param wait: whether a streamed miss waits for the first bytes (and a 404) before it's returned.
+        Callers that don't have to wait on it themselves, see ArticleStream.has_started()
         :return: The boolean in the tuple indicates if the article exists, and
         if it does, the second argument would be the actual bytes of the article.
+        In-memory hits are a memoryview of the arena and disk hits are a DiskSlice.
+        Either way, they have to be given back with release() once sent. The third
+        one is how fresh the article is, None if that isn't known.
+        :raises origin.FETCH_ERRORS: if it's a miss and the article couldn't be fetched, other than
+        because the origin doesn't have it. There's nothing to release then.
         """
-        try:
-            return self.get_helper(article)
-        except:  # Being super defensive about this
-            return True, utils.compress_article(self.fetch_from_origin(article))
+        return self.get_helper(article, from_peer, wait)
 
-    def get_helper(self, article: str) -> (bool, bytes):
+    @staticmethod
+    def normalize(article: str) -> str:
+        """
+        :return: the name the article is tracked under given its request path
+        """
         # Strip away leading slash from URLs
         if article[0] == "/":
             article = article[1:]
@@ -111,42 +374,395 @@ class RepliCache:
         if not utils.is_url_encoded(article):
             article = quote(article)
 
-        if article not in self.articles:
-            return False, None
+        return article
+
+    def get_helper(self, article: str, from_peer: bool = False, wait: bool = True) -> (bool, bytes, Freshness):
+        article = self.normalize(article)
+
+        with self.lock:
+            if not self.count_request(article):
+                return False, None, None
+
+            lookup_info: LookupInfo = self.articles.get(article)
+            if lookup_info is None:
+                # Not in pageviews.csv and not cached, but the origin might have it
+                buffer_offset = NOT_CACHED
+            else:
+                lookup_info.increment_views()
+                self.heap.update(lookup_info)  # no-op if the article isn't cached
+                buffer_offset = lookup_info.buffer_offset
+
+            if buffer_offset != NOT_CACHED:
+                # Stale hits are served all the same, and revalidated in the background
+                freshness = self.check_freshness(lookup_info)
+
+            if buffer_offset >= 0:
+                # (IN-MEMORY CACHE HIT) fetch from in-memory cache.
+                # Zero-copy slice of the arena, pinned until release() is called
+                return True, self.arena.lease(buffer_offset), freshness
+
+        if buffer_offset == ON_DISK:
+            # (DISK CACHE HIT) fetch from disk and see if it qualifies for promotion
+            try:
+                return True, self.open_from_disk_cache(article), freshness
+            except KeyError:
+                # Evicted by another thread between the lookup and the read
+                log(f"{article}: Evicted from disk cache while reading")
+
+        # (CACHE MISS) fetch from the owner peer or the origin and cache it. Concurrent
+        # requests for the same article wait for a single fetch instead of hitting the origin.
+        log(f"{article}: Not cached, fetching from origin")
+        try:
+            if self.streaming:
+                stream = self.attach_stream(article, from_peer, wait)
+                return True, stream, stream.freshness
+            compressed_article = self.in_flight.do(article, lambda: self.fill(article, from_peer))
+        except OriginError as e:
+            if e.status != http.HTTPStatus.NOT_FOUND:
+                raise
+            self.negative_cache.add(article)
+            log(f"{article}: Not found at the origin")
+            return False, None, None
+
+        with self.lock:
+            lookup_info = self.articles.get(article)
+        return True, compressed_article, lookup_info.freshness if lookup_info is not None else None
+
+    def attach_stream(self, article: str, from_peer: bool = False, wait: bool = True) -> ArticleStream:
+        """
+        Starts streaming an article that isn't cached, unless it's already being streamed.
+
+        :param wait: whether to wait for the first bytes
+        :return: the stream, once it has the first bytes if wait
+        :raises OriginError: if the origin doesn't have the article
+        """
+        with self.lock:
+            stream = self.streams.get(article)
+            if stream is None:
+                stream = ArticleStream(article)
+                self.streams[article] = stream
+                threading.Thread(target=self.produce, args=(stream, from_peer), daemon=True).start()
+
+        if wait:
+            stream.wait_started()
+        return stream
+
+    def produce(self, stream: ArticleStream, from_peer: bool = False):
+        """
+        Fetches an article into its stream and caches it once it's complete.
+        """
+        article = stream.article
+        try:
+            # The fetch is shared with the warmer's, if it happens to be on it already
+            compressed_article = self.in_flight.do(article, lambda: self.fill(article, from_peer, stream))
+            if not stream.started:
+                stream.write(compressed_article)
+            stream.finish()
+        except BaseException as e:
+            if isinstance(e, OriginError) and e.status == http.HTTPStatus.NOT_FOUND:
+                # Whether or not anyone waited for the first bytes to find out
+                self.negative_cache.add(article)
+            stream.fail(e)
+        finally:
+            with self.lock:
+                del self.streams[article]
+
+    def count_request(self, article: str) -> bool:
+        """
+        Records a request for an article in the frequency sketch, in admission mode.
+        Holding self.lock.
+
+        :return: whether the article might exist, i.e. it's either in pageviews.csv
+        or cached, or the cache is in admission mode and the origin didn't recently
+        answer it with a 404
+        """
+        if self.sketch is None:
+            return article in self.articles
+
+        self.sketch.increment(article)
+        return article in self.articles or article not in self.negative_cache
+
+    def frequency(self, lookup_info: LookupInfo) -> int:
+        """
+        :return: how popular an article is as far as eviction goes: its views, or in
+        admission mode how often it was requested lately
+        """
+        if self.sketch is None:
+            return lookup_info.views
+        return self.sketch.estimate(lookup_info.article_name)
+
+    def forget(self, article: str):
+        """
+        Stops tracking an article that isn't cached (anymore), unless it's in
+        pageviews.csv, so that what's tracked doesn't grow with every article ever
+        requested. Holding self.lock.
+        """
+        if article in self.listed:
+            return
+        lookup_info = self.articles.get(article)
+        if lookup_info is not None and lookup_info.buffer_offset == NOT_CACHED:
+            del self.articles[article]
+            self.compressor.pop(article)
+
+    def fill(self, article: str, from_peer: bool = False, stream: ArticleStream = None) -> bytes:
+        """
+        Fetches an article, compresses it and attempts to cache it.
+        Only ever runs once at a time per article (see self.in_flight).
 
-        lookup_info: LookupInfo = self.articles[article]
-        lookup_info.increment_views()
-        print(lookup_info)
+        :param article: Request path of article to fetch
+        :param from_peer: whether another replica is asking for it
+        :param stream: where to write the compressed article as it comes in, if anywhere
+        :return: the compressed article
+        """
+        compressed_article, freshness, admission = self.fetch_compressed(article, from_peer, stream)
+        self.cache_fetched(article, compressed_article, admission=admission, freshness=freshness)
+        return compressed_article
 
-        if lookup_info.buffer_offset == NOT_CACHED:
-            # (CACHE MISS) fetch from origin and cache to disk
-            print(f"{article}: Not cached, fetching from origin")
+    def fetch_compressed(
+        self, article: str, from_peer: bool = False, stream: ArticleStream = None
+    ) -> (bytes, Freshness, float):
+        """
+        Fetches an article gzipped, from the replica that owns it if there's a peer
+        group (unless another replica is asking, which means this one is the owner
+        as far as it's concerned), and from the origin otherwise or if that fails.
 
-            # Fetch article from origin and compress it
-            article_raw_bytes = self.fetch_from_origin(article)
-            compressed_article = utils.compress_article(article_raw_bytes)
+        :param stream: where to write the compressed article as it comes in, if anywhere
+        :return: the compressed article, how fresh it is, and how many times the views
+        of its victims it needs to get cached
+        """
+        if self.peers is None:
+            return (*self.fetch_compressed_from_origin(article, stream), 1.0)
+
+        # Articles owned by another replica are one peer fetch away, so they
+        # don't get to push out as much as the ones this replica is the owner of
+        admission = 1.0 if self.peers.is_owner(article) else self.peers.admission
+        if not from_peer:
+            response = self.peers.fetch(article)
+            if response is not None:
+                log(f"{article}: Fetched from peer {self.peers.owner(article)}")
+                # The peer's copy is as old as it says, not as old as this fetch
+                freshness = Freshness.from_headers(response.headers, self.max_age)
+                if stream is not None:
+                    stream.freshness = freshness
+                    stream.write(response.body)
+                return self.compressor.adopt(article, response.body), freshness, admission
+        return (*self.fetch_compressed_from_origin(article, stream), admission)
+
+    def cache_fetched(
+        self,
+        article: str,
+        compressed_article: bytes,
+        stats: CompressionStats = None,
+        admission: float = 1.0,
+        freshness: Freshness = None,
+    ):
+        """
+        Attempts to cache an article that was just fetched, evicting less popular
+        ones if need be. If it gets cached, it's queued up for recompression.
+
+        :param article: Request path of the article
+        :param compressed_article: the compressed article
+        :param stats: how the article was compressed, if it was done by another process
+        :param admission: how many times the views of the articles it evicts it needs
+        :param freshness: how fresh the article is
+        """
+        if stats is not None:
+            self.compressor.record(stats)
+
+        with self.lock:
+            lookup_info = self.articles.get(article)
+            if lookup_info is None:
+                # Not in pageviews.csv, so its views are only the ones the sketch has seen lately
+                lookup_info = LookupInfo(self.sketch.estimate(article), NOT_CACHED, article)
+                self.articles[article] = lookup_info
+
+            # Someone else might have cached it while we were busy with the origin
+            if lookup_info.buffer_offset != NOT_CACHED:
+                return
 
             # Optimistically cache it to disk if we have the space
             if (
                 self.add(
-                    article, compressed_article, self.articles[article].views
+                    article, compressed_article, lookup_info.views
                 ).buffer_offset
                 == NOT_CACHED
             ):
-                self.attempt_evict_and_add(article, compressed_article)
+                if not self.attempt_evict_and_add(article, compressed_article, admission):
+                    self.rejected += 1
 
-            return True, compressed_article
-        elif lookup_info.buffer_offset == ON_DISK:
-            # (DISK CACHE HIT) fetch from disk and see if it qualifies for promotion
-            print(f"{article}: Serving from disk cache")
+            # add() replaces the LookupInfo if it got cached
+            self.articles[article].freshness = freshness
+            self.store_freshness(article, freshness)
+            cached = self.articles[article].buffer_offset != NOT_CACHED
+            if not cached:
+                self.forget(article)
 
-            compressed_article = self.get_from_disk_cache(article)
-            return True, compressed_article
-        else:
-            # (IN-MEMORY CACHE HIT) fetch from in-memory cache
-            print(f"{article}: Serving from in-memory cache")
+        if cached and self.compressor.needs_recompression(article):
+            self.recompress_queue.put(article)
 
-            return True, self.buffer[lookup_info.buffer_offset]
+    def recompress_forever(self):
+        """
+        Recompresses the queued up articles one at a time, for as long as the process runs.
+        """
+        while True:
+            article = self.recompress_queue.get()
+            try:
+                self.recompress(article)
+            except Exception as e:
+                log(f"{article}: Recompression failed: {e!r}")
+
+    def recompress(self, article: str):
+        """
+        Recompresses a cached article at the max level and swaps it in, in
+        whichever tier it is, if it got smaller. The compression itself happens
+        without holding the lock.
+
+        :param article: Request path of the article
+        """
+        with self.lock:
+            lookup_info = self.articles.get(article)
+            if lookup_info is None:
+                return  # evicted and forgotten in the meantime
+            buffer_offset = lookup_info.buffer_offset
+            if buffer_offset >= 0:
+                compressed_article = bytes(self.arena.view[buffer_offset : buffer_offset + lookup_info.size])
+            elif buffer_offset == ON_DISK:
+                try:
+                    compressed_article = bytes(self.get_from_disk_cache(article))
+                except KeyError:
+                    return
+            else:
+                return  # evicted in the meantime
+
+        recompressed_article = self.compressor.recompress(article, compressed_article)
+        if recompressed_article is None:
+            return
+        saved = len(compressed_article) - len(recompressed_article)
+
+        with self.lock:
+            # It might have been evicted, or evicted and cached again in the meantime
+            if lookup_info is not self.articles.get(article) or lookup_info.size != len(compressed_article):
+                return
+
+            if lookup_info.buffer_offset >= 0:
+                buffer_offset = self.arena.store(recompressed_article)
+                if buffer_offset == NO_SPACE:
+                    return
+                # Anyone still sending the old copy keeps it until they release it
+                self.arena.free(lookup_info.buffer_offset)
+                lookup_info.buffer_offset = buffer_offset
+                self.memory_used -= saved
+            elif lookup_info.buffer_offset == ON_DISK:
+                try:
+                    # The old copy is dead once the new one is written, but it's there until then
+                    if not self.make_room_on_disk(self.disk_store.record_size(article, len(recompressed_article))):
+                        return
+                    self.disk_store.put(article, recompressed_article)
+                except IOError:
+                    return
+            else:
+                return
+
+            lookup_info.size = len(recompressed_article)
+            self.compressor.replaced(article, lookup_info.size)
+
+        log(f"{article}: Recompressed, saved {saved} bytes")
+
+    def check_freshness(self, lookup_info: LookupInfo) -> Freshness:
+        """
+        Queues up a cached article for revalidation if it's stale, unless it already
+        is. Holding self.lock.
+
+        :return: how fresh the article is
+        """
+        freshness = lookup_info.freshness
+        if freshness is not None and freshness.is_stale() and lookup_info.article_name not in self.revalidating:
+            self.revalidating.add(lookup_info.article_name)
+            self.revalidate_queue.put(lookup_info.article_name)
+        return freshness
+
+    def revalidate_forever(self):
+        """
+        Revalidates the queued up articles one at a time, for as long as the process runs.
+        """
+        while True:
+            article = self.revalidate_queue.get()
+            try:
+                self.revalidate(article)
+            except Exception as e:
+                # It's queued up again on the next hit
+                with self.lock:
+                    self.revalidation_failures += 1
+                log(f"{article}: Revalidation failed, still serving the stale copy: {e!r}")
+            finally:
+                with self.lock:
+                    self.revalidating.discard(article)
+
+    def revalidate(self, article: str):
+        """
+        Asks the origin whether a stale article changed, with a conditional request.
+        If it didn't, the article is fresh again. If it did, the new version replaces
+        the old one, and if the origin doesn't have it anymore, it's dropped. Requests
+        keep getting the stale copy until then.
+
+        :param article: Request path of the article
+        """
+        with self.lock:
+            lookup_info = self.articles.get(article)
+            if lookup_info is None or lookup_info.buffer_offset == NOT_CACHED:
+                return  # evicted in the meantime
+            freshness = lookup_info.freshness
+
+        headers = {"Accept-Encoding": "gzip", **freshness.conditional_headers()}
+        try:
+            response = self.origin_pool.get(
+                article, headers, statuses=(http.HTTPStatus.OK, http.HTTPStatus.NOT_MODIFIED)
+            )
+        except OriginError as e:
+            if e.status != http.HTTPStatus.NOT_FOUND:
+                raise
+            with self.lock:
+                if lookup_info is self.articles.get(article) and lookup_info.buffer_offset != NOT_CACHED:
+                    self.drop(article)
+                    self.forget(article)
+            self.negative_cache.add(article)
+            log(f"{article}: Not found at the origin anymore, dropped it")
+            return
+
+        if response.status == http.HTTPStatus.NOT_MODIFIED:
+            with self.lock:
+                # It might have been evicted, or evicted and cached again in the meantime
+                if lookup_info is self.articles.get(article):
+                    lookup_info.freshness = freshness.revalidated(response.headers, self.max_age)
+                    self.store_freshness(article, lookup_info.freshness)
+                self.not_modified += 1
+            log(f"{article}: Revalidated, not modified")
+            return
+
+        compressed_article = self.compress_response(article, response)
+        with self.lock:
+            if lookup_info is not self.articles.get(article) or lookup_info.buffer_offset == NOT_CACHED:
+                return
+            self.drop(article)
+            self.cache_fetched(
+                article, compressed_article, freshness=Freshness.from_headers(response.headers, self.max_age)
+            )
+            self.modified += 1
+        log(f"{article}: Revalidated, replaced with the new version")
+
+    def drop(self, article: str):
+        """
+        Removes a cached article from whichever tier it's in, e.g. to replace it
+        with a new version. Holding self.lock.
+        """
+        lookup_info = self.articles[article]
+        if lookup_info.buffer_offset >= 0:
+            self.remove_from_in_memory_cache(article)
+        if lookup_info.buffer_offset != NOT_CACHED and article in self.disk_store:
+            # In test mode, in-memory articles loaded at startup still have their copy on disk
+            self.remove_from_disk_cache(article)
+        self.heap.remove(lookup_info)
+        lookup_info.buffer_offset = NOT_CACHED
 
     def add(self, article: str, article_raw_bytes: bytes, views: int) -> LookupInfo:
         """
@@ -157,50 +773,155 @@ class RepliCache:
         :param views: Number of page views
         :return:
         """
-        buffer_offset = self.add_to_in_memory_cache(article_raw_bytes)
-        if buffer_offset == NOT_CACHED:
-            buffer_offset = self.add_to_disk_cache(article, article_raw_bytes)
+        with self.lock:
+            buffer_offset = self.add_to_in_memory_cache(article_raw_bytes)
+            if buffer_offset == NOT_CACHED:
+                buffer_offset = self.add_to_disk_cache(article, article_raw_bytes)
 
-        lookup_info = LookupInfo(views, buffer_offset, article)
-        if lookup_info.buffer_offset != NOT_CACHED:
-            self.heap.append(lookup_info)
-            self.articles[article] = lookup_info
+            lookup_info = LookupInfo(views, buffer_offset, article, len(article_raw_bytes))
+            if lookup_info.buffer_offset != NOT_CACHED:
+                self.heap.push(lookup_info)
+                self.articles[article] = lookup_info
 
-        return lookup_info
+            return lookup_info
 
-    def add_to_in_memory_cache(
-        self, article_raw_bytes: bytes, buffer_offset: int = APPEND
-    ) -> int:
+    def add_to_in_memory_cache(self, article_raw_bytes: bytes) -> int:
         """
-        Attempts to add an article to the in-memory cache.
+        Attempts to add an article to the in-memory cache. If there's enough
+        free space in the arena but it's too fragmented, the arena is compacted first.
         """
-        if self.fits_in_memory_cache(article_raw_bytes):
-            self.memory_used += len(article_raw_bytes)
-            if buffer_offset == APPEND:
-                self.buffer.append(article_raw_bytes)
-                return len(self.buffer) - 1
-            else:
-                self.buffer[buffer_offset] = article_raw_bytes
-                return buffer_offset
+        if not self.fits_in_memory_cache(article_raw_bytes):
+            return NOT_CACHED
 
-        return NOT_CACHED
+        buffer_offset = self.arena.store(article_raw_bytes)
+        if buffer_offset == NO_SPACE:
+            self.compact_in_memory_cache()
+            buffer_offset = self.arena.store(article_raw_bytes)
+            if buffer_offset == NO_SPACE:
+                # The free space is held by regions that are still being read
+                return NOT_CACHED
 
-    def remove_from_in_memory_cache(self, article: str) -> int:
+        self.memory_used += len(article_raw_bytes)
+        return buffer_offset
+
+    def compact_in_memory_cache(self):
+        """
+        Compacts the arena and points the moved articles to their new offsets.
+        """
+        moved = self.arena.compact()
+        if not moved:
+            return
+
+        for lookup_info in self.heap:
+            if lookup_info.buffer_offset in moved:
+                lookup_info.buffer_offset = moved[lookup_info.buffer_offset]
+        log(f"Compacted in-memory cache, moved {len(moved)} articles")
+
+    def dump_articles(self) -> str:
+        """
+        :return: the lookup table as JSON, for debugging
+        """
+        with self.lock:
+            return json.dumps(self.articles, default=lambda obj: obj.__dict__)
+
+    def compression_report(self) -> str:
+        """
+        :return: the compression stats as JSON, for debugging
+        """
+        return json.dumps(self.compressor.report())
+
+    def warmer_report(self) -> str:
+        """
+        :return: the progress of the cache warmer as JSON
+        """
+        if self.warmer is None:
+            return json.dumps({"ready": True, "state": "disabled"})
+        return json.dumps(self.warmer.progress())
+
+    def admission_report(self) -> str:
+        """
+        :return: the counters of the admission filter and the negative cache as JSON
+        """
+        with self.lock:
+            report = {
+                "enabled": self.sketch is not None,
+                "tracked_articles": len(self.articles),
+                "rejected": self.rejected,
+                "negative_cache": self.negative_cache.stats(),
+            }
+            if self.sketch is not None:
+                report["sketch"] = self.sketch.stats()
+        return json.dumps(report)
+
+    def freshness_report(self) -> str:
+        """
+        :return: the counters of the revalidations as JSON
+        """
+        with self.lock:
+            return json.dumps(
+                {
+                    "max_age": self.max_age,
+                    "stale": sum(
+                        1
+                        for lookup_info in self.heap
+                        if lookup_info.freshness is not None and lookup_info.freshness.is_stale()
+                    ),
+                    "revalidating": len(self.revalidating),
+                    "not_modified": self.not_modified,
+                    "modified": self.modified,
+                    "failures": self.revalidation_failures,
+                }
+            )
+
+    def metrics_report(self) -> str:
+        """
+        :return: the counters and latency histograms of the process, and how full the cache is, as JSON
+        """
+        return json.dumps({**report(METRICS.snapshot()), "cache": self.usage()})
+
+    def usage(self) -> dict:
+        with self.lock:
+            return {
+                "cached_articles": len(self.heap),
+                "memory_used": self.memory_used,
+                "disk_used": self.disk_used,
+            }
+
+    def logs_report(self) -> str:
         """
-        Since buffer is a list, there's really nothing to "remove" here.
-        We can set the element at the offset in the buffer to None in the
-        hopes that the garbage collector reclaims that memory.
+        :return: the lines in the log's ring
+        """
+        return format_lines(LOG.tail())
 
-        We return the buffer_offset that is now empty in the hopes that it
-        will be refilled with a new article. This method is only called by
-        attempt_promotion which does exactly that, so we're safe. Otherwise,
-        we would have holes in our buffer.
+    def peer_report(self) -> str:
+        """
+        :return: the counters of the peer group as JSON
+        """
+        if self.peers is None:
+            return json.dumps({"state": "disabled"})
+        return json.dumps(self.peers.stats())
 
-        :return: buffer_offset: offset within the in-memory buffer that the article occupied
+    def release(self, data: bytes):
+        """
+        Gives back the article returned by get() once it has been sent. In-memory
+        articles stay pinned in the arena until then and disk slices keep their file open.
+        """
+        if isinstance(data, memoryview):
+            with self.lock:
+                self.arena.release(data)
+        elif isinstance(data, DiskSlice):
+            data.file.close()
+
+    def remove_from_in_memory_cache(self, article: str) -> int:
+        """
+        Gives the region of the arena the article occupied back to the free list.
+        If someone is still sending the article, the region is reused once they're done.
+
+        :return: buffer_offset: offset within the arena that the article occupied
         """
         lookup_info = self.articles[article]
-        self.memory_used -= len(self.buffer[lookup_info.buffer_offset])
-        self.buffer[lookup_info.buffer_offset] = None
+        self.arena.free(lookup_info.buffer_offset)
+        self.memory_used -= lookup_info.size
         return lookup_info.buffer_offset
 
     def add_to_disk_cache(self, article: str, article_raw_bytes: bytes) -> int:
@@ -208,152 +929,305 @@ class RepliCache:
         Attempts to add an article to the disk cache.
         """
         try:
-            with open(f"cache/{article}", "wb") as cache_file:
-                cache_file.write(article_raw_bytes)
-                self.disk_used += len(article_raw_bytes)
-                return ON_DISK
+            if not self.make_room_on_disk(self.disk_footprint(article, len(article_raw_bytes))):
+                return NOT_CACHED
+            self.disk_store.put(article, article_raw_bytes)
+            return ON_DISK
         except IOError:
             return NOT_CACHED
 
     def remove_from_disk_cache(self, article: str):
-        filepath = f"cache/{article}"
-        file_size = os.path.getsize(filepath)
-        os.remove(filepath)
-        self.disk_used -= file_size
+        self.delete_from_disk_store(article)
 
-    def attempt_evict_and_add(
-        self, article_name_to_promote: str, compressed_article_to_promote: bytes
-    ) -> bool:
+    @property
+    def disk_used(self) -> int:
         """
-        Promotion: When the cache is full, and we need to add a new article to it.
+        :return: the size of the disk store, which is what counts towards the disk
+        quota, dead records, tombstones and the freshness of the articles included
+        """
+        return self.disk_store.size_on_disk()
 
-        In this situation, we find the article with minimum views from our cache and compare its
-        views with that of the new article. If the new article has more views, we perform further
-        checks to ensure the new article can fit in the cache (memory or disk, doesn't matter)
-        once the old one is evicted. If that check succeeds, we evict the one in the cache and add
-        the new one in its place.
+    def disk_footprint(self, article: str, size: int) -> int:
+        """
+        :return: how much of the disk quota an article of the given size takes: its record
+        in the disk store and its freshness, their entries in the index, and the tombstones
+        that eventually delete both
+        """
+        record_size, index_entry_size = self.disk_store.record_size, self.disk_store.index_entry_size
+        freshness_key = FRESHNESS_PREFIX + article
+        return (
+            record_size(article, size)
+            + record_size(freshness_key, FRESHNESS_RESERVE)
+            + index_entry_size(article)
+            + index_entry_size(freshness_key)
+            + record_size(article, 0)
+            + record_size(freshness_key, 0)
+        )
 
-        To make the lookup of the article with minimum views faster, we employ a heap. We run heapify
-        lazily i.e. only before we need to grab the minimum element. At other times, we don't need the
-        heap. This results in O(logn) heapify complexity, which is not too bad for the total number of
-        articles we anticipate in the cache (~400). The logn runtime is justified because now we can
-        look up the article with minimum views in O(1).
+    def make_room_on_disk(self, footprint: int) -> bool:
         """
-        heapq.heapify(self.heap)
-        lookup_info_to_evict: LookupInfo = heapq.heappop(self.heap)
-        lookup_info_to_promote: LookupInfo = self.articles[article_name_to_promote]
+        Checks that footprint more bytes fit in the disk quota, and if it's dead records
+        that are in the way, compacts the disk store to reclaim as many as it takes.
+        Holding self.lock.
 
-        eligible = lookup_info_to_evict.views < lookup_info_to_promote.views
+        :return: whether they fit
+        :raises IOError: if compacting fails
+        """
+        overflow = self.disk_used + footprint - self.max_disk_size
+        if 0 < overflow <= self.disk_store.dead_size():
+            reclaimed = self.disk_store.reclaim(overflow)
+            log(f"Compacted disk cache, reclaimed {reclaimed} bytes")
+        return self.disk_used + footprint <= self.max_disk_size
 
-        if not eligible:
-            # If we can't evict, add back to the heap
-            self.heap.append(lookup_info_to_evict)
+    def delete_from_disk_store(self, article: str) -> int:
+        """
+        Deletes an article and its freshness from the disk store.
+
+        :return: the size of the article, 0 if it wasn't in the store
+        """
+        self.disk_store.delete(FRESHNESS_PREFIX + article)
+        return self.disk_store.delete(article)
+
+    def store_freshness(self, article: str, freshness: Freshness):
+        """
+        Keeps the freshness of an article next to it in the disk store, if it's there.
+        """
+        if freshness is None or article not in self.disk_store:
+            return
+        key, data = FRESHNESS_PREFIX + article, freshness.encode()
+        try:
+            if not self.make_room_on_disk(self.disk_store.record_size(key, len(data))):
+                return
+            self.disk_store.put(key, data)
+        except IOError:
+            pass  # it'll be revalidated unconditionally after a restart, that's all
+
+    def stored_freshness(self, article: str) -> Freshness:
+        """
+        :return: the freshness of an article in the disk store. If it wasn't kept,
+        there's no telling how old the article is, so it's as fresh as if it was
+        just fetched, and last modified then.
+        """
+        try:
+            return Freshness.decode(self.disk_store.read(FRESHNESS_PREFIX + article))
+        except (KeyError, ValueError, TypeError):
+            return Freshness.from_headers({}, self.max_age)
+
+    def attempt_evict_and_add(
+        self, article_name_to_promote: str, compressed_article_to_promote: bytes, admission: float = 1.0
+    ) -> bool:
+        """
+        Promotion: When the cache is full, and we need to add a new article to it.
+
+        In this situation, we pop articles off the min-heap in order of increasing views for as
+        long as all of them together have fewer views than the new article, i.e. for as long as
+        evicting them loses less traffic than caching the new one gains. For each tier we
+        keep track of how much room evicting the popped articles would free up. As soon as one
+        of the tiers would have enough room for the new article, we evict the popped articles
+        from that tier and add the new one in their place. The ones popped from the other tier
+        go back on the heap. This way one large popular article can displace several small
+        unpopular ones instead of being compared against the least viewed article only.
+
+        The heap is indexed, so it stays valid when views are incremented on hits and each
+        push/pop is O(logn). Evicting k articles costs O(klogn).
+
+        With admission > 1, the victims need to have admission times fewer views than
+        the new article, e.g. for articles owned by another replica, which can be
+        fetched from it again.
+
+        In admission mode, the victims are still picked in order of views, but it's
+        how often they and the new article were requested lately that's compared
+        (see self.frequency), i.e. the frequency sketch is the TinyLFU admission
+        filter in front of the eviction policy.
+        """
+        with self.lock:
+            lookup_info_to_promote: LookupInfo = self.articles[article_name_to_promote]
+            article_size = len(compressed_article_to_promote)
+            frequency_to_promote = self.frequency(lookup_info_to_promote)
+
+            memory_victims, disk_victims = [], []
+            memory_freed, disk_freed = 0, 0
+            victim_views = 0
+            # Dead records count towards the disk quota, but compacting reclaims them
+            disk_live = self.disk_used - self.disk_store.dead_size()
+            disk_footprint = self.disk_footprint(article_name_to_promote, article_size)
+
+            while (
+                self.heap
+                and (victim_views + self.frequency(self.heap.peek())) * admission < frequency_to_promote
+            ):
+                lookup_info_to_evict: LookupInfo = self.heap.pop()
+                victim_views += self.frequency(lookup_info_to_evict)
+                if lookup_info_to_evict.buffer_offset == ON_DISK:
+                    disk_victims.append(lookup_info_to_evict)
+                    disk_freed += self.disk_store.record_size(
+                        lookup_info_to_evict.article_name, lookup_info_to_evict.size
+                    )
+                else:
+                    memory_victims.append(lookup_info_to_evict)
+                    memory_freed += lookup_info_to_evict.size
+
+                if self.memory_used - memory_freed + article_size <= self.max_memory_size:
+                    self.restore_to_heap(disk_victims)
+                    if self.evict_and_add_in_memory(
+                        lookup_info_to_promote, compressed_article_to_promote, memory_victims
+                    ):
+                        return True
+                    # The space they'd free up is still being read, so nothing gets evicted
+                    self.restore_to_heap(memory_victims)
+                    return False
+
+                if disk_live - disk_freed + disk_footprint <= self.max_disk_size:
+                    self.restore_to_heap(memory_victims)
+                    self.evict_and_add_on_disk(
+                        lookup_info_to_promote, compressed_article_to_promote, disk_victims
+                    )
+                    return True
+
+            # Not enough less popular articles to make room, so nothing gets evicted
+            self.restore_to_heap(memory_victims)
+            self.restore_to_heap(disk_victims)
             return False
-        else:
-            compressed_article_to_evict = self.buffer[
-                lookup_info_to_evict.buffer_offset
-            ]
-
-            return self.attempt_evict_and_add_in_memory(
-                article_name_to_promote,
-                lookup_info_to_promote,
-                compressed_article_to_promote,
-                lookup_info_to_evict,
-                compressed_article_to_evict,
-            ) or self.attempt_evict_and_add_on_disk(
-                article_name_to_promote,
-                lookup_info_to_promote,
-                compressed_article_to_promote,
-                lookup_info_to_evict,
-                compressed_article_to_evict,
-            )
 
-    def attempt_evict_and_add_in_memory(
+    def restore_to_heap(self, lookup_infos: list):
+        for lookup_info in lookup_infos:
+            self.heap.push(lookup_info)
+
+    def evict_and_add_in_memory(
         self,
-        article_name_to_promote: str,
         lookup_info_to_promote: LookupInfo,
         compressed_article_to_promote: bytes,
-        lookup_info_to_evict: LookupInfo,
-        compressed_article_to_evict: bytes,
+        lookup_infos_to_evict: list,
     ) -> bool:
         """
-        Checks if a swap is possible in memory. If yes,
-        performs the same and modifies the appropriate
-        LookupInfo data.
-        """
-        swap_possible_in_memory = (
-            self.memory_used
-            - len(compressed_article_to_evict)
-            + len(compressed_article_to_promote)
-        ) <= self.max_memory_size
+        Evicts the given articles from the in-memory cache and adds the
+        promoted one in their place, modifying the appropriate LookupInfo data.
+        The evicted articles that still have a copy in the disk store (in test mode,
+        the ones loaded from it at startup) stay cached there.
 
-        if not swap_possible_in_memory:
+        :return: False, without evicting anything, if the promoted article wouldn't
+        fit in the arena even then, e.g. because some of them are still being sent
+        """
+        offsets = [lookup_info.buffer_offset for lookup_info in lookup_infos_to_evict]
+        if not self.arena.fits_after_free(len(compressed_article_to_promote), offsets):
             return False
 
-        lookup_info_to_promote.buffer_offset = lookup_info_to_evict.buffer_offset
-        lookup_info_to_evict.buffer_offset = NOT_CACHED
-
-        deleted_buffer_offset = self.remove_from_in_memory_cache(
-            lookup_info_to_evict.article_name
-        )
-        self.add_to_in_memory_cache(
-            compressed_article_to_promote,
-            deleted_buffer_offset,
+        for lookup_info_to_evict in lookup_infos_to_evict:
+            article = lookup_info_to_evict.article_name
+            self.remove_from_in_memory_cache(article)
+            if article in self.disk_store:
+                lookup_info_to_evict.buffer_offset = ON_DISK
+                lookup_info_to_evict.size = self.disk_store.length(article)
+                self.heap.push(lookup_info_to_evict)
+                continue
+            lookup_info_to_evict.buffer_offset = NOT_CACHED
+            self.forget(article)
+
+        lookup_info_to_promote.buffer_offset = self.add_to_in_memory_cache(
+            compressed_article_to_promote
         )
+        lookup_info_to_promote.size = len(compressed_article_to_promote)
+        self.heap.push(lookup_info_to_promote)
 
-        print(
-            f"Promoted {article_name_to_promote}, evicted {lookup_info_to_evict.article_name}"
-        )
+        METRICS.count("evictions.memory", len(lookup_infos_to_evict))
+        evicted = ", ".join(info.article_name for info in lookup_infos_to_evict)
+        log(f"Promoted {lookup_info_to_promote.article_name}, evicted {evicted}")
         return True
 
-    def attempt_evict_and_add_on_disk(
+    def evict_and_add_on_disk(
         self,
-        article_name_to_promote: str,
         lookup_info_to_promote: LookupInfo,
         compressed_article_to_promote: bytes,
-        lookup_info_to_evict: LookupInfo,
-        compressed_article_to_evict: bytes,
+        lookup_infos_to_evict: list,
     ):
         """
-        Checks if a swap is possible on disk. If yes,
-        performs the same and modifies the appropriate
-        LookupInfo data.
+        Evicts the given articles from the disk cache and adds the
+        promoted one in their place, modifying the appropriate LookupInfo data.
         """
-        swap_possible_on_disk = (
-            self.disk_used
-            - len(compressed_article_to_promote)
-            + len(compressed_article_to_evict)
-        ) <= self.max_disk_size
-
-        if not swap_possible_on_disk:
-            return False
-
-        lookup_info_to_evict.buffer_offset = NOT_CACHED
-        lookup_info_to_promote.buffer_offset = ON_DISK
-
-        # This is the damn reason why we need to have a redundant
-        # reference to article_name within LookupInfo.
-        self.remove_from_disk_cache(lookup_info_to_evict.article_name)
-        self.add_to_disk_cache(
+        for lookup_info_to_evict in lookup_infos_to_evict:
+            # This is the damn reason why we need to have a redundant
+            # reference to article_name within LookupInfo.
+            self.remove_from_disk_cache(lookup_info_to_evict.article_name)
+            lookup_info_to_evict.buffer_offset = NOT_CACHED
+            self.forget(lookup_info_to_evict.article_name)
+
+        lookup_info_to_promote.buffer_offset = self.add_to_disk_cache(
             lookup_info_to_promote.article_name, compressed_article_to_promote
         )
+        lookup_info_to_promote.size = len(compressed_article_to_promote)
+        if lookup_info_to_promote.buffer_offset != NOT_CACHED:
+            self.heap.push(lookup_info_to_promote)
 
-        print(
-            f"Promoted {article_name_to_promote}, evicted {lookup_info_to_evict.article_name}"
-        )
-        return True
+        METRICS.count("evictions.disk", len(lookup_infos_to_evict))
+        evicted = ", ".join(info.article_name for info in lookup_infos_to_evict)
+        log(f"Promoted {lookup_info_to_promote.article_name}, evicted {evicted}")
 
     def fetch_from_origin(self, article: str) -> bytes:
-        with urlopen(f"{self.origin_url}/{article}") as response:
-            return response.read()
+        """
+        Fetches the raw (uncompressed) bytes of an article from the origin.
+        """
+        response = self.origin_pool.get(article)
+        if response.is_gzipped:
+            return gzip.decompress(response.body)
+        return response.body
+
+    def fetch_compressed_from_origin(self, article: str, stream: ArticleStream = None) -> (bytes, Freshness):
+        """
+        Fetches an article from the origin and returns it gzipped. We ask the origin
+        for gzip so that if it already compresses, we can skip compressing it ourselves.
+        Otherwise it's compressed at the fast level.
+
+        :param stream: where to write the compressed article as it comes in from the origin, if anywhere
+        :return: the compressed article and how fresh it is
+        """
+        if stream is not None:
+            return self.stream_compressed_from_origin(article, stream)
+
+        response = self.origin_pool.get(article, {"Accept-Encoding": "gzip"})
+        return self.compress_response(article, response), Freshness.from_headers(response.headers, self.max_age)
+
+    def compress_response(self, article: str, response: OriginResponse) -> bytes:
+        """
+        :return: the article in a response from the origin, gzipped
+        """
+        if response.is_gzipped:
+            return self.compressor.adopt(article, response.body)
+        return self.compressor.compress(article, response.body)
+
+    def stream_compressed_from_origin(self, article: str, stream: ArticleStream) -> (bytes, Freshness):
+        """
+        Same as fetch_compressed_from_origin(), but the article is compressed and
+        written to the stream as it comes in from the origin.
+
+        :return: the whole compressed article and how fresh it is
+        """
+        with self.origin_pool.stream(article, {"Accept-Encoding": "gzip"}, STREAM_CHUNK_SIZE) as response:
+            stream.freshness = Freshness.from_headers(response.headers, self.max_age)
+            if response.is_gzipped:
+                for chunk in response.body:
+                    stream.write(chunk)
+                return self.compressor.adopt(article, bytes(stream.buffer)), stream.freshness
+
+            for chunk in self.compressor.compress_stream(article, response.body):
+                stream.write(chunk)
+            return bytes(stream.buffer), stream.freshness
 
     def fits_in_memory_cache(self, article_raw_bytes: bytes) -> bool:
         return self.memory_used + len(article_raw_bytes) <= self.max_memory_size
 
-    @staticmethod
-    def get_from_disk_cache(article: str) -> bytes:
-        with open(f"cache/{article}", "rb") as fd:
-            return fd.read()
+    def open_from_disk_cache(self, article: str) -> DiskSlice:
+        """
+        :return: where the article lives on disk, with the file already open
+        :raises KeyError: if the article isn't on disk (anymore)
+        """
+        return DiskSlice(*self.disk_store.open(article))
+
+    def get_from_disk_cache(self, article: str) -> memoryview:
+        """
+        :return: a zero-copy slice of the article in the disk store
+        :raises KeyError: if the article isn't on disk (anymore)
+        """
+        return self.disk_store.read(article)
 
 
 if __name__ == "__main__":
@@ -362,17 +1236,15 @@ if __name__ == "__main__":
 
     from timeit import default_timer as timer
 
-    start = timer()
-    cache.get("Rishi_Sunak")
-    end = timer()
-    print(f"{(end - start) * 1000:.2f}ms")
-
-    start = timer()
-    cache.get("Prabhas")
-    end = timer()
-    print(f"{(end - start) * 1000:.2f}ms")
-
-    start = timer()
-    cache.get("Jeff_Bridges")
-    end = timer()
-    print(f"{(end - start) * 1000:.2f}ms")
+    for article in ("Rishi_Sunak", "Prabhas", "Jeff_Bridges"):
+        start = timer()
+        try:
+            found, data, freshness = cache.get(article)
+        except FETCH_ERRORS as e:
+            print(f"{article}: {e!r}")
+            continue
+        end = timer()
+        if found:
+            # Hits stay pinned in the arena, or keep their segment open, until they're given back
+            cache.release(data)
+        print(f"{article}: {(end - start) * 1000:.2f}ms")
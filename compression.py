@@ -0,0 +1,303 @@
+import gzip
+import struct
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Iterable, Iterator
+
+from metrics import METRICS
+
+FAST_LEVEL = 1  # for misses, while the client is waiting
+MAX_LEVEL = 9  # for the background recompression
+
+# The encoding articles are cached in. Other encodings (e.g. br or zstd) can be
+# added to ENCODINGS once there's a variant to serve them from.
+STORED_ENCODING = "gzip"
+IDENTITY = "identity"
+ENCODINGS = (STORED_ENCODING, IDENTITY)  # in order of preference
+
+ORIGIN_LEVEL = 0  # the level isn't known when the origin compressed the article itself
+GZIP_WBITS = 31  # tells zlib to write a gzip header and trailer
+
+
+def parse_accept_encoding(header: str) -> dict:
+    """
+    Parses an Accept-Encoding header.
+
+    :param header: the value of the header, e.g. "gzip;q=1.0, identity; q=0.5, *;q=0"
+    :return: a dict mapping each (lowercase) content coding to its quality value
+    """
+
+    qualities = {}
+    for item in header.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    return qualities
+
+
+def negotiate(header: str = None) -> str:
+    """
+    Picks the encoding to send an article in, as per RFC 9110 section 12.5.3.
+
+    :param header: the value of the Accept-Encoding header, None if there's none
+    :return: one of ENCODINGS, or None if the client accepts none of them
+    """
+
+    if header is None:
+        # Any encoding is acceptable, and clients have always been sent gzip
+        return STORED_ENCODING
+
+    qualities = parse_accept_encoding(header)
+    wildcard = qualities.get("*")
+
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = qualities.get(encoding, wildcard)
+        if quality is None:
+            # identity is acceptable unless it (or *) is explicitly refused
+            quality = 0.001 if encoding == IDENTITY else 0.0
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def decompress(compressed_article) -> bytes:
+    """
+    Decodes a cached article for clients that don't accept its encoding.
+
+    :param compressed_article: the cached article (bytes, a memoryview or a DiskSlice)
+    :return: the uncompressed article
+    """
+
+    if hasattr(compressed_article, "read"):
+        compressed_article = compressed_article.read()
+    return gzip.decompress(compressed_article)
+
+
+def uncompressed_size(compressed_article) -> int:
+    """
+    :return: the size of the article once decompressed, from the gzip trailer
+    """
+
+    return struct.unpack("<I", compressed_article[-4:])[0]
+
+
+@dataclass
+class CompressionStats:
+    """
+    A simple data class that keeps track of how well an article compresses.
+    """
+
+    article_name: str
+    raw_size: int
+
+    # Size and level of the variant that is cached right now
+    size: int
+    level: int
+
+    # Size after the fast compression on the request path and how long it took.
+    # Both are 0 if the origin sent the article compressed already.
+    fast_size: int = 0
+    fast_seconds: float = 0.0
+
+    # How long the background recompression took, 0 if it hasn't happened
+    max_seconds: float = 0.0
+
+    @property
+    def ratio(self) -> float:
+        return self.raw_size / self.size if self.size else 0.0
+
+
+class Compressor:
+    """
+    Compresses the articles fetched from the origin.
+
+    Misses are compressed at FAST_LEVEL so that the client isn't kept waiting,
+    and the cache recompresses them at MAX_LEVEL in the background once they're
+    cached, which makes them about a fifth smaller. Keeps track of the ratio and
+    the time it took for every article it compressed.
+    """
+
+    def __init__(self, fast_level: int = FAST_LEVEL, max_level: int = MAX_LEVEL):
+        self.fast_level = fast_level
+        self.max_level = max_level
+        self.stats = {}  # article name -> CompressionStats
+        self.lock = threading.Lock()
+
+    def compress(self, article: str, article_raw_bytes: bytes) -> bytes:
+        """
+        Compresses an article at the fast level.
+        """
+
+        start = time.perf_counter()
+        compressed_article = gzip.compress(article_raw_bytes, self.fast_level, mtime=0)
+        elapsed = time.perf_counter() - start
+        METRICS.observe("compression.fast", elapsed)
+
+        self.record(
+            CompressionStats(
+                article,
+                len(article_raw_bytes),
+                len(compressed_article),
+                self.fast_level,
+                fast_size=len(compressed_article),
+                fast_seconds=elapsed,
+            )
+        )
+        return compressed_article
+
+    def compress_stream(self, article: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """
+        Compresses an article at the fast level as it comes in. Every chunk is flushed
+        right away, which costs a few bytes each, so that what came in so far can be
+        sent before the rest arrives. The recompression gets rid of them.
+
+        :param chunks: the uncompressed article, a chunk at a time
+        :return: an iterator over the gzipped article, a chunk at a time
+        """
+
+        compressor = zlib.compressobj(self.fast_level, zlib.DEFLATED, GZIP_WBITS)
+        raw_size = size = 0
+        elapsed = 0.0
+        for chunk in chunks:
+            start = time.perf_counter()
+            compressed_chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            elapsed += time.perf_counter() - start
+            raw_size += len(chunk)
+            size += len(compressed_chunk)
+            yield compressed_chunk
+
+        compressed_chunk = compressor.flush()
+        size += len(compressed_chunk)
+        yield compressed_chunk
+
+        METRICS.observe("compression.fast", elapsed)
+
+        self.record(
+            CompressionStats(
+                article,
+                raw_size,
+                size,
+                self.fast_level,
+                fast_size=size,
+                fast_seconds=elapsed,
+            )
+        )
+
+    def adopt(self, article: str, compressed_article: bytes) -> bytes:
+        """
+        Keeps track of an article that the origin compressed itself.
+        """
+
+        self.record(
+            CompressionStats(
+                article,
+                uncompressed_size(compressed_article),
+                len(compressed_article),
+                ORIGIN_LEVEL,
+            )
+        )
+        return compressed_article
+
+    def needs_recompression(self, article: str) -> bool:
+        with self.lock:
+            stats = self.stats.get(article)
+            return stats is not None and stats.level != self.max_level
+
+    def recompress(self, article: str, compressed_article) -> bytes:
+        """
+        Recompresses an article at the max level.
+
+        :param compressed_article: the article as it is cached right now
+        :return: the recompressed article, or None if it didn't get any smaller
+        """
+
+        start = time.perf_counter()
+        recompressed_article = gzip.compress(decompress(compressed_article), self.max_level, mtime=0)
+        elapsed = time.perf_counter() - start
+        METRICS.observe("compression.max", elapsed)
+
+        with self.lock:
+            stats = self.stats.get(article)
+            if stats is not None:
+                stats.max_seconds = elapsed
+                stats.level = self.max_level
+
+        if len(recompressed_article) >= len(compressed_article):
+            return None
+        return recompressed_article
+
+    def replaced(self, article: str, size: int) -> None:
+        """
+        Records that the cached variant of an article is now size bytes.
+        """
+
+        with self.lock:
+            if article in self.stats:
+                self.stats[article].size = size
+
+    def record(self, stats: CompressionStats) -> None:
+        with self.lock:
+            self.stats[stats.article_name] = stats
+
+    def pop(self, article: str) -> CompressionStats:
+        """
+        Stops keeping track of an article, e.g. to hand its stats over to another process.
+        """
+
+        with self.lock:
+            return self.stats.pop(article, None)
+
+    def report(self) -> dict:
+        """
+        :return: the totals over every article compressed so far, and the stats of each of them
+        """
+
+        with self.lock:
+            stats = list(self.stats.values())
+
+        raw_size = sum(s.raw_size for s in stats)
+        size = sum(s.size for s in stats)
+        fast = [s for s in stats if s.fast_size]
+        recompressed = [s for s in stats if s.max_seconds]
+        fast_size = sum(s.fast_size for s in fast)
+        megabyte = 1024 * 1024
+
+        return {
+            "articles": len(stats),
+            "raw_bytes": raw_size,
+            "cached_bytes": size,
+            "ratio": raw_size / size if size else 0.0,
+            "fast_level": self.fast_level,
+            "max_level": self.max_level,
+            "fast_compressions": len(fast),
+            "fast_seconds": sum(s.fast_seconds for s in fast),
+            "recompressions": len(recompressed),
+            "max_seconds": sum(s.max_seconds for s in recompressed),
+            # Of the articles compressed on the request path, how many fit in a MB as
+            # they were first cached vs as they're cached now
+            "articles_per_mb_fast": len(fast) * megabyte / fast_size if fast_size else 0.0,
+            "articles_per_mb_now": len(fast) * megabyte / sum(s.size for s in fast) if fast else 0.0,
+            "per_article": {
+                s.article_name: {
+                    "raw_size": s.raw_size,
+                    "size": s.size,
+                    "level": s.level,
+                    "ratio": round(s.ratio, 3),
+                    "fast_ms": round(s.fast_seconds * 1000, 3),
+                    "max_ms": round(s.max_seconds * 1000, 3),
+                }
+                for s in stats
+            },
+        }
@@ -0,0 +1,168 @@
+import json
+import time
+from dataclasses import asdict, dataclass
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Mapping, Optional
+
+DEFAULT_MAX_AGE = 300.0  # seconds an article is fresh for, unless the origin says otherwise
+STALE_WHILE_REVALIDATE = 3600  # seconds clients may keep using a stale copy while they revalidate it with us
+
+
+def parse_http_date(value: str) -> Optional[float]:
+    """
+    :return: the timestamp of an HTTP date, or None if it isn't one
+    """
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def weak(etag: str) -> str:
+    """
+    :return: the weak version of an entity tag. Articles are sent gzipped or not
+    depending on the client, so the same tag can't be a strong one.
+    """
+    return etag if etag.startswith("W/") else f"W/{etag}"
+
+
+def max_age_of(cache_control: str) -> Optional[float]:
+    """
+    :return: how long a response may be cached for according to its Cache-Control
+    header, 0 if it has to be revalidated every time, or None if it doesn't say
+    """
+    directives = {}
+    for directive in cache_control.split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name.lower()] = value.strip('"')
+
+    if "no-cache" in directives or "no-store" in directives:
+        return 0.0
+    for name in ("s-maxage", "max-age"):  # s-maxage is the one meant for shared caches like us
+        try:
+            return float(directives[name])
+        except (KeyError, ValueError):
+            continue
+    return None
+
+
+@dataclass(frozen=True)
+class Freshness:
+    """
+    A simple data class that describes how fresh a cached article is, and what
+    to revalidate it with.
+
+    An article is fresh for max_age seconds after it was fetched (or last
+    revalidated), then it's stale. Stale articles are still served, while they're
+    revalidated in the background (stale-while-revalidate), so the origin is never
+    on the request path of a hit. The validators are the origin's, and are sent
+    back to it in a conditional request, as well as to the clients so that they
+    can revalidate their copy with us.
+    """
+
+    # When the article was fetched or last revalidated (time.time()), minus how
+    # old it already was then, e.g. when it came from a peer's cache
+    fetched_at: float
+    max_age: float
+    etag: str = None
+    last_modified: str = None  # an HTTP date
+
+    @classmethod
+    def from_headers(cls, headers: Mapping, default_max_age: float = DEFAULT_MAX_AGE) -> "Freshness":
+        """
+        :param headers: the headers of the origin's (or a peer's) response
+        :param default_max_age: the max age if the response doesn't have one
+        :return: the freshness of the article that was just fetched. Without a
+        Last-Modified, the article is taken to be modified when it was fetched.
+        """
+        now = time.time()
+        try:
+            age = max(0.0, float(headers.get("Age", 0)))
+        except ValueError:
+            age = 0.0
+
+        max_age = max_age_of(headers.get("Cache-Control", ""))
+        return cls(
+            fetched_at=now - age,
+            max_age=default_max_age if max_age is None else max_age,
+            etag=headers.get("ETag"),
+            last_modified=headers.get("Last-Modified") or formatdate(now - age, usegmt=True),
+        )
+
+    def revalidated(self, headers: Mapping, default_max_age: float = DEFAULT_MAX_AGE) -> "Freshness":
+        """
+        :param headers: the headers of the origin's 304 response
+        :return: the freshness of the article now that the origin said it didn't change
+        """
+        freshness = Freshness.from_headers(headers, default_max_age)
+        return Freshness(
+            fetched_at=freshness.fetched_at,
+            max_age=freshness.max_age,
+            etag=headers.get("ETag") or self.etag,
+            last_modified=headers.get("Last-Modified") or self.last_modified,
+        )
+
+    def encode(self) -> bytes:
+        """
+        :return: the freshness as JSON, to keep it next to the article in the disk store
+        """
+        return json.dumps(asdict(self)).encode()
+
+    @classmethod
+    def decode(cls, data: bytes) -> "Freshness":
+        return cls(**json.loads(bytes(data)))
+
+    def age(self) -> float:
+        return max(0.0, time.time() - self.fetched_at)
+
+    def is_stale(self) -> bool:
+        return self.age() >= self.max_age
+
+    def conditional_headers(self) -> dict:
+        """
+        :return: the headers that ask the origin to answer with a 304 if the article didn't change
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def response_headers(self) -> dict:
+        """
+        :return: the headers that let clients (and caches in between) cache the
+        article and revalidate it with us
+        """
+        headers = {
+            "Cache-Control": f"public, max-age={int(self.max_age)}, stale-while-revalidate={STALE_WHILE_REVALIDATE}",
+            "Age": str(int(self.age())),
+        }
+        if self.etag:
+            headers["ETag"] = weak(self.etag)
+        if self.last_modified:
+            headers["Last-Modified"] = self.last_modified
+        return headers
+
+    def not_modified(self, if_none_match: str = None, if_modified_since: str = None) -> bool:
+        """
+        Evaluates the conditional headers of a client's request. If-None-Match
+        wins over If-Modified-Since when there are both.
+
+        :return: whether the client's copy is the one we have, so that it can be answered with a 304
+        """
+        if if_none_match:
+            if not self.etag:
+                return False
+            if if_none_match.strip() == "*":
+                return True
+            # Weak comparison, since we only ever hand out weak tags
+            ours = weak(self.etag)
+            return any(weak(tag.strip()) == ours for tag in if_none_match.split(",") if tag.strip())
+
+        if if_modified_since and self.last_modified:
+            since = parse_http_date(if_modified_since)
+            modified = parse_http_date(self.last_modified)
+            return since is not None and modified is not None and int(modified) <= int(since)
+
+        return False
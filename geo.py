@@ -1,11 +1,22 @@
+import ipaddress
+import threading
+from collections import Counter, OrderedDict
 from math import radians, sin, cos, atan2, sqrt
+from typing import Optional, Union
 
 from replicas import REPLICAS
 from vendor import maxminddb
 
-DB = maxminddb.open_database('GeoLite2-City.mmdb')  # open the GeoIP database
+GEOIP_CACHE_SIZE = 4096  # max number of decoded GeoIP records to keep around
+DB = maxminddb.open_database('GeoLite2-City.mmdb', cache_size=GEOIP_CACHE_SIZE)  # open the GeoIP database
+# All we ever need from a record, the rest of it is skipped without being decoded
+LOCATION = maxminddb.Projection([('location', 'latitude'), ('location', 'longitude')])
 RADIUS_OF_EARTH = 6373  # km
 REPLICA_LOCATIONS = dict()
+REPLICA_COORDINATES = list()  # (replica, latitude in radians, longitude in radians, cosine of latitude)
+ROUTING_CACHE_SIZE = 65536  # max number of networks to remember the best replica for
+
+IPAddress = Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
 
 
 def locate_ip(client_ip: str) -> tuple:
@@ -16,9 +27,8 @@ def locate_ip(client_ip: str) -> tuple:
     :return: the client's IP address' latitude and longitude
     """
 
-    lat = DB.get(client_ip)['location']['latitude']
-    lon = DB.get(client_ip)['location']['longitude']
-    return lat, lon
+    location = DB.get(client_ip, LOCATION)['location']
+    return location['latitude'], location['longitude']
 
 
 def calculate_replica_locations() -> None:
@@ -29,6 +39,7 @@ def calculate_replica_locations() -> None:
     for replica_ip in REPLICAS.keys():
         lat, lon = locate_ip(replica_ip)
         REPLICA_LOCATIONS[replica_ip] = lat, lon
+        REPLICA_COORDINATES.append((replica_ip, radians(lat), radians(lon), cos(radians(lat))))
 
 
 calculate_replica_locations()
@@ -59,17 +70,135 @@ def haversine_distance(lon1: float, lat1: float, lon2: float, lat2: float) -> fl
     return d
 
 
+def closest_replica(lat: float, lon: float) -> str:
+    """
+    Finds the replica closest to a location in one pass over all of them.
+
+    The haversine term grows with the distance, so there's no need to go all the
+    way to kilometers to compare them, and the replicas' side of it is precomputed.
+
+    :param lat: the latitude of the location
+    :param lon: the longitude of the location
+    :return: the IP address of the closest http replica server
+    """
+
+    lat, lon = radians(lat), radians(lon)
+    cos_lat = cos(lat)
+    best_replica, best_a = None, 2.0
+    for replica, replica_lat, replica_lon, replica_cos_lat in REPLICA_COORDINATES:
+        a = sin((replica_lat - lat) / 2) ** 2 + cos_lat * replica_cos_lat * sin((replica_lon - lon) / 2) ** 2
+        if a < best_a:
+            best_replica, best_a = replica, a
+    return best_replica
+
+
+class RoutingCache:
+    """
+    This class represents a cache of the best replica for every network a client
+    came from, so that the GeoIP database only has to be searched and decoded once
+    per network instead of once per query.
+
+    The database tells us the length of the prefix each record is for, so one
+    lookup answers for the whole block. Lookups are a longest prefix match: for
+    each prefix length that is in the cache, longest first, the address is masked
+    and looked up in a dict. There's only a handful of distinct prefix lengths, so
+    that's a few dict lookups. The cache holds at most max_entries networks and
+    evicts the least recently used one.
+    """
+
+    def __init__(self, max_entries: int = ROUTING_CACHE_SIZE):
+        """
+        :param max_entries: the max number of networks to remember
+        """
+
+        self.max_entries = max_entries
+        # (ip version, prefix length, network bits) -> replica, least recently used first
+        self.entries = OrderedDict()
+        self.prefix_lens = {4: Counter(), 6: Counter()}  # number of entries per prefix length
+        self.lookup_order = {4: [], 6: []}  # the prefix lengths in the cache, longest first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(address: IPAddress, prefix_len: int) -> tuple:
+        return address.version, prefix_len, int(address) >> (address.max_prefixlen - prefix_len)
+
+    def get(self, address: IPAddress) -> Optional[str]:
+        """
+        :return: the replica for the longest cached prefix that the address is in, None if there's none
+        """
+
+        with self.lock:
+            for prefix_len in self.lookup_order[address.version]:
+                key = self.key(address, prefix_len)
+                replica = self.entries.get(key)
+                if replica is not None:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return replica
+
+            self.misses += 1
+            return None
+
+    def put(self, address: IPAddress, prefix_len: int, replica: str) -> None:
+        """
+        Remembers the replica for the network of the given prefix length that the address is in.
+        """
+
+        key = self.key(address, prefix_len)
+        with self.lock:
+            if key not in self.entries:
+                self.count(address.version, prefix_len, 1)
+            self.entries[key] = replica
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                (version, evicted_prefix_len, _), _ = self.entries.popitem(last=False)
+                self.count(version, evicted_prefix_len, -1)
+                self.evictions += 1
+
+    def count(self, version: int, prefix_len: int, delta: int) -> None:
+        prefix_lens = self.prefix_lens[version]
+        prefix_lens[prefix_len] += delta
+        if prefix_lens[prefix_len] == 0:
+            del prefix_lens[prefix_len]
+        elif prefix_lens[prefix_len] != 1 or delta < 0:
+            return  # the prefix lengths in the cache didn't change
+        self.lookup_order[version] = sorted(prefix_lens, reverse=True)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "prefix_lens": {version: dict(counts) for version, counts in self.prefix_lens.items()},
+            }
+
+
+ROUTING_CACHE = RoutingCache()
+
+
 def find_best_replica(client_ip: str) -> str:
     """
     Assigns the best http replica server to a client based on the GeoIP database.
+    The answer is cached for the client's whole network.
 
     :param client_ip: the client's IP address
     :return: the best http replica server for a client
     """
 
-    distances = list()
-    client_lat, client_lon = locate_ip(client_ip)
-    for replica, location in REPLICA_LOCATIONS.items():
-        distance = haversine_distance(client_lon, client_lat, location[1], location[0])
-        distances.append((distance, replica))
-    return min(distances)[1]
+    address = ipaddress.ip_address(client_ip)
+    replica = ROUTING_CACHE.get(address)
+    if replica is not None:
+        return replica
+
+    record, prefix_len = DB.get_with_prefix_len(address, LOCATION)
+    location = record['location']
+    replica = closest_replica(location['latitude'], location['longitude'])
+    ROUTING_CACHE.put(address, prefix_len, replica)
+    return replica
@@ -0,0 +1,143 @@
+from typing import Any, Callable, Hashable, Iterator
+
+
+class IndexedMinHeap:
+    """
+    A binary min-heap that also keeps track of where each item lives in it.
+
+    heapq only works on plain lists, so changing the priority of an item in place
+    silently breaks the heap invariant and the only fix is a full O(n) heapify.
+    This heap keeps a key -> position index next to the list, which allows
+    updating or removing any item in O(logn) while peeking at the minimum stays O(1).
+
+    Items are ordered by priority(item) and identified by key(item).
+    """
+
+    def __init__(
+        self,
+        priority: Callable[[Any], Any],
+        key: Callable[[Any], Hashable],
+    ):
+        self.priority = priority
+        self.key = key
+        self.items = []
+        self.positions = {}
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __bool__(self) -> bool:
+        return bool(self.items)
+
+    def __contains__(self, item: Any) -> bool:
+        return self.key(item) in self.positions
+
+    def __iter__(self) -> Iterator[Any]:
+        """
+        Iterates over the items in no particular order.
+        """
+        return iter(self.items)
+
+    def push(self, item: Any):
+        """
+        Adds an item to the heap. If an item with the same key is already in the
+        heap, it is replaced.
+        """
+        key = self.key(item)
+        if key in self.positions:
+            position = self.positions[key]
+            self.items[position] = item
+            self._fix(position)
+            return
+
+        self.items.append(item)
+        self.positions[key] = len(self.items) - 1
+        self._sift_up(len(self.items) - 1)
+
+    def peek(self) -> Any:
+        """
+        :return: the item with the lowest priority without removing it
+        """
+        return self.items[0]
+
+    def pop(self) -> Any:
+        """
+        Removes and returns the item with the lowest priority.
+        """
+        if not self.items:
+            raise IndexError("pop from an empty heap")
+        return self._remove_at(0)
+
+    def remove(self, item: Any) -> bool:
+        """
+        Removes an item from the heap.
+
+        :return: whether the item was in the heap
+        """
+        position = self.positions.get(self.key(item))
+        if position is None:
+            return False
+        self._remove_at(position)
+        return True
+
+    def update(self, item: Any) -> bool:
+        """
+        Restores the heap invariant after the priority of an item changed in place.
+
+        :return: whether the item was in the heap
+        """
+        position = self.positions.get(self.key(item))
+        if position is None:
+            return False
+        self._fix(position)
+        return True
+
+    def _remove_at(self, position: int) -> Any:
+        item = self.items[position]
+        last = self.items.pop()
+        del self.positions[self.key(item)]
+
+        if position < len(self.items):
+            self.items[position] = last
+            self.positions[self.key(last)] = position
+            self._fix(position)
+
+        return item
+
+    def _fix(self, position: int):
+        if position > 0 and self._less(position, (position - 1) >> 1):
+            self._sift_up(position)
+        else:
+            self._sift_down(position)
+
+    def _less(self, i: int, j: int) -> bool:
+        return self.priority(self.items[i]) < self.priority(self.items[j])
+
+    def _swap(self, i: int, j: int):
+        items = self.items
+        items[i], items[j] = items[j], items[i]
+        self.positions[self.key(items[i])] = i
+        self.positions[self.key(items[j])] = j
+
+    def _sift_up(self, position: int):
+        while position > 0:
+            parent = (position - 1) >> 1
+            if not self._less(position, parent):
+                break
+            self._swap(position, parent)
+            position = parent
+
+    def _sift_down(self, position: int):
+        size = len(self.items)
+        while True:
+            smallest = position
+            left = 2 * position + 1
+            right = left + 1
+            if left < size and self._less(left, smallest):
+                smallest = left
+            if right < size and self._less(right, smallest):
+                smallest = right
+            if smallest == position:
+                break
+            self._swap(position, smallest)
+            position = smallest
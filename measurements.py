@@ -0,0 +1,207 @@
+import json
+import subprocess
+import threading
+import time
+from collections import deque
+from sys import maxsize
+from typing import Callable, Iterable
+
+import psutil
+
+from ringlog import log
+from subnets import SubnetTable
+
+STALE_AFTER = 120.0  # seconds after which a client's RTT is measured again
+MEASUREMENT_INTERVAL = 12.0  # seconds between two requests from the DNS server to a replica
+UNREACHABLE = maxsize  # the RTT of a client that didn't answer the pings
+
+
+def scamper_ping(client_ips: list) -> dict:
+    """
+    Runs scamper to get RTTs active measurements by pinging the client servers.
+
+    :param client_ips: the list of client's IP addresses
+    :return: the client's IP addresses mapped to their average RTT, UNREACHABLE if there's none
+    """
+
+    scamper_output = subprocess.check_output(
+        ["scamper", "-p", "10", "-c", "ping", "-i", *client_ips, "-O", "json"]
+    ).decode()  # run scamper as a subprocess and ping clients with 10 packets per second
+    scamper_output = scamper_output.split("\n")[1:-2]  # get rid of first and last line
+    measurements = {}
+    for line in scamper_output:  # parse the output to only keep the client's IP address and RTT
+        json_object = json.loads(line)
+        dst_ip = json_object["dst"]
+        if "avg" in json_object["statistics"]:  # if the average RTT is present in the JSON object
+            measurements[dst_ip] = json_object["statistics"]["avg"]  # map client's IP address to RTT
+        else:  # otherwise set the RTT to infinity
+            measurements[dst_ip] = UNREACHABLE
+    return measurements
+
+
+class CpuSampler:
+    """
+    Keeps the average CPU usage over the last few seconds up to date in the
+    background, so that reading it doesn't take seconds of sampling.
+    """
+
+    def __init__(self, interval: float = 1.0, samples: int = 5):
+        """
+        :param interval: seconds each sample covers
+        :param samples: the number of samples the average is over
+        """
+
+        self.interval = interval
+        self.samples = deque(maxlen=samples)
+        self.stopped = threading.Event()
+
+    def start(self) -> "CpuSampler":
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            self.samples.append(psutil.cpu_percent(interval=self.interval))
+
+    def percent(self) -> float:
+        """
+        :return: the average CPU usage, 0 until the first sample is in
+        """
+
+        samples = list(self.samples)
+        return sum(samples) / len(samples) if samples else 0.0
+
+
+class RttTable:
+    """
+    This class represents the RTTs a replica measured to the clients, along with
+    when it measured them.
+
+    A client is only pinged again once its RTT is older than max_age, and clients
+    that are being pinged for another request aren't pinged twice, so the cost of
+    a request from the DNS server grows with the number of new or stale clients
+    in it rather than with the number of clients overall.
+    """
+
+    def __init__(self, ping: Callable[[list], dict] = scamper_ping, max_age: float = STALE_AFTER):
+        """
+        :param ping: measures the RTTs to a list of clients, e.g. a stub for benchmarks
+        :param max_age: seconds after which an RTT is measured again
+        """
+
+        self.ping = ping
+        self.max_age = max_age
+        self.rtts = {}  # client -> (RTT, when it was measured)
+        self.measuring = set()  # clients being pinged right now
+        self.pinged = 0
+        self.lock = threading.Lock()
+
+    def measure(self, clients: Iterable[str]) -> dict:
+        """
+        Pings the clients whose RTT is missing or stale.
+
+        :param clients: the client's IP addresses
+        :return: the RTT of every client that has one, including those that didn't need pinging
+        """
+
+        clients = list(clients)
+        now = time.monotonic()
+        with self.lock:
+            to_ping = [
+                client
+                for client in clients
+                if client not in self.measuring
+                and (client not in self.rtts or now - self.rtts[client][1] >= self.max_age)
+            ]
+            self.measuring.update(to_ping)
+
+        try:
+            results = self.ping(to_ping) if to_ping else {}
+        finally:
+            with self.lock:
+                self.measuring.difference_update(to_ping)
+
+        with self.lock:
+            for client in to_ping:
+                self.rtts[client] = results.get(client, UNREACHABLE), now
+            self.pinged += len(to_ping)
+            return {client: self.rtts[client][0] for client in clients if client in self.rtts}
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"clients": len(self.rtts), "pinged": self.pinged, "measuring": len(self.measuring)}
+
+
+class MeasurementCollector:
+    """
+    This class represents the DNS server's side of the active measurements.
+
+    There's a long-lived thread per replica, which every interval sends it the
+    probes of the networks it hasn't measured yet or whose RTT is older than
+    max_age, i.e. only the delta since last time, and merges the RTTs it gets
+    back into the best replica for each of those networks right away, without
+    waiting for the other replicas. RTTs from the other replicas are kept, so the
+    best replica for a network is always the best one among everything measured
+    so far.
+    """
+
+    def __init__(
+        self,
+        replicas: Iterable[str],
+        subnets: SubnetTable,
+        request: Callable[[str, list], dict],
+        interval: float = MEASUREMENT_INTERVAL,
+        max_age: float = STALE_AFTER,
+    ):
+        """
+        :param replicas: the http replica server's IP addresses
+        :param subnets: the networks the DNS server got queries from
+        :param request: asks a replica for the RTTs to a list of addresses, returns them by address
+        :param interval: seconds between two requests to a replica
+        :param max_age: seconds after which a network's RTT is requested again
+        """
+
+        self.replicas = list(replicas)
+        self.subnets = subnets
+        self.request = request
+        self.interval = interval
+        self.max_age = max_age
+        self.sent = 0
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self) -> "MeasurementCollector":
+        for replica in self.replicas:
+            threading.Thread(target=self.run, args=(replica,), daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def run(self, replica: str) -> None:
+        while not self.stopped.is_set():
+            self.measure(replica)
+            self.stopped.wait(self.interval)
+
+    def measure(self, replica: str) -> int:
+        """
+        Requests the RTTs that are due from a replica and merges them.
+
+        :return: the number of addresses requested
+        """
+
+        probes = self.subnets.due(replica, self.max_age)
+        if not probes:
+            return 0
+        try:
+            rtts = self.request(replica, probes)
+        except Exception as e:
+            log(f"Measurements from {replica} failed: {e!r}")  # e.g. the replica isn't up yet
+            return 0
+        self.subnets.merge(replica, rtts, UNREACHABLE)
+        with self.lock:
+            self.sent += len(probes)
+        return len(probes)
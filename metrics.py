@@ -0,0 +1,189 @@
+import math
+import os
+import threading
+from collections import defaultdict
+
+SUB_BUCKET_BITS = 4  # 16 buckets per power of two, i.e. values are recorded within about 6%
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+PERCENTILES = (50, 90, 95, 99, 99.9)
+PRUNE_THRESHOLD = 64  # number of per-thread shards after which the ones of threads that exited are folded
+
+
+def bucket_of(value: int) -> int:
+    """
+    :return: the bucket of a value in a log-linear histogram: values under SUB_BUCKETS
+    get a bucket each, and every power of two above that is split into SUB_BUCKETS
+    """
+    if value < SUB_BUCKETS:
+        return max(0, value)
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return ((shift + 1) << SUB_BUCKET_BITS) + (value >> shift) - SUB_BUCKETS
+
+
+def highest_in(bucket: int) -> int:
+    """
+    :return: the highest value that falls in a bucket
+    """
+    if bucket < SUB_BUCKETS:
+        return bucket
+    shift = (bucket >> SUB_BUCKET_BITS) - 1
+    return ((SUB_BUCKETS + (bucket & (SUB_BUCKETS - 1)) + 1) << shift) - 1
+
+
+class Histogram:
+    """
+    This class represents a latency histogram in the style of HdrHistogram: values
+    (in microseconds) are counted in log-linear buckets, so recording one is a dict
+    increment, and the percentiles come out within about 6% however skewed the
+    latencies are, in memory that only grows with the orders of magnitude they span.
+
+    It isn't thread-safe. Every thread records into its own (see Metrics), and
+    they're merged to be read.
+    """
+
+    def __init__(self):
+        self.counts = {}  # bucket -> number of values in it
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    def record(self, value: int) -> None:
+        bucket = bucket_of(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "Histogram") -> None:
+        for bucket, count in other.counts.copy().items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent: float) -> int:
+        """
+        :return: the value (in microseconds) under which percent of the values are, give or take a bucket
+        """
+        if not self.total:
+            return 0
+        rank = max(1, math.ceil(self.total * percent / 100))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(highest_in(bucket), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        """
+        :return: the count, mean, percentiles and max, in milliseconds
+        """
+        summary = {"count": self.total, "mean_ms": round(self.sum / self.total / 1000, 3) if self.total else 0.0}
+        for percent in PERCENTILES:
+            summary[f"p{percent:g}_ms"] = round(self.percentile(percent) / 1000, 3)
+        summary["max_ms"] = round(self.max / 1000, 3)
+        return summary
+
+
+class Shard:
+    """
+    The counters and histograms of one thread.
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.histograms = {}
+
+    def merge(self, other: "Shard") -> None:
+        for name, value in other.counters.copy().items():
+            self.counters[name] += value
+        for name, histogram in other.histograms.copy().items():
+            self.histograms.setdefault(name, Histogram()).merge(histogram)
+
+
+class Metrics:
+    """
+    This class represents the counters and latency histograms of a process.
+
+    Every thread counts and records into its own Shard, so that the hot path never
+    takes a lock or waits for another thread: a lock is only taken the first time a
+    thread records anything. Reading the metrics merges all the shards. The shards
+    of threads that exited (the threaded http server has one per connection) are
+    folded into one every now and then, so that they don't pile up.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = {}  # thread -> its Shard
+        self.retired = Shard()  # what the threads that exited recorded
+        self.prune_at = PRUNE_THRESHOLD
+        self.lock = threading.Lock()
+
+    def shard(self) -> Shard:
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = Shard()
+            with self.lock:
+                self.shards[threading.current_thread()] = shard
+                if len(self.shards) >= self.prune_at:
+                    self.prune()
+        return shard
+
+    def prune(self) -> None:
+        """
+        Folds the shards of the threads that exited. Holding self.lock.
+        """
+        for thread in [thread for thread in self.shards if not thread.is_alive()]:
+            self.retired.merge(self.shards.pop(thread))
+        self.prune_at = max(PRUNE_THRESHOLD, 2 * len(self.shards))
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.shard().counters[name] += amount
+
+    def observe(self, name: str, seconds: float) -> None:
+        """
+        Records a latency in the histogram called name.
+        """
+        histograms = self.shard().histograms
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.record(int(seconds * 1_000_000))
+
+    def snapshot(self) -> Shard:
+        """
+        :return: everything recorded so far, merged
+        """
+        snapshot = Shard()
+        with self.lock:
+            snapshot.merge(self.retired)
+            for shard in self.shards.values():
+                snapshot.merge(shard)
+        return snapshot
+
+    def reset(self) -> None:
+        """
+        Forgets everything, e.g. in a forked worker, which would count its parent's metrics again otherwise.
+        """
+        self.local = threading.local()
+        self.shards = {}
+        self.retired = Shard()
+        self.prune_at = PRUNE_THRESHOLD
+        self.lock = threading.Lock()
+
+
+def report(snapshot: Shard) -> dict:
+    """
+    :return: the counters and the summaries of the histograms of a snapshot, for /debug/metrics
+    """
+    return {
+        "counters": dict(sorted(snapshot.counters.items())),
+        "latency": {name: snapshot.histograms[name].summary() for name in sorted(snapshot.histograms)},
+    }
+
+
+# The metrics of this process
+METRICS = Metrics()
+os.register_at_fork(after_in_child=METRICS.reset)
@@ -0,0 +1,264 @@
+import contextlib
+import http.client
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+from metrics import METRICS
+
+# Errors that mean a pooled keep-alive connection went stale, i.e. the origin
+# closed it while it was sitting idle in the pool.
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    BrokenPipeError,
+    ConnectionResetError,
+    ConnectionAbortedError,
+)
+
+
+class OriginError(Exception):
+    """
+    Raised when the origin responds with anything other than a 200 (or the other statuses asked for).
+    """
+
+    def __init__(self, path: str, status: int, reason: str):
+        super().__init__(f"Origin responded to {path} with {status} {reason}")
+        self.path = path
+        self.status = status
+        self.reason = reason
+
+
+# What fetching an article raises when the origin (or a peer) can't be reached or won't give it
+FETCH_ERRORS = (OriginError, OSError, http.client.HTTPException)
+
+
+class OriginResponse:
+    """
+    A simple data object for a fully read origin response.
+    """
+
+    def __init__(self, status: int, headers: http.client.HTTPMessage, body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @property
+    def is_gzipped(self) -> bool:
+        return self.headers.get("Content-Encoding", "").strip().lower() == "gzip"
+
+
+class OriginConnectionPool:
+    """
+    A bounded pool of persistent HTTP/1.1 keep-alive connections to the origin.
+
+    Opening a new connection costs a DNS lookup and a TCP handshake to the origin,
+    which is a big chunk of the latency of a cache miss. Instead, connections are
+    returned to the pool after every request and reused by the next one.
+
+    At most pool_size connections are open at any time; callers block if all of
+    them are busy. Connections that sat idle for longer than idle_timeout are
+    closed instead of being reused, and a request that fails on a reused connection
+    (because the origin closed it in the meantime) is retried on a fresh one.
+    """
+
+    def __init__(
+        self,
+        origin_url: str,
+        pool_size: int = 8,
+        idle_timeout: float = 30.0,
+        retries: int = 1,
+        timeout: float = 10.0,
+        metric: str = "origin",
+    ):
+        parts = urlsplit(origin_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.base_path = parts.path.rstrip("/")
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        self.timeout = timeout
+        self.metric = metric  # prefix of the metrics of the requests, e.g. "origin.fetch" for their latency
+
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.idle = deque()  # (connection, time it was returned to the pool)
+
+        # Counters exposed through stats()
+        self.pool_hits = 0  # a request got an idle connection from the pool
+        self.pool_misses = 0  # a request had to open a new connection
+        self.expired = 0  # idle connections dropped for exceeding idle_timeout
+        self.stale_retries = 0  # requests retried because a reused connection was dead
+        self.requests = 0
+
+    def get(self, path: str, headers: dict = None, statuses: tuple = (http.HTTPStatus.OK,)) -> OriginResponse:
+        """
+        Sends a GET request to the origin over a pooled connection.
+
+        :param path: request path relative to the origin URL, e.g. an article name
+        :param headers: extra request headers
+        :param statuses: the statuses that aren't errors, e.g. a 304 for a conditional request
+        :return: the fully read response
+        :raises OriginError: if the origin responds with any other status
+        """
+        if not path.startswith("/"):
+            path = "/" + path
+        path = self.base_path + path
+
+        request_headers = {"Connection": "keep-alive"}
+        if headers:
+            request_headers.update(headers)
+
+        self.slots.acquire()
+        try:
+            start = time.perf_counter()
+            attempt = 0
+            while True:
+                connection, reused = self._checkout()
+                try:
+                    connection.request("GET", path, headers=request_headers)
+                    response = connection.getresponse()
+                    body = response.read()
+                except STALE_CONNECTION_ERRORS:
+                    connection.close()
+                    if not reused or attempt >= self.retries:
+                        raise
+                    attempt += 1
+                    with self.lock:
+                        self.stale_retries += 1
+                    continue
+                except BaseException:
+                    connection.close()
+                    raise
+
+                if response.will_close:
+                    connection.close()
+                else:
+                    self._checkin(connection)
+
+                with self.lock:
+                    self.requests += 1
+                METRICS.observe(f"{self.metric}.fetch", time.perf_counter() - start)
+                METRICS.count(f"{self.metric}.bytes", len(body))
+
+                if response.status not in statuses:
+                    raise OriginError(path, response.status, response.reason)
+                return OriginResponse(response.status, response.headers, body)
+        finally:
+            self.slots.release()
+
+    @contextlib.contextmanager
+    def stream(self, path: str, headers: dict = None, chunk_size: int = 64 * 1024):
+        """
+        Same as get(), but the body is read as it comes in, up to chunk_size bytes
+        at a time. The connection goes back to the pool only if the body was read
+        to the end.
+
+        :param chunk_size: the max number of bytes per chunk
+        :return: the response, whose body is an iterator over the chunks
+        :raises OriginError: if the origin responds with anything other than a 200
+        """
+        if not path.startswith("/"):
+            path = "/" + path
+        path = self.base_path + path
+
+        request_headers = {"Connection": "keep-alive"}
+        if headers:
+            request_headers.update(headers)
+
+        self.slots.acquire()
+        try:
+            start = time.perf_counter()
+            attempt = 0
+            while True:
+                connection, reused = self._checkout()
+                try:
+                    connection.request("GET", path, headers=request_headers)
+                    response = connection.getresponse()
+                    break
+                except STALE_CONNECTION_ERRORS:
+                    connection.close()
+                    if not reused or attempt >= self.retries:
+                        raise
+                    attempt += 1
+                    with self.lock:
+                        self.stale_retries += 1
+                except BaseException:
+                    connection.close()
+                    raise
+
+            with self.lock:
+                self.requests += 1
+
+            try:
+                if response.status != http.HTTPStatus.OK:
+                    response.read()
+                    raise OriginError(path, response.status, response.reason)
+                yield OriginResponse(response.status, response.headers, self._read_chunks(response, chunk_size))
+            finally:
+                if response.isclosed() and not response.will_close:
+                    self._checkin(connection)  # the body was read to the end
+                else:
+                    connection.close()
+                METRICS.observe(f"{self.metric}.fetch", time.perf_counter() - start)
+        finally:
+            self.slots.release()
+
+    def _read_chunks(self, response: http.client.HTTPResponse, chunk_size: int):
+        """
+        :return: an iterator over the body of a response, as it comes in
+        :raises http.client.IncompleteRead: if the origin closes the connection before the end of the body
+        """
+        while True:
+            chunk = response.read1(chunk_size)
+            if not chunk:
+                break
+            METRICS.count(f"{self.metric}.bytes", len(chunk))
+            yield chunk
+        # Unlike read(), read1() takes the connection being closed early for the end of the body
+        if response.length:
+            raise http.client.IncompleteRead(b"", response.length)
+
+    def _checkout(self) -> (http.client.HTTPConnection, bool):
+        """
+        :return: a connection to the origin and whether it was reused from the pool
+        """
+        now = time.monotonic()
+        with self.lock:
+            while self.idle:
+                connection, returned_at = self.idle.pop()  # most recently used first
+                if now - returned_at <= self.idle_timeout:
+                    self.pool_hits += 1
+                    return connection, True
+                self.expired += 1
+                connection.close()
+            self.pool_misses += 1
+
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+
+    def _checkin(self, connection: http.client.HTTPConnection):
+        with self.lock:
+            self.idle.append((connection, time.monotonic()))
+
+    def stats(self) -> dict:
+        """
+        :return: pool hit/miss and connection reuse counters
+        """
+        with self.lock:
+            return {
+                "pool_size": self.pool_size,
+                "idle_connections": len(self.idle),
+                "requests": self.requests,
+                "pool_hits": self.pool_hits,
+                "pool_misses": self.pool_misses,
+                "expired": self.expired,
+                "stale_retries": self.stale_retries,
+            }
+
+    def close(self):
+        with self.lock:
+            while self.idle:
+                connection, _ = self.idle.pop()
+                connection.close()
@@ -0,0 +1,149 @@
+import hashlib
+import http
+import threading
+import time
+from typing import Iterable, Optional
+
+from origin import OriginConnectionPool, OriginError, OriginResponse
+from ringlog import log
+
+PEER_HEADER = "X-Replica-Peer"  # marks requests from another replica, which are never passed on
+PEER_ADMISSION = 2.0  # how many times the views of its victims an article owned by a peer needs to get cached
+PEER_TIMEOUT = 2.0  # seconds to wait for a peer before going to the origin instead
+PEER_RETRY_AFTER = 10.0  # seconds a peer that failed is left alone
+
+
+def rendezvous_owner(article: str, peers: Iterable[str]) -> str:
+    """
+    Picks the owner of an article with rendezvous (highest random weight) hashing:
+    every peer gets a score for the article and the highest one wins. When a peer
+    comes or goes, only the articles it owned move, and everyone agrees on the owner
+    without talking to each other.
+
+    :param article: the name of the article
+    :param peers: the URLs of the replicas
+    :return: the URL of the owner
+    """
+
+    def score(peer: str) -> int:
+        digest = hashlib.blake2b(f"{peer}/{article}".encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big")
+
+    return max(peers, key=score)
+
+
+class PeerGroup:
+    """
+    This class represents the replicas filling their caches from each other.
+
+    Every article has an owner among the replicas (see rendezvous_owner). On a
+    miss, a replica asks the owner for the article before going to the origin.
+    The owner serves it like any other request, already gzipped, and fetches it
+    from the origin if it doesn't have it either, so the origin sees about one
+    request per article for the whole fleet instead of one per replica. Requests
+    from peers carry PEER_HEADER and the owner never passes them on, so they can't
+    go around in circles.
+
+    A peer that times out or fails is left alone for retry_after seconds, so a
+    replica that's down costs one timeout rather than one per miss.
+    """
+
+    def __init__(
+        self,
+        peer_urls: Iterable[str],
+        self_url: str,
+        pool_size: int = 4,
+        timeout: float = PEER_TIMEOUT,
+        retry_after: float = PEER_RETRY_AFTER,
+        admission: float = PEER_ADMISSION,
+    ):
+        """
+        :param peer_urls: the URLs of all the replicas, this one included
+        :param self_url: the URL of this replica, as it appears in peer_urls
+        :param pool_size: max number of keep-alive connections to each peer
+        :param timeout: seconds to wait for a peer
+        :param retry_after: seconds a peer that failed is left alone
+        :param admission: see PEER_ADMISSION
+        """
+
+        self.peer_urls = sorted(set(peer_urls) | {self_url})
+        self.self_url = self_url
+        self.retry_after = retry_after
+        self.admission = admission
+        self.pools = {
+            url: OriginConnectionPool(url, pool_size=pool_size, timeout=timeout, metric="peer")
+            for url in self.peer_urls
+            if url != self_url
+        }
+        self.down_until = {}  # URL of a peer that failed -> when to try it again
+        self.lock = threading.Lock()
+
+        self.hits = 0  # misses a peer had the article for
+        self.owned = 0  # misses for articles this replica owns, which go to the origin
+        self.failures = 0  # peers that timed out or failed
+        self.skipped = 0  # misses that skipped a peer because it recently failed
+
+    def owner(self, article: str) -> str:
+        """
+        :return: the URL of the replica that owns an article
+        """
+
+        # Not memoized: it's one hash per replica, and any path can be requested
+        return rendezvous_owner(article, self.peer_urls)
+
+    def is_owner(self, article: str) -> bool:
+        return self.owner(article) == self.self_url
+
+    def fetch(self, article: str) -> Optional[OriginResponse]:
+        """
+        Asks the owner of an article for it.
+
+        :param article: the name of the article
+        :return: the owner's response with the gzipped article, or None if this replica owns it or the owner
+        couldn't help
+        """
+
+        owner = self.owner(article)
+        if owner == self.self_url:
+            with self.lock:
+                self.owned += 1
+            return None
+
+        with self.lock:
+            if time.monotonic() < self.down_until.get(owner, 0):
+                self.skipped += 1
+                return None
+
+        try:
+            response = self.pools[owner].get(article, {"Accept-Encoding": "gzip", PEER_HEADER: "1"})
+        except OriginError as e:
+            if e.status != http.HTTPStatus.NOT_FOUND:
+                self.failed(owner, e)
+            return None
+        except OSError as e:  # e.g. the peer is down or timed out
+            self.failed(owner, e)
+            return None
+
+        if not response.is_gzipped:
+            return None
+        with self.lock:
+            self.hits += 1
+        return response
+
+    def failed(self, peer: str, error: Exception) -> None:
+        log(f"Peer {peer} failed: {error!r}")
+        with self.lock:
+            self.failures += 1
+            self.down_until[peer] = time.monotonic() + self.retry_after
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "self": self.self_url,
+                "peers": len(self.pools),
+                "hits": self.hits,
+                "owned": self.owned,
+                "failures": self.failures,
+                "skipped": self.skipped,
+                "down": sorted(peer for peer, until in self.down_until.items() if until > time.monotonic()),
+            }
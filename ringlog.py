@@ -0,0 +1,142 @@
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+LOG_CAPACITY = 10000  # lines kept for /debug/logs, and max lines waiting to be written out
+LOG_RATE = 200  # max lines written out per second, the rest only make it to the ring
+FLUSH_INTERVAL = 0.5  # seconds between writes
+
+
+def format_lines(lines: list) -> str:
+    """
+    :param lines: (sequence number, time, message) of the lines
+    :return: the lines as text
+    """
+    return "".join(
+        f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(logged_at))} {message}\n"
+        for _, logged_at, message in lines
+    )
+
+
+class RingLog:
+    """
+    This class represents the log of a process, kept in memory and written out in
+    the background.
+
+    Logging a line appends it to two bounded deques, which is all the caller pays
+    for: no lock, no write and no flush. One is the ring of the last capacity lines,
+    which /debug/logs reads. The other holds the lines waiting to be written to
+    stdout, which a background thread does every interval seconds, up to rate lines
+    per second. Lines over the rate, or that fell off the end of the deque because
+    the writer couldn't keep up, aren't written out, and a line saying how many
+    there were is written instead, so a burst of logging can't slow down requests
+    or fill up the disk.
+    """
+
+    def __init__(
+        self, capacity: int = LOG_CAPACITY, rate: int = LOG_RATE, interval: float = FLUSH_INTERVAL, out=None
+    ):
+        """
+        :param capacity: max number of lines kept in the ring, and waiting to be written out
+        :param rate: max number of lines written out per second
+        :param interval: seconds between writes
+        :param out: where to write the lines to, defaults to stdout
+        """
+
+        self.capacity = capacity
+        self.rate = rate
+        self.interval = interval
+        self.out = out
+        self.lines = deque(maxlen=capacity)
+        self.pending = deque(maxlen=capacity)
+        self.sequence = itertools.count()
+        self.written = -1  # the sequence number of the last line written out (or dropped)
+        self.dropped = 0
+        self.thread = None
+        self.lock = threading.Lock()  # only taken by the writers
+
+    def log(self, message: str) -> None:
+        line = (next(self.sequence), time.time(), message)
+        self.lines.append(line)
+        self.pending.append(line)
+
+    def start(self) -> "RingLog":
+        """
+        Starts writing the lines out in the background, unless it already does.
+        """
+
+        if self.thread is not None and self.thread.is_alive():
+            return self
+        self.thread = threading.Thread(target=self.flush_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def flush_forever(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes out the lines logged since the last time, as many as the rate allows.
+        """
+
+        with self.lock:
+            budget = max(1, int(self.rate * self.interval))
+            out = self.out or sys.stdout
+            written, dropped = [], 0
+            while self.pending:
+                line = self.pending.popleft()
+                dropped += line[0] - self.written - 1  # fell off the end of the deque
+                self.written = line[0]
+                if len(written) < budget:
+                    written.append(line)
+                else:
+                    dropped += 1
+
+            if not written and not dropped:
+                return
+            self.dropped += dropped
+            text = format_lines(written)
+            if dropped:
+                text += f"{dropped} log lines dropped, over {self.rate} lines per second\n"
+            try:
+                out.write(text)
+                out.flush()
+            except (OSError, ValueError):
+                pass  # e.g. stdout is closed
+
+    def tail(self) -> list:
+        """
+        :return: the (sequence number, time, message) of the lines in the ring, oldest first
+        """
+
+        return list(self.lines.copy())
+
+    def after_fork(self) -> None:
+        """
+        Forgets the parent's lines and restarts the writer, in a forked child.
+        """
+
+        self.lines.clear()
+        self.pending.clear()
+        self.sequence = itertools.count()
+        self.written = -1
+        self.lock = threading.Lock()
+        if self.thread is not None:
+            self.start()
+
+
+# The log of this process
+LOG = RingLog()
+os.register_at_fork(after_in_child=LOG.after_fork)
+
+
+def log(message: str) -> None:
+    """
+    Logs a line, without waiting for it to be written out.
+    """
+    LOG.log(message)
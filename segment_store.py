@@ -0,0 +1,517 @@
+import mmap
+import os
+import struct
+import threading
+import zlib
+from typing import BinaryIO
+
+from ringlog import log
+
+# Every record in a segment is a header followed by the key and the value.
+# A value length of TOMBSTONE marks a deleted key and has no value bytes.
+RECORD_HEADER = struct.Struct("<IHI")  # crc32 of key + value, key length, value length
+TOMBSTONE = 0xFFFFFFFF
+
+INDEX_MAGIC = b"RCIX"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<4sHII")  # magic, version, number of segments, number of entries
+INDEX_SEGMENT = struct.Struct("<IQ")  # segment id, size of the segment at checkpoint time
+INDEX_ENTRY = struct.Struct("<HIQI")  # key length, segment id, value offset, value length
+INDEX_CHECKSUM = struct.Struct("<I")
+
+INDEX_FILE = "index"
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+
+
+class SegmentStore:
+    """
+    A log-structured key-value store on disk: the disk tier of the cache.
+
+    Instead of one file per article, values are appended to a handful of segment
+    files and a compact index maps every key to (segment, offset, length). The index
+    is checkpointed to a single file, so opening the store costs one read of the index
+    plus one open per segment, no matter how many articles are in it.
+
+    Reads are served from memory maps of the segments. Segments are append-only, so a
+    region that has been handed out is never overwritten and the slices are zero-copy.
+
+    Deleting a key appends a tombstone and leaves a dead record behind. A background
+    thread compacts segments that are mostly dead by copying their live records to the
+    end of the log and removing them, and it checkpoints the index periodically.
+
+    Checkpoints are written to a temporary file and renamed over the old index, so a
+    crash never leaves a half written index. On startup, records appended after the
+    last checkpoint are recovered by scanning the tail of each segment, and a torn
+    record at the end of a segment (detected by its checksum) is truncated away.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_size: int = 1024 * 1024,
+        compaction_threshold: float = 0.25,
+        checkpoint_interval: float = 30.0,
+        background: bool = True,
+    ):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compaction_threshold = compaction_threshold
+        self.checkpoint_interval = checkpoint_interval
+
+        self.lock = threading.RLock()
+        self.index = {}  # key -> (segment id, value offset, value length)
+        self.segment_sizes = {}  # segment id -> size of the segment file
+        self.dead_bytes = {}  # segment id -> bytes taken by deleted or overwritten records
+        self.maps = {}  # segment id -> mmap of the segment
+        self.live_bytes = 0
+        self.dirty = False
+        self.compactions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+        self.active_id = max(self.segment_sizes, default=0)
+        if self.active_id:
+            self.active_file = open(self.segment_path(self.active_id), "ab")
+        else:
+            self.roll_over()
+
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+        self.background_thread = None
+        if background:
+            self.start()
+
+    def start(self):
+        """
+        Starts compacting and checkpointing in the background, if it wasn't started with background on.
+        """
+
+        self.background_thread = threading.Thread(target=self.run_background, daemon=True)
+        self.background_thread.start()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def keys(self) -> list:
+        with self.lock:
+            return list(self.index)
+
+    def length(self, key: str) -> int:
+        return self.index[key][2]
+
+    def segment_path(self, segment_id: int) -> str:
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{segment_id:06d}{SEGMENT_SUFFIX}")
+
+    def locate(self, key: str) -> (str, int, int):
+        """
+        :return: the path of the segment holding the key, and the offset and length of the value in it
+        :raises KeyError: if the key isn't in the store
+        """
+        with self.lock:
+            segment_id, offset, length = self.index[key]
+            if segment_id == self.active_id:
+                # So that other processes reading the file see the value
+                self.active_file.flush()
+            return self.segment_path(segment_id), offset, length
+
+    def open(self, key: str) -> (BinaryIO, int, int):
+        """
+        Opens the segment holding the key, e.g. to sendfile() the value straight to a socket.
+        The open file stays readable even if the segment gets compacted away in the meantime.
+
+        :return: the open segment file, and the offset and length of the value in it
+        :raises KeyError: if the key isn't in the store
+        """
+        with self.lock:
+            segment_id, offset, length = self.index[key]
+            if segment_id == self.active_id:
+                self.active_file.flush()
+            return open(self.segment_path(segment_id), "rb"), offset, length
+
+    def read(self, key: str) -> memoryview:
+        """
+        :return: a zero-copy slice of the value
+        :raises KeyError: if the key isn't in the store
+        """
+        with self.lock:
+            segment_id, offset, length = self.index[key]
+            segment_map = self.maps.get(segment_id)
+            if segment_map is None or len(segment_map) < offset + length:
+                if segment_id == self.active_id:
+                    self.active_file.flush()
+                segment_map = self.map_segment(segment_id)
+            return memoryview(segment_map)[offset : offset + length]
+
+    def put(self, key: str, value: bytes):
+        """
+        Appends a value to the log. If the key was already in the store, the old value becomes dead.
+        """
+        with self.lock:
+            self.forget(key)
+            if self.segment_sizes[self.active_id] >= self.segment_size:
+                self.roll_over()
+
+            encoded_key = key.encode()
+            checksum = zlib.crc32(value, zlib.crc32(encoded_key))
+            header = RECORD_HEADER.pack(checksum, len(encoded_key), len(value))
+            record_offset = self.segment_sizes[self.active_id]
+            self.active_file.write(header + encoded_key)
+            self.active_file.write(value)
+
+            value_offset = record_offset + RECORD_HEADER.size + len(encoded_key)
+            self.index[key] = (self.active_id, value_offset, len(value))
+            self.segment_sizes[self.active_id] = value_offset + len(value)
+            self.live_bytes += len(value)
+            self.dirty = True
+
+    def delete(self, key: str) -> int:
+        """
+        Appends a tombstone for the key so that the deletion survives a restart.
+
+        :return: the length of the deleted value, 0 if the key wasn't in the store
+        """
+        with self.lock:
+            existed = key in self.index
+            length = self.forget(key)
+            if existed:
+                encoded_key = key.encode()
+                header = RECORD_HEADER.pack(zlib.crc32(encoded_key), len(encoded_key), TOMBSTONE)
+                self.active_file.write(header + encoded_key)
+                self.segment_sizes[self.active_id] += len(header) + len(encoded_key)
+                self.dead_bytes[self.active_id] += len(header) + len(encoded_key)
+                self.dirty = True
+            if self.dead_ratio() >= self.compaction_threshold:
+                self.wakeup.set()
+            return length
+
+    def forget(self, key: str) -> int:
+        """
+        Drops a key from the index and marks its record as dead.
+
+        :return: the length of the value that was dropped, 0 if the key wasn't in the store
+        """
+        location = self.index.pop(key, None)
+        if location is None:
+            return 0
+
+        segment_id, value_offset, length = location
+        self.dead_bytes[segment_id] += self.record_size(key, length)
+        self.live_bytes -= length
+        self.dirty = True
+        return length
+
+    def size_on_disk(self) -> int:
+        """
+        :return: the size of all the segments, dead records and tombstones included, and of the index
+        """
+        with self.lock:
+            index_size = (
+                INDEX_HEADER.size
+                + len(self.segment_sizes) * INDEX_SEGMENT.size
+                + sum(self.index_entry_size(key) for key in self.index)
+                + INDEX_CHECKSUM.size
+            )
+            return sum(self.segment_sizes.values()) + index_size
+
+    def dead_size(self) -> int:
+        """
+        :return: the bytes taken by dead records and tombstones, which compacting reclaims
+        """
+        with self.lock:
+            return sum(self.dead_bytes.values())
+
+    @staticmethod
+    def record_size(key: str, length: int) -> int:
+        """
+        :return: the bytes a record with a value of the given length takes in a segment,
+        or a tombstone with a length of 0
+        """
+        return RECORD_HEADER.size + len(key.encode()) + length
+
+    @staticmethod
+    def index_entry_size(key: str) -> int:
+        """
+        :return: the bytes the key takes in the checkpointed index
+        """
+        return INDEX_ENTRY.size + len(key.encode())
+
+    def dead_ratio(self) -> float:
+        size = sum(self.segment_sizes.values())
+        return sum(self.dead_bytes.values()) / size if size else 0.0
+
+    def roll_over(self):
+        """
+        Seals the active segment and starts appending to a new one.
+        """
+        if self.active_id:
+            self.active_file.close()
+        self.active_id += 1
+        self.segment_sizes[self.active_id] = 0
+        self.dead_bytes[self.active_id] = 0
+        self.active_file = open(self.segment_path(self.active_id), "ab")
+
+    def map_segment(self, segment_id: int) -> mmap.mmap:
+        """
+        (Re)maps a segment. Older maps of the segment stay alive for as long as
+        someone holds a slice of them.
+        """
+        with open(self.segment_path(segment_id), "rb") as segment_file:
+            segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps[segment_id] = segment_map
+        return segment_map
+
+    def compact(self, force: bool = False) -> int:
+        """
+        Copies the live records of sealed segments that are mostly dead (or all
+        sealed segments, if forced) to the end of the log and removes those segments.
+
+        :return: the number of bytes reclaimed
+        """
+        with self.lock:
+            victims = [
+                segment_id
+                for segment_id, size in self.segment_sizes.items()
+                if segment_id != self.active_id
+                and size
+                and (force or self.dead_bytes[segment_id] / size >= self.compaction_threshold)
+            ]
+            return self.compact_segments(victims)
+
+    def reclaim(self, needed: int = None) -> int:
+        """
+        Compacts the segments with the most dead bytes first, however few they have,
+        until at least needed bytes are reclaimed (or all of them). The active segment
+        is sealed first if that's where the dead bytes are.
+
+        :return: the number of bytes reclaimed
+        """
+        with self.lock:
+            if self.dead_bytes[self.active_id] and (
+                needed is None or self.dead_size() - self.dead_bytes[self.active_id] < needed
+            ):
+                self.roll_over()
+
+            victims = []
+            reclaimable = 0
+            for segment_id in sorted(self.dead_bytes, key=self.dead_bytes.get, reverse=True):
+                if segment_id == self.active_id or not self.dead_bytes[segment_id]:
+                    continue
+                if needed is not None and reclaimable >= needed:
+                    break
+                victims.append(segment_id)
+                reclaimable += self.dead_bytes[segment_id]
+            return self.compact_segments(victims)
+
+    def compact_segments(self, victims: list) -> int:
+        """
+        Copies the live records of the given sealed segments to the end of the log and
+        removes the segments one at a time, so that the store never takes up more than
+        one segment's worth of extra space while it's at it.
+
+        :return: the number of bytes reclaimed
+        """
+        with self.lock:
+            if not victims:
+                return 0
+
+            reclaimed = 0
+            for segment_id in victims:
+                segment_map = self.map_segment(segment_id)
+                live_keys = [key for key, location in self.index.items() if location[0] == segment_id]
+                for key in live_keys:
+                    _, offset, length = self.index[key]
+                    self.put(key, segment_map[offset : offset + length])
+
+                reclaimed += self.segment_sizes.pop(segment_id) - sum(
+                    self.record_size(key, self.index[key][2]) for key in live_keys
+                )
+                del self.dead_bytes[segment_id]
+                # Outstanding slices keep the old map (and thus the unlinked file) alive
+                self.maps.pop(segment_id, None)
+
+                # The index mustn't refer to the segment anymore by the time it's gone
+                self.checkpoint()
+                os.remove(self.segment_path(segment_id))
+
+            self.compactions += 1
+            return reclaimed
+
+    def checkpoint(self):
+        """
+        Atomically replaces the index file with the current index.
+        """
+        with self.lock:
+            self.active_file.flush()
+            os.fsync(self.active_file.fileno())
+
+            parts = [INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(self.segment_sizes), len(self.index))]
+            for segment_id, size in sorted(self.segment_sizes.items()):
+                parts.append(INDEX_SEGMENT.pack(segment_id, size))
+            for key, (segment_id, offset, length) in self.index.items():
+                encoded_key = key.encode()
+                parts.append(INDEX_ENTRY.pack(len(encoded_key), segment_id, offset, length))
+                parts.append(encoded_key)
+            data = b"".join(parts)
+            data += INDEX_CHECKSUM.pack(zlib.crc32(data))
+
+            index_path = os.path.join(self.directory, INDEX_FILE)
+            with open(index_path + ".tmp", "wb") as index_file:
+                index_file.write(data)
+                index_file.flush()
+                os.fsync(index_file.fileno())
+            os.replace(index_path + ".tmp", index_path)
+            self.dirty = False
+
+    def load(self):
+        """
+        Loads the last checkpoint of the index and replays whatever was appended
+        to the segments after it. Without a usable checkpoint, all segments are replayed.
+        """
+        segment_ids = sorted(
+            int(name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        )
+        for segment_id in segment_ids:
+            self.segment_sizes[segment_id] = os.path.getsize(self.segment_path(segment_id))
+            self.dead_bytes[segment_id] = 0
+
+        checkpointed_sizes = self.load_checkpoint()
+        if checkpointed_sizes is None or any(
+            self.segment_sizes.get(segment_id, -1) < size for segment_id, size in checkpointed_sizes.items()
+        ):
+            # No checkpoint, or it refers to data that isn't there anymore
+            self.index = {}
+            checkpointed_sizes = {}
+
+        for key, (segment_id, _, length) in self.index.items():
+            self.live_bytes += length
+
+        for segment_id in segment_ids:
+            self.replay(segment_id, checkpointed_sizes.get(segment_id, 0))
+
+        # Whatever isn't referenced by the index is dead
+        live_per_segment = {segment_id: 0 for segment_id in segment_ids}
+        for key, (segment_id, _, length) in self.index.items():
+            live_per_segment[segment_id] += self.record_size(key, length)
+        for segment_id in segment_ids:
+            self.dead_bytes[segment_id] = self.segment_sizes[segment_id] - live_per_segment[segment_id]
+
+    def load_checkpoint(self):
+        """
+        :return: the size of every segment at checkpoint time, or None if there's no valid checkpoint
+        """
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE), "rb") as index_file:
+                data = index_file.read()
+        except FileNotFoundError:
+            return None
+
+        if len(data) < INDEX_HEADER.size + INDEX_CHECKSUM.size:
+            return None
+        (checksum,) = INDEX_CHECKSUM.unpack_from(data, len(data) - INDEX_CHECKSUM.size)
+        if zlib.crc32(data[: -INDEX_CHECKSUM.size]) != checksum:
+            return None
+
+        magic, version, segment_count, entry_count = INDEX_HEADER.unpack_from(data, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            return None
+
+        position = INDEX_HEADER.size
+        checkpointed_sizes = {}
+        for _ in range(segment_count):
+            segment_id, size = INDEX_SEGMENT.unpack_from(data, position)
+            checkpointed_sizes[segment_id] = size
+            position += INDEX_SEGMENT.size
+
+        for _ in range(entry_count):
+            key_length, segment_id, offset, length = INDEX_ENTRY.unpack_from(data, position)
+            position += INDEX_ENTRY.size
+            key = data[position : position + key_length].decode()
+            position += key_length
+            self.index[key] = (segment_id, offset, length)
+
+        return checkpointed_sizes
+
+    def replay(self, segment_id: int, position: int):
+        """
+        Applies the records of a segment from position onwards to the index,
+        truncating the segment at the first torn or corrupt record.
+        """
+        size = self.segment_sizes[segment_id]
+        if position >= size:
+            return
+
+        with open(self.segment_path(segment_id), "rb") as segment_file:
+            segment_file.seek(position)
+            data = segment_file.read()
+
+        cursor = 0
+        while cursor + RECORD_HEADER.size <= len(data):
+            checksum, key_length, value_length = RECORD_HEADER.unpack_from(data, cursor)
+            key_start = cursor + RECORD_HEADER.size
+            value_start = key_start + key_length
+            value_end = value_start if value_length == TOMBSTONE else value_start + value_length
+            if value_end > len(data):
+                break
+            if zlib.crc32(data[value_start:value_end], zlib.crc32(data[key_start:value_start])) != checksum:
+                break
+
+            key = data[key_start:value_start].decode()
+            location = self.index.pop(key, None)
+            if location is not None:
+                self.live_bytes -= location[2]
+            if value_length != TOMBSTONE:
+                self.index[key] = (segment_id, position + value_start, value_length)
+                self.live_bytes += value_length
+            cursor = value_end
+
+        if position + cursor < size:
+            log(f"Truncating torn tail of segment {segment_id} at {position + cursor}")
+            os.truncate(self.segment_path(segment_id), position + cursor)
+            self.segment_sizes[segment_id] = position + cursor
+        self.dirty = True
+
+    def run_background(self):
+        """
+        Compacts segments and checkpoints the index every checkpoint_interval seconds,
+        or as soon as deletions push the share of dead bytes over the compaction threshold.
+        """
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.checkpoint_interval)
+            self.wakeup.clear()
+            if self.stopped.is_set():
+                break
+            try:
+                with self.lock:
+                    if self.dead_ratio() >= self.compaction_threshold and self.dead_bytes[self.active_id]:
+                        self.roll_over()  # so that the active segment can be compacted as well
+                    if not self.compact() and self.dirty:
+                        self.checkpoint()
+            except OSError as e:
+                log(f"Disk store maintenance failed: {e}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "keys": len(self.index),
+                "segments": len(self.segment_sizes),
+                "live_bytes": self.live_bytes,
+                "dead_bytes": sum(self.dead_bytes.values()),
+                "size_on_disk": self.size_on_disk(),
+                "compactions": self.compactions,
+            }
+
+    def close(self):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.background_thread is not None:
+            self.background_thread.join()
+        with self.lock:
+            self.checkpoint()
+            self.active_file.close()
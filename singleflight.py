@@ -0,0 +1,73 @@
+import threading
+from typing import Any, Callable, Hashable
+
+
+class _Call:
+    """
+    A simple data object that represents a piece of work that is currently
+    in flight, along with its outcome once it completes.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key so that the work only runs once.
+
+    The first caller for a key becomes the leader and runs the function. Everyone
+    else that asks for the same key while the leader is busy blocks until it is
+    done and gets the very same result (or exception). Once the call completes,
+    the key is forgotten, so the next call runs the function again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """
+        Runs fn once for all concurrent callers asking for the same key.
+
+        :param key: identifies the piece of work, e.g. an article name
+        :param fn: the function to run if no call for the key is in flight
+        :return: the return value of fn
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = _Call()
+                self.calls[key] = call
+                leader = True
+            else:
+                call.waiters += 1
+                leader = False
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+        return call.result
+
+    def in_flight(self) -> int:
+        """
+        :return: the number of keys that currently have a call in flight
+        """
+        with self.lock:
+            return len(self.calls)
@@ -0,0 +1,145 @@
+import threading
+
+STREAM_CHUNK_SIZE = 64 * 1024  # bytes read from the origin at a time on the streaming miss path
+
+
+class ArticleStream:
+    """
+    This class represents an article that is being fetched, compressed and cached
+    on a miss, as it comes in.
+
+    One thread writes the compressed bytes as they're produced and every request for
+    the article reads them, from the start, while that's still going on. So the first
+    request doesn't wait for the whole article to be fetched and compressed before it
+    gets the first byte, and requests that come in later attach to the same fetch and
+    catch up. The bytes are kept, since they're what gets cached once the article is
+    complete. If the fetch fails, the readers get the error instead of the rest.
+
+    Readers that can't block, e.g. on an event loop, subscribe a callback that's
+    called whenever there's something new, and read with read_nowait().
+    """
+
+    def __init__(self, article: str):
+        self.article = article
+        self.buffer = bytearray()
+        self.started = False  # whether anything was written, or the stream ended
+        self.done = False
+        self.error = None
+        self.freshness = None  # set before the first bytes are written, once the response is in
+        self.condition = threading.Condition()
+        self.listeners = []  # called from the writer's thread whenever there's something new
+
+    def write(self, chunk: bytes) -> None:
+        if not chunk:
+            return
+        with self.condition:
+            self.buffer += chunk
+            self.started = True
+            self.condition.notify_all()
+        self.notify()
+
+    def finish(self) -> None:
+        with self.condition:
+            self.done = self.started = True
+            self.condition.notify_all()
+        self.notify()
+
+    def fail(self, error: BaseException) -> None:
+        with self.condition:
+            self.error = error
+            self.done = self.started = True
+            self.condition.notify_all()
+        self.notify()
+
+    def subscribe(self, listener) -> None:
+        with self.condition:
+            self.listeners.append(listener)
+
+    def unsubscribe(self, listener) -> None:
+        with self.condition:
+            self.listeners.remove(listener)
+
+    def notify(self) -> None:
+        with self.condition:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+
+    def wait_started(self) -> None:
+        """
+        Waits for the first bytes, so that e.g. a 404 from the origin can still be
+        answered as such.
+
+        :raises: the error the fetch failed with, if it failed before writing anything
+        """
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.started)
+            if self.error is not None and not self.buffer:
+                raise self.error
+
+    def has_started(self) -> bool:
+        """
+        Same as wait_started(), without waiting.
+
+        :return: whether there are bytes to read, or the stream ended
+        :raises: the error the fetch failed with, if it failed before writing anything
+        """
+
+        with self.condition:
+            if self.error is not None and not self.buffer:
+                raise self.error
+            return self.started
+
+    def read_from(self, offset: int) -> bytes:
+        """
+        Waits for the bytes past offset.
+
+        :return: the bytes past offset, or b"" once there are no more
+        :raises: the error the fetch failed with
+        """
+
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.buffer) > offset or self.done)
+            if len(self.buffer) > offset:
+                return bytes(self.buffer[offset:])
+            if self.error is not None:
+                raise self.error
+            return b""
+
+    def read_nowait(self, offset: int) -> bytes:
+        """
+        Same as read_from(), without waiting.
+
+        :return: the bytes past offset, b"" once there are no more, or None if there are none yet
+        :raises: the error the fetch failed with
+        """
+
+        with self.condition:
+            if len(self.buffer) > offset:
+                return bytes(self.buffer[offset:])
+            if not self.done:
+                return None
+            if self.error is not None:
+                raise self.error
+            return b""
+
+    def chunks(self):
+        """
+        :return: an iterator over the bytes of the article as they come in
+        """
+
+        offset = 0
+        while True:
+            chunk = self.read_from(offset)
+            if not chunk:
+                return
+            offset += len(chunk)
+            yield chunk
+
+    def read(self) -> bytes:
+        """
+        Waits for the whole article, e.g. for clients that need it decompressed.
+        """
+
+        return b"".join(self.chunks())
@@ -0,0 +1,254 @@
+import ipaddress
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Optional
+
+IPV4_UNIT = 24  # prefix length of the networks IPv4 clients are grouped in
+IPV6_UNIT = 48  # same for IPv6
+SUBNET_TABLE_SIZE = 65536  # max number of networks to keep track of
+SUBNET_TTL = 3600.0  # seconds after which a network that sent no queries is forgotten
+
+ECS_OPTION = 8  # the EDNS option code of EDNS Client Subnet (RFC 7871)
+ECS_FAMILIES = {1: 4, 2: 6}  # address family number -> IP version
+ECS_HEADER_SIZE = 4  # family, source prefix length and scope prefix length
+EDNS_UDP_SIZE = 1232  # the UDP payload size advertised in replies with an OPT record
+
+
+@dataclass
+class ClientSubnet:
+    """
+    A simple data class that represents the EDNS Client Subnet option of a query.
+    """
+
+    family: int
+    source_prefix_len: int
+    address: bytes  # as sent, i.e. only as many bytes as the source prefix length needs
+
+    @cached_property
+    def network(self) -> Optional[ipaddress.ip_network]:
+        """
+        :return: the client's network, None if the resolver doesn't want it to be used
+        """
+
+        if not self.source_prefix_len:
+            return None
+        size = 4 if ECS_FAMILIES[self.family] == 4 else 16
+        address = ipaddress.ip_address(self.address.ljust(size, b"\x00"))
+        return ipaddress.ip_network(f"{address}/{self.source_prefix_len}", strict=False)
+
+
+def parse_client_subnet(data: bytes) -> Optional[ClientSubnet]:
+    """
+    :param data: the data of an EDNS Client Subnet option
+    :return: the option, or None if it's malformed
+    """
+
+    if len(data) < ECS_HEADER_SIZE:
+        return None
+    family, source_prefix_len, _ = struct.unpack_from("!HBB", data)
+    address = bytes(data[ECS_HEADER_SIZE:])
+    if family not in ECS_FAMILIES or len(address) != (source_prefix_len + 7) // 8:
+        return None
+    if source_prefix_len > (32 if ECS_FAMILIES[family] == 4 else 128):
+        return None
+    return ClientSubnet(family, source_prefix_len, address)
+
+
+def encode_client_subnet(client_subnet: ClientSubnet, scope_prefix_len: int) -> bytes:
+    """
+    :return: the data of the EDNS Client Subnet option echoed in a reply, with the scope the answer is good for
+    """
+
+    return (
+        struct.pack("!HBB", client_subnet.family, client_subnet.source_prefix_len, scope_prefix_len)
+        + client_subnet.address
+    )
+
+
+def scope_prefix_len(client_subnet: ClientSubnet, unit: "MeasurementUnit") -> int:
+    """
+    :return: the scope prefix length of the answer to a query with a client subnet
+    """
+
+    # Answers to resolvers that don't want their client's subnet used are good for everyone
+    return unit.prefix_len if client_subnet.network is not None else 0
+
+
+class MeasurementUnit:
+    """
+    A simple data object that represents a network of clients, which are measured
+    and mapped to a replica as a whole.
+    """
+
+    __slots__ = ("key", "network", "probe", "last_seen", "received", "rtts", "best")
+
+    def __init__(self, key: tuple, network: str, probe: str):
+        self.key = key  # (ip version, prefix length, network bits)
+        self.network = network
+        self.probe = probe  # the address replicas ping on behalf of the whole network
+        self.last_seen = time.monotonic()
+        self.received = {}  # replica -> when its RTT came in
+        self.rtts = {}  # replica -> RTT
+        self.best = None  # {'replica': IP address, 'rtt': RTT}, None until a replica reached it
+
+    @property
+    def prefix_len(self) -> int:
+        return self.key[1]
+
+
+class SubnetTable:
+    """
+    This class represents the networks the DNS server got queries from, each with
+    the RTTs the replicas measured to it and the best replica.
+
+    Clients are grouped in networks, /24 for IPv4 and /48 for IPv6 by default, or
+    the client subnet a resolver sends along with EDNS Client Subnet if it's
+    shorter. Only one address per network, the probe, gets pinged, so measurements
+    and memory grow with the number of networks rather than the number of hosts.
+    There are at most max_entries networks, the least recently seen ones are evicted
+    first, and those that sent no queries for ttl seconds are forgotten.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = SUBNET_TABLE_SIZE,
+        ttl: float = SUBNET_TTL,
+        ipv4_prefix_len: int = IPV4_UNIT,
+        ipv6_prefix_len: int = IPV6_UNIT,
+    ):
+        """
+        :param max_entries: the max number of networks to keep track of
+        :param ttl: seconds after which a network that sent no queries is forgotten
+        :param ipv4_prefix_len: the prefix length of the networks IPv4 clients are grouped in
+        :param ipv6_prefix_len: same for IPv6
+        """
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.unit_prefix_lens = {4: ipv4_prefix_len, 6: ipv6_prefix_len}
+        self.units = OrderedDict()  # key -> MeasurementUnit, least recently seen first
+        self.probes = {}  # probe address -> MeasurementUnit
+        self.lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def touch(self, client: str, client_subnet: ClientSubnet = None) -> MeasurementUnit:
+        """
+        Records a query from a client.
+
+        :param client: the IP address the query came from, e.g. a resolver
+        :param client_subnet: the EDNS Client Subnet of the query, if it had one
+        :return: the network the query counts for
+        """
+
+        network = client_subnet.network if client_subnet is not None else None
+        if network is None:
+            # Every query goes through here, so skip the ipaddress module for the common case
+            try:
+                version, packed = 4, socket.inet_pton(socket.AF_INET, client)
+            except OSError:
+                version, packed = 6, socket.inet_pton(socket.AF_INET6, client)
+            bits = int.from_bytes(packed, "big")
+            prefix_len = self.unit_prefix_lens[version]
+            probe = client
+        else:
+            address = network.network_address
+            version, bits = address.version, int(address)
+            prefix_len = min(network.prefixlen, self.unit_prefix_lens[version])
+            # The subnet doesn't say which host the client is, so ping the first one
+            probe = str(address + 1) if prefix_len < address.max_prefixlen else str(address)
+        max_prefix_len = 32 if version == 4 else 128
+        key = version, prefix_len, bits >> (max_prefix_len - prefix_len)
+
+        now = time.monotonic()
+        with self.lock:
+            unit = self.units.get(key)
+            if unit is None:
+                address_type = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+                network_address = address_type(key[2] << (max_prefix_len - prefix_len))
+                unit = MeasurementUnit(key, f"{network_address}/{prefix_len}", probe)
+                self.units[key] = unit
+                self.probes.setdefault(probe, unit)  # in the rare case it's taken, the network goes by GeoIP
+                self.evict(now)
+            else:
+                unit.last_seen = now
+                self.units.move_to_end(key)
+            return unit
+
+    def evict(self, now: float) -> None:
+        """
+        Forgets the least recently seen networks while there are too many or they're too old.
+        """
+
+        while self.units:
+            unit = next(iter(self.units.values()))
+            if now - unit.last_seen >= self.ttl:
+                self.expirations += 1
+            elif len(self.units) > self.max_entries:
+                self.evictions += 1
+            else:
+                return
+            self.remove(unit)
+
+    def remove(self, unit: MeasurementUnit) -> None:
+        del self.units[unit.key]
+        if self.probes.get(unit.probe) is unit:
+            del self.probes[unit.probe]
+
+    def __len__(self) -> int:
+        return len(self.units)
+
+    def due(self, replica: str, max_age: float) -> list:
+        """
+        :return: the probes of the networks whose RTT from a replica is missing or older than max_age
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            self.evict(now)
+            return [
+                probe
+                for probe, unit in self.probes.items()
+                if replica not in unit.received or now - unit.received[replica] >= max_age
+            ]
+
+    def merge(self, replica: str, rtts: dict, unreachable: int) -> None:
+        """
+        Updates the best replica for every network a replica sent an RTT for.
+
+        :param rtts: the probes mapped to their RTT from the replica
+        :param unreachable: the RTT of a probe that didn't answer
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            for probe, rtt in rtts.items():
+                unit = self.probes.get(probe)
+                if unit is None:
+                    continue  # forgotten in the meantime
+                unit.received[replica] = now
+                if int(rtt) == unreachable:  # don't consider it
+                    unit.rtts.pop(replica, None)
+                else:
+                    unit.rtts[replica] = int(rtt)
+
+                if unit.rtts:
+                    best_replica = min(unit.rtts, key=unit.rtts.get)
+                    unit.best = {'replica': best_replica, 'rtt': unit.rtts[best_replica]}
+                else:
+                    unit.best = None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "networks": len(self.units),
+                "max_entries": self.max_entries,
+                "measured": sum(1 for unit in self.units.values() if unit.best is not None),
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
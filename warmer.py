@@ -0,0 +1,226 @@
+import threading
+import time
+from typing import Callable, Optional
+
+import psutil
+
+from cache import NOT_CACHED, RepliCache
+from ringlog import log
+
+# An article that was fetched but didn't make it into the cache is only tried
+# again once its views have grown by this factor
+RETRY_GROWTH = 1.5
+
+
+class CacheWarmer:
+    """
+    Fills the cache in the background after startup, so that the replica can
+    serve right away instead of the first request for every article paying for
+    a round trip to the origin.
+
+    Goes after the most viewed articles that aren't cached, one at a time. The
+    ranking is redone before every fetch from the live view counts, so articles
+    that are on the rise get fetched before they become hot. An article is only
+    fetched if the cache would take it, i.e. there's room left in one of the tiers
+    or it has more views than the least viewed cached article.
+
+    To stay out of the way of live traffic, the warmer waits while any live miss
+    is in flight or the CPU is busier than max_cpu_percent, and after each fetch
+    it sleeps for pause_factor times as long as the fetch took, so it slows down
+    along with the origin.
+
+    If the replicas fill from each other (see peers.py), only the articles this
+    replica owns are warmed. The others are one peer fetch away.
+    """
+
+    def __init__(
+        self,
+        repli_cache: RepliCache,
+        live_misses: Callable[[], int] = None,
+        fill: Callable[[str], Optional[bytes]] = None,
+        max_cpu_percent: float = 70.0,
+        pause_factor: float = 1.0,
+        idle_interval: float = 5.0,
+    ):
+        """
+        :param repli_cache: the cache to warm
+        :param live_misses: returns the number of live misses in flight, defaults to the cache's own
+        :param fill: fetches an article and caches it the way live misses do, so that they wait for it.
+        Returns None if a live miss is already at it. Defaults to going through the cache's own in_flight
+        :param max_cpu_percent: the CPU usage above which the warmer waits
+        :param pause_factor: how long to pause after a fetch, relative to how long the fetch took
+        :param idle_interval: seconds to wait before looking again when there's nothing to fetch
+        """
+
+        self.repli_cache = repli_cache
+        self.live_misses = live_misses or repli_cache.in_flight.in_flight
+        self.fill = fill or (lambda article: repli_cache.in_flight.do(article, lambda: repli_cache.fill(article)))
+        self.max_cpu_percent = max_cpu_percent
+        self.pause_factor = pause_factor
+        self.idle_interval = idle_interval
+        self.attempted = {}  # article -> views when it was fetched but didn't get cached
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+        # Progress
+        self.state = "starting"
+        self.started_at = time.monotonic()
+        self.warm_seconds = None  # how long it took until there was nothing left to fetch
+        self.warmed = 0
+        self.warmed_bytes = 0
+        self.not_admitted = 0
+        self.failed = 0
+        self.fetch_seconds = 0.0
+        self.paused_seconds = 0.0
+
+    def start(self) -> "CacheWarmer":
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def run(self) -> None:
+        psutil.cpu_percent(interval=None)  # the first call only sets the baseline
+        while not self.stopped.is_set():
+            try:
+                if self.should_yield():
+                    self.set_state("paused")
+                    self.pause(0.5)
+                    continue
+
+                article = self.next_candidate()
+                if article is None:
+                    if self.warm_seconds is None:
+                        self.warm_seconds = time.monotonic() - self.started_at
+                    self.set_state("idle")
+                    self.stopped.wait(self.idle_interval)
+                    continue
+
+                self.set_state("warming")
+                elapsed = self.warm(article)
+                self.pause(elapsed * self.pause_factor)
+            except Exception as e:
+                log(f"Cache warmer: {e!r}")
+                self.stopped.wait(self.idle_interval)
+
+    def should_yield(self) -> bool:
+        """
+        :return: whether live traffic needs the origin or the CPU right now
+        """
+
+        return self.live_misses() > 0 or psutil.cpu_percent(interval=None) > self.max_cpu_percent
+
+    def pause(self, seconds: float) -> None:
+        self.stopped.wait(seconds)
+        with self.lock:
+            self.paused_seconds += seconds
+
+    def set_state(self, state: str) -> None:
+        with self.lock:
+            self.state = state
+
+    def next_candidate(self) -> str:
+        """
+        :return: the most viewed article that isn't cached but would be, or None if there's none
+        """
+
+        repli_cache = self.repli_cache
+        with repli_cache.lock:
+            # The bar to get in: any views at all if there's room left for an average
+            # article, otherwise more than the least viewed cached article, which it would evict
+            room = max(
+                repli_cache.max_memory_size - repli_cache.memory_used,
+                repli_cache.max_disk_size - repli_cache.disk_used,
+            )
+            cached_bytes = repli_cache.memory_used + repli_cache.disk_used
+            average_size = cached_bytes / len(repli_cache.heap) if repli_cache.heap else 0
+            has_room = room > average_size
+            bar = -1 if has_room or not repli_cache.heap else repli_cache.heap.peek().views
+
+            peers = repli_cache.peers
+            best = None
+            for lookup_info in repli_cache.articles.values():
+                if lookup_info.buffer_offset != NOT_CACHED or lookup_info.views <= bar:
+                    continue
+                if peers is not None and not peers.is_owner(lookup_info.article_name):
+                    continue
+                attempted_views = self.attempted.get(lookup_info.article_name)
+                if attempted_views is not None and lookup_info.views < attempted_views * RETRY_GROWTH:
+                    continue
+                if best is None or lookup_info.views > best.views:
+                    best = lookup_info
+
+            return best.article_name if best is not None else None
+
+    def warm(self, article: str) -> float:
+        """
+        Fetches an article and caches it, the same way a live miss does. A live
+        request for the article while it's being fetched waits for this fetch.
+
+        :return: how long it took, in seconds
+        """
+
+        repli_cache = self.repli_cache
+        start = time.monotonic()
+        try:
+            compressed_article = self.fill(article)
+        except Exception as e:
+            log(f"{article}: Warming failed: {e!r}")
+            self.attempted[article] = repli_cache.articles[article].views
+            with self.lock:
+                self.failed += 1
+            return time.monotonic() - start
+        elapsed = time.monotonic() - start
+        if compressed_article is None:
+            return elapsed  # a live miss got to it first
+
+        with repli_cache.lock:
+            lookup_info = repli_cache.articles[article]
+            cached = lookup_info.buffer_offset != NOT_CACHED
+            if not cached:
+                self.attempted[article] = lookup_info.views
+
+        with self.lock:
+            self.fetch_seconds += elapsed
+            if cached:
+                self.warmed += 1
+                self.warmed_bytes += len(compressed_article)
+            else:
+                self.not_admitted += 1
+
+        if cached:
+            log(f"{article}: Warmed")
+        return elapsed
+
+    def progress(self) -> dict:
+        """
+        :return: how far along the warmer is
+        """
+
+        repli_cache = self.repli_cache
+        with repli_cache.lock:
+            total_views = sum(info.views for info in repli_cache.articles.values())
+            cached_views = sum(info.views for info in repli_cache.heap)
+            cached_articles = len(repli_cache.heap)
+            memory_used = repli_cache.memory_used
+            disk_used = repli_cache.disk_used
+
+        with self.lock:
+            return {
+                "ready": True,  # the replica serves while it warms
+                "state": self.state,
+                "uptime_seconds": time.monotonic() - self.started_at,
+                "warm_seconds": self.warm_seconds,
+                "warmed_articles": self.warmed,
+                "warmed_bytes": self.warmed_bytes,
+                "not_admitted": self.not_admitted,
+                "failed": self.failed,
+                "fetch_seconds": self.fetch_seconds,
+                "paused_seconds": self.paused_seconds,
+                "cached_articles": cached_articles,
+                # The share of all the views so far that cached articles account for
+                "view_coverage": cached_views / total_views if total_views else 0.0,
+                "memory_used": memory_used,
+                "disk_used": disk_used,
+            }
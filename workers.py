@@ -0,0 +1,660 @@
+import http
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import Counter
+from multiprocessing.connection import Client, Listener
+from queue import Empty, LifoQueue
+from typing import Callable, Optional
+
+from cache import DiskSlice, RepliCache, NOT_CACHED, ON_DISK
+from compression import CompressionStats
+from freshness import Freshness
+from measurements import RttTable
+from metrics import METRICS, Shard, report
+from origin import OriginError
+from ringlog import LOG, format_lines, log
+from streaming import ArticleStream
+
+# Requests workers send to the owner
+GET = "get"
+FILL = "fill"
+ABORT = "abort"
+RELEASE = "release"
+DUMP = "dump"
+COMPRESSION = "compression"
+WARMER = "warmer"
+MEASURE = "measure"
+MISSING = "missing"
+ADMISSION = "admission"
+FRESHNESS = "freshness"
+METRICS_REPORT = "metrics"
+PUSH_METRICS = "push_metrics"
+LOGS = "logs"
+
+# Requests the owner doesn't reply to
+FIRE_AND_FORGET = (RELEASE, PUSH_METRICS)
+
+METRICS_PUSH_INTERVAL = 5.0  # seconds between the snapshots of its metrics a worker sends the owner
+FILL_TIMEOUT = 30.0  # seconds a miss waits for another worker's fill before fetching the article itself
+
+# Replies to GET
+NOT_FOUND = "not_found"
+IN_MEMORY = "in_memory"
+IN_STORE = "in_store"
+MISS = "miss"
+ERROR = "error"
+
+
+class OwnerError(Exception):
+    """
+    Raised in a worker when the owner failed to handle one of its requests.
+    """
+
+    pass
+
+
+class CacheOwner:
+    """
+    This class represents the process that owns the cache when the replica runs
+    several worker processes (see --workers).
+
+    The workers serve HTTP, but all the bookkeeping, i.e. view counts, the heap
+    and eviction, stays in this one process so that what's hot is tracked across
+    all of them. Workers ask the owner where an article is over a unix socket and
+    read the bytes themselves: in-memory articles straight from the arena, whose
+    anonymous map was inherited across fork() and is shared, and disk articles
+    from the segment files of the disk store.
+
+    In-memory articles are pinned in the arena on behalf of the worker until it
+    releases them, so they can't be overwritten or moved while being sent. Misses
+    are fetched and compressed by the worker that got them, which is where most of
+    the CPU goes, and concurrent misses for the same article in any worker wait for
+    that single fill.
+    """
+
+    def __init__(self, repli_cache: RepliCache, rtt_table: RttTable = None):
+        """
+        :param repli_cache: the cache, built before any worker is forked
+        :param rtt_table: the RTTs to the clients, kept here so that a client is only
+        pinged once whichever worker the DNS server's request lands on
+        """
+
+        self.repli_cache = repli_cache
+        self.rtt_table = rtt_table
+        self.directory = tempfile.mkdtemp(prefix="replica-")
+        self.address = os.path.join(self.directory, "owner.sock")
+        self.listener = Listener(self.address, family="AF_UNIX")
+        self.fills = {}  # article -> event set once the worker fetching it is done
+        self.fill_leaders = {}  # article -> pid of the worker fetching it
+        self.pins = {}  # worker pid -> Counter of the arena offsets pinned for it
+        self.workers = {}  # worker pid -> worker index
+        self.worker_metrics = {}  # worker pid -> the latest snapshot of its metrics
+        self.retired_metrics = Shard()  # what the workers that exited recorded
+        self.metrics_lock = threading.Lock()
+        self.handlers = {
+            GET: self.get,
+            FILL: self.fill,
+            ABORT: self.abort,
+            RELEASE: self.release,
+            DUMP: self.dump,
+            COMPRESSION: self.compression,
+            WARMER: self.warmer,
+            MEASURE: self.measure,
+            MISSING: self.missing,
+            ADMISSION: self.admission,
+            FRESHNESS: self.freshness,
+            METRICS_REPORT: self.metrics,
+            PUSH_METRICS: self.push_metrics,
+            LOGS: self.logs,
+        }
+
+    def start(self) -> None:
+        """
+        Starts accepting connections from the workers in the background.
+        """
+
+        threading.Thread(target=self.accept_forever, daemon=True).start()
+
+    def accept_forever(self) -> None:
+        while True:
+            try:
+                connection = self.listener.accept()
+            except OSError:
+                return  # the listener was closed
+            threading.Thread(target=self.serve_connection, args=(connection,), daemon=True).start()
+
+    def serve_connection(self, connection) -> None:
+        """
+        Handles the requests of a worker on one of its connections. The first
+        message on a connection is the pid of the worker.
+        """
+
+        try:
+            pid = connection.recv()
+            while True:
+                op, *args = connection.recv()
+                try:
+                    reply = self.handlers[op](pid, *args)
+                except Exception as e:
+                    log(f"Owner: {op} failed: {e!r}")
+                    reply = (ERROR, repr(e))
+                if op not in FIRE_AND_FORGET:
+                    connection.send(reply)
+        except (EOFError, OSError):
+            pass  # the worker closed the connection or died
+        finally:
+            connection.close()
+
+    def get(self, pid: int, path: str, count_view: bool = True) -> tuple:
+        """
+        Looks an article up on behalf of a worker.
+
+        :param pid: the pid of the worker
+        :param path: the request path of the article
+        :param count_view: whether this is a new request, as opposed to a retry
+        :return: (NOT_FOUND,), (IN_MEMORY, offset, length, freshness) with the region
+        pinned, (IN_STORE, segment path, offset, length, freshness) or (MISS, article,
+        leader) where only the leader fills the cache for everyone
+        """
+
+        repli_cache = self.repli_cache
+        article = repli_cache.normalize(path)
+
+        with repli_cache.lock:
+            if count_view:
+                if not repli_cache.count_request(article):
+                    return (NOT_FOUND,)
+
+                lookup_info = repli_cache.articles.get(article)
+                if lookup_info is not None:
+                    lookup_info.increment_views()
+                    repli_cache.heap.update(lookup_info)  # no-op if the article isn't cached
+
+        waited = False
+        while True:
+            with repli_cache.lock:
+                # Articles that aren't in pageviews.csv are only tracked while they're cached
+                lookup_info = repli_cache.articles.get(article)
+                buffer_offset = lookup_info.buffer_offset if lookup_info is not None else NOT_CACHED
+                if buffer_offset >= 0:
+                    length = repli_cache.arena.pin(buffer_offset)
+                    self.pins.setdefault(pid, Counter())[buffer_offset] += 1
+                    # Stale hits are served all the same, and revalidated in the background here
+                    return IN_MEMORY, buffer_offset, length, repli_cache.check_freshness(lookup_info)
+
+                if buffer_offset == ON_DISK:
+                    try:
+                        location = repli_cache.disk_store.locate(article)
+                        return (IN_STORE, *location, repli_cache.check_freshness(lookup_info))
+                    except KeyError:
+                        pass  # evicted in the meantime, so it's a miss
+
+                if waited:
+                    if article in repli_cache.negative_cache:
+                        return (NOT_FOUND,)  # the fill we waited for found out the origin doesn't have it
+                    # The fill we waited for didn't cache it (e.g. it's not popular
+                    # enough), so there's no point in queueing up behind each other
+                    return MISS, article, False
+
+                fill = self.fills.get(article)
+                if fill is None:
+                    self.fills[article] = threading.Event()
+                    self.fill_leaders[article] = pid
+                    return MISS, article, True
+
+            # If the leader is stuck, the followers go to the origin themselves after a while
+            fill.wait(FILL_TIMEOUT)
+            waited = True
+
+    def fill(
+        self,
+        pid: int,
+        article: str,
+        compressed_article: bytes,
+        leader: bool,
+        stats: CompressionStats = None,
+        admission: float = 1.0,
+        freshness: Freshness = None,
+    ) -> bool:
+        """
+        Caches an article a worker fetched from a peer or the origin and wakes up everyone
+        waiting for it. The background recompression and revalidation happen in this process.
+        """
+
+        try:
+            self.repli_cache.cache_fetched(article, compressed_article, stats, admission, freshness)
+        finally:
+            if leader:
+                self.abort(pid, article)
+        return True
+
+    def abort(self, pid: int, article: str) -> bool:
+        """
+        Wakes up everyone waiting for a fill, e.g. because the origin fetch failed.
+        """
+
+        with self.repli_cache.lock:
+            fill = self.fills.pop(article, None)
+            self.fill_leaders.pop(article, None)
+        if fill is not None:
+            fill.set()
+        return True
+
+    def release(self, pid: int, offset: int) -> None:
+        """
+        Unpins a region of the arena pinned by get().
+        """
+
+        with self.repli_cache.lock:
+            pins = self.pins[pid]
+            pins[offset] -= 1
+            if not pins[offset]:
+                del pins[offset]
+            self.repli_cache.arena.unpin(offset)
+
+    def dump(self, pid: int) -> str:
+        return self.repli_cache.dump_articles()
+
+    def compression(self, pid: int) -> str:
+        return self.repli_cache.compression_report()
+
+    def warmer(self, pid: int) -> str:
+        return self.repli_cache.warmer_report()
+
+    def measure(self, pid: int, clients: list) -> dict:
+        return self.rtt_table.measure(clients)
+
+    def missing(self, pid: int, article: str) -> bool:
+        """
+        Remembers that the origin answered a worker's request for an article with a 404.
+        """
+
+        self.repli_cache.negative_cache.add(article)
+        return True
+
+    def admission(self, pid: int) -> str:
+        return self.repli_cache.admission_report()
+
+    def freshness(self, pid: int) -> str:
+        return self.repli_cache.freshness_report()
+
+    def push_metrics(self, pid: int, snapshot: Shard) -> None:
+        with self.metrics_lock:
+            self.worker_metrics[pid] = snapshot
+
+    def metrics(self, pid: int, snapshot: Shard) -> str:
+        """
+        :param snapshot: the metrics of the worker asking, the other workers' are as of their last push
+        :return: the metrics of this process and all the workers, merged, as JSON
+        """
+
+        merged = METRICS.snapshot()
+        with self.metrics_lock:
+            self.worker_metrics[pid] = snapshot
+            merged.merge(self.retired_metrics)
+            for worker_snapshot in self.worker_metrics.values():
+                merged.merge(worker_snapshot)
+            workers = len(self.worker_metrics)
+        return json.dumps({**report(merged), "cache": self.repli_cache.usage(), "workers": workers})
+
+    def logs(self, pid: int) -> list:
+        return LOG.tail()
+
+    def warm(self, article: str) -> Optional[bytes]:
+        """
+        Fetches an article and caches it for the warmer, which leads the fill the same
+        way a worker does, so that the workers' misses for the article wait for it.
+
+        :return: the compressed article, or None if a worker is already filling it
+        """
+
+        repli_cache = self.repli_cache
+        with repli_cache.lock:
+            if article in self.fills:
+                return None
+            self.fills[article] = threading.Event()
+            self.fill_leaders[article] = os.getpid()
+        try:
+            return repli_cache.fill(article)
+        finally:
+            self.abort(os.getpid(), article)
+
+    def misses_in_flight(self) -> int:
+        """
+        :return: the number of articles workers (or the warmer) are fetching from the origin right now
+        """
+
+        with self.repli_cache.lock:
+            return len(self.fills)
+
+    def forget_worker(self, pid: int) -> None:
+        """
+        Unpins everything a worker that exited never got to release, and wakes up
+        everyone waiting for the fills it was leading, which would never end otherwise.
+        """
+
+        with self.repli_cache.lock:
+            for offset, count in self.pins.pop(pid, Counter()).items():
+                for _ in range(count):
+                    self.repli_cache.arena.unpin(offset)
+            articles = [article for article, leader in self.fill_leaders.items() if leader == pid]
+            fills = [self.fills.pop(article) for article in articles if article in self.fills]
+            for article in articles:
+                del self.fill_leaders[article]
+        for fill in fills:
+            fill.set()
+
+        with self.metrics_lock:
+            snapshot = self.worker_metrics.pop(pid, None)
+            if snapshot is not None:
+                self.retired_metrics.merge(snapshot)
+
+    def run_workers(
+        self, count: int, start_worker: Callable[[int], None], started: Callable[[], None] = None
+    ) -> None:
+        """
+        Forks count worker processes and restarts any that die, until interrupted.
+
+        The first workers are forked before any of the owner's threads run, so that none
+        of them holds a lock the workers inherit. Workers restarted later are forked while
+        they do, which is why RepliCache replaces its locks after a fork.
+
+        :param count: the number of workers
+        :param start_worker: runs in each worker with its index, and serves until interrupted
+        :param started: runs in the owner once the first workers are forked, to start its threads
+        """
+
+        # Turn SIGTERM (e.g. from pkill) into a KeyboardInterrupt here and in the workers
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            for index in range(count):
+                self.fork_worker(index, start_worker)
+            if started is not None:
+                started()
+
+            while True:
+                pid, status = os.wait()
+                index = self.workers.pop(pid, None)
+                if index is None:
+                    continue
+                self.forget_worker(pid)
+                log(f"Worker {index} (pid {pid}) exited with status {status}, restarting it")
+                self.fork_worker(index, start_worker)
+        except KeyboardInterrupt:
+            for pid in self.workers:
+                os.kill(pid, signal.SIGTERM)
+            for pid in self.workers:
+                os.waitpid(pid, 0)
+
+    def fork_worker(self, index: int, start_worker: Callable[[int], None]) -> None:
+        LOG.flush()
+        sys.stdout.flush()  # otherwise the worker would print whatever is buffered again
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = index
+            return
+
+        status = 0
+        try:
+            start_worker(index)
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            LOG.flush()
+            sys.stdout.flush()
+            os._exit(status)  # never return into the owner's code
+
+    def close(self) -> None:
+        self.listener.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class SharedCacheClient:
+    """
+    This class stands in for RepliCache in the worker processes and has the same
+    interface as far as the http servers are concerned.
+
+    Lookups go to the owner (see CacheOwner), and the articles are read from the
+    shared arena or the segment files directly. Connections to the owner are pooled
+    so that the threads of the worker can talk to it at the same time.
+    """
+
+    def __init__(self, address: str, repli_cache: RepliCache, max_connections: int = 64):
+        """
+        :param address: the address of the owner
+        :param repli_cache: the worker's copy of the cache as of the fork. Only its arena
+        (which is shared), its origin pool and its peer group (which must be the worker's own) are used
+        :param max_connections: the max number of connections to the owner
+        """
+
+        self.address = address
+        self.repli_cache = repli_cache
+        self.arena_view = repli_cache.arena.view
+        self.connections = LifoQueue()
+        self.connection_slots = threading.BoundedSemaphore(max_connections)
+        self.leases = {}  # id(slice) -> offset of the region it was taken from
+        self.lock = threading.Lock()
+        threading.Thread(target=self.push_metrics_forever, daemon=True).start()
+
+    @property
+    def origin_pool(self):
+        return self.repli_cache.origin_pool
+
+    def checkout(self):
+        self.connection_slots.acquire()
+        try:
+            return self.connections.get_nowait()
+        except Empty:
+            pass
+
+        try:
+            connection = Client(self.address, family="AF_UNIX")
+            connection.send(os.getpid())
+            return connection
+        except BaseException:
+            self.connection_slots.release()
+            raise
+
+    def checkin(self, connection) -> None:
+        self.connections.put(connection)
+        self.connection_slots.release()
+
+    def call(self, *request, reply: bool = True):
+        """
+        Sends a request to the owner and waits for its reply, unless there isn't one.
+
+        :raises OwnerError: if the owner failed to handle the request
+        """
+
+        connection = self.checkout()
+        try:
+            connection.send(request)
+            response = connection.recv() if reply else None
+        except BaseException:
+            # The connection might be out of sync, so don't reuse it
+            connection.close()
+            self.connection_slots.release()
+            raise
+        self.checkin(connection)
+
+        if isinstance(response, tuple) and response[0] == ERROR:
+            raise OwnerError(response[1])
+        return response
+
+    def get(self, article: str, from_peer: bool = False, wait: bool = True) -> (bool, bytes, Freshness):
+        """
+        Same as RepliCache.get().
+        """
+
+        return self.get_helper(article, from_peer, wait)
+
+    def get_helper(self, article: str, from_peer: bool = False, wait: bool = True) -> (bool, bytes, Freshness):
+        count_view = True
+        while True:
+            response = self.call(GET, article, count_view)
+            kind = response[0]
+
+            if kind == NOT_FOUND:
+                return False, None, None
+
+            if kind == IN_MEMORY:
+                _, offset, length, freshness = response
+                # Zero-copy slice of the shared arena, pinned by the owner until release() is called
+                data = self.arena_view[offset : offset + length]
+                with self.lock:
+                    self.leases[id(data)] = offset
+                return True, data, freshness
+
+            if kind == IN_STORE:
+                path, offset, length, freshness = response[1:]
+                try:
+                    return True, DiskSlice(open(path, "rb"), offset, length), freshness
+                except FileNotFoundError:
+                    # The segment got compacted away in the meantime, look it up again
+                    count_view = False
+                    continue
+
+            _, article, leader = response
+            try:
+                if self.repli_cache.streaming:
+                    stream = self.attach_stream(article, leader, from_peer, wait)
+                    return True, stream, stream.freshness
+                return (True, *self.fill(article, leader, from_peer))
+            except OriginError as e:
+                if e.status != http.HTTPStatus.NOT_FOUND:
+                    raise
+                return False, None, None
+
+    def fill(
+        self, article: str, leader: bool, from_peer: bool = False, stream: ArticleStream = None
+    ) -> (bytes, Freshness):
+        """
+        Fetches an article this worker got a miss for and hands it to the owner to cache.
+
+        :param leader: whether the owner has everyone else wait for this fill
+        :param stream: where to write the compressed article as it comes in, if anywhere
+        :return: the compressed article and how fresh it is
+        """
+
+        try:
+            compressed_article, freshness, admission = self.repli_cache.fetch_compressed(article, from_peer, stream)
+        except BaseException as e:
+            if isinstance(e, OriginError) and e.status == http.HTTPStatus.NOT_FOUND:
+                # Before waking anyone up, so that they don't try the origin too
+                self.call(MISSING, article)
+            if leader:
+                self.call(ABORT, article)
+            raise
+        # The owner keeps the compression stats along with everything else
+        stats = self.repli_cache.compressor.pop(article)
+        self.call(FILL, article, compressed_article, leader, stats, admission, freshness)
+        return compressed_article, freshness
+
+    def attach_stream(self, article: str, leader: bool, from_peer: bool = False, wait: bool = True) -> ArticleStream:
+        """
+        Same as RepliCache.attach_stream(), except that only the request that got the
+        miss reads from the stream. Requests for the article in the meantime wait for
+        the owner to cache it, like without streaming.
+        """
+
+        stream = ArticleStream(article)
+        threading.Thread(target=self.produce, args=(stream, leader, from_peer), daemon=True).start()
+        if wait:
+            stream.wait_started()
+        return stream
+
+    def produce(self, stream: ArticleStream, leader: bool, from_peer: bool = False) -> None:
+        try:
+            self.fill(stream.article, leader, from_peer, stream)
+            stream.finish()
+        except BaseException as e:
+            stream.fail(e)
+
+    def dump_articles(self) -> str:
+        return self.call(DUMP)
+
+    def compression_report(self) -> str:
+        return self.call(COMPRESSION)
+
+    def warmer_report(self) -> str:
+        return self.call(WARMER)
+
+    def admission_report(self) -> str:
+        return self.call(ADMISSION)
+
+    def freshness_report(self) -> str:
+        return self.call(FRESHNESS)
+
+    def metrics_report(self) -> str:
+        return self.call(METRICS_REPORT, METRICS.snapshot())
+
+    def push_metrics_forever(self) -> None:
+        """
+        Sends the owner a snapshot of the worker's metrics every now and then, so
+        that a report from any worker covers all of them.
+        """
+
+        while True:
+            time.sleep(METRICS_PUSH_INTERVAL)
+            try:
+                self.call(PUSH_METRICS, METRICS.snapshot(), reply=False)
+            except Exception as e:
+                log(f"Pushing the metrics failed: {e!r}")
+
+    def logs_report(self) -> str:
+        """
+        :return: the lines in the owner's log and this worker's, in order
+        """
+
+        lines = self.call(LOGS) + LOG.tail()
+        return format_lines(sorted(lines, key=lambda line: line[1]))
+
+    def peer_report(self) -> str:
+        # Each worker fetches from the peers on its own, so these are the worker's counters
+        return self.repli_cache.peer_report()
+
+    def release(self, data: bytes) -> None:
+        """
+        Same as RepliCache.release().
+        """
+
+        if isinstance(data, memoryview):
+            with self.lock:
+                offset = self.leases.pop(id(data), None)
+            if offset is None:
+                return
+            data.release()
+            self.call(RELEASE, offset, reply=False)
+        elif isinstance(data, DiskSlice):
+            data.file.close()
+
+
+class SharedRttTable:
+    """
+    This class stands in for RttTable in the worker processes. The table is kept by
+    the owner (see CacheOwner), and the pings run there too.
+    """
+
+    def __init__(self, client: SharedCacheClient):
+        """
+        :param client: the worker's connection pool to the owner
+        """
+
+        self.client = client
+
+    def measure(self, clients: list) -> dict:
+        """
+        Same as RttTable.measure().
+        """
+
+        return self.client.call(MEASURE, clients)